@@ -1,41 +1,78 @@
 import datetime, json ,sys, base64, configparser, dbClient, hsmclient, logger, atexit, uuid, time, flask, tableBuilder, \
-    secrets, random, hashlib, logging
+    secrets, random, hashlib, logging, checkinBuffer, csv, io, concurrent.futures, enrollmentPool, \
+    sessionStore, hmac, startup, profiling, machineCache, os
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor
 from pony import orm
 from flask_wtf.csrf import generate_csrf
 from flask import Response
+from markupsafe import Markup
 
 
 class Controller():
-    # number of allowed usages of the HSM Token configured in the HSM
+    # number of allowed usages of the HSM Token configured in the HSM, used if the login response doesn't state it
     hsmTokenMaxUses = 10
+    # threads of the scheduler running the interval jobs, part of the default db pool size
+    schedulerThreads = 10
 
-    def __init__(self):
+    """
+    Sets up the controller of one server process
+    parameters:
+        worker: index of this worker process, the jobs which must only run once (like renewing the hsm secret) are only
+                scheduled in worker 0
+        workers: number of worker processes the server runs
+    """
+    def __init__(self, worker: int = 0, workers: int = 1):
         # Setup the config and secret parser, considering if the script is called in development mode
-        self.__config = configparser.ConfigParser()
-        self.__secrets = configparser.ConfigParser()
         self.devmode = '-dev' in list(sys.argv)
+        self.__config = startup.readConfig(self.devmode)
+        self.__secrets = configparser.ConfigParser()
         if self.devmode:
-            self.__config.read('app/config-dev.ini')
             self.__secrets.read('app/secrets-dev.ini')
         else:
-            self.__config.read('app/config.ini')
             self.__secrets.read('app/secrets.ini')
         # Starts the logger with a custom format
         self.logger = logger.Logger(self.__config['LOGGING']['LEVEL'],self.__config['LOGGING']['LOGFOLDER'],
-                                    int(self.__config['LOGGING']['LOGLINERETENTION']))
+                                    int(self.__config['LOGGING']['LOGLINERETENTION']),
+                                    jsonFormat=self.__config.get("LOGGING", "format", fallback="text") == "json",
+                                    queueSize=self.__config.getint("LOGGING", "queue-size", fallback=10000))
         # Setup the mysql connection with the pony ORM
         self.__mysqlConx = dbClient.dbClient(self.__config['MYSQL']['username'],
                                              self.__secrets['MYSQL']['password'],
                                              self.__config['MYSQL']['host'], self.__config['MYSQL']['database'],
-                                             self.devmode)
+                                             self.devmode,
+                                             poolSize=self.__dbPoolSize(),
+                                             poolRecycle=self.__config.getint("MYSQL", "pool-recycle", fallback=3600),
+                                             connectTimeout=self.__config.getint("MYSQL", "connect-timeout", fallback=10),
+                                             readTimeout=self.__config.getint("MYSQL", "read-timeout", fallback=30),
+                                             sqlSampleRate=self.__config.getfloat("MYSQL", "sql-sample-rate", fallback=0.0),
+                                             replicaHost=self.__config.get("MYSQL", "replica-host", fallback=None) or None)
 
         # Setup the tablebuilder with the db connection for server-side html table building
         self.__tableBuilder = tableBuilder.TableBuilder(self.__mysqlConx)
-        # Setup runtime tables to store temporary valid sharelinks and valid updatesessionids
-        self.__updateSessions = {}
-        self.__shareLinks = {}
-        self.__updateSessionSalt = uuid.uuid4().hex
+        # Setup the store of the temporary valid sharelinks and updatesessionids, shared by all server processes
+        # unless the memory backend is used
+        self.__sessions = sessionStore.createSessionStore(self.__config.get("SESSIONS", "backend", fallback="memory"),
+                                                          self.__mysqlConx,
+                                                          self.__config.get("SESSIONS", "sqlite-path", fallback=None),
+                                                          self.__config.getint("SESSIONS", "max-size", fallback=10000))
+        if workers > 1 and self.__config.get("SESSIONS", "backend", fallback="memory") == "memory":
+            logging.getLogger('mlaps').warning(f"The memory session store isn't shared by the {workers} workers, "
+                                               f"update sessions, share links and enrollment polls only work in the "
+                                               f"worker creating them")
+        self.__updateSessionTTL = self.__config.getint("SESSIONS", "update-session-ttl", fallback=86400)
+        self.__shareLinkTTL = self.__config.getint("SESSIONS", "share-link-ttl", fallback=900)
+        # Setup the cache of the tables of the machine detail page, invalidated by every write to the machine
+        self.__machineCache = machineCache.MachineCache(self.__sessions,
+                                                        self.__config.getint("TABLES", "detail-cache-ttl", fallback=60),
+                                                        self.__config.getint("TABLES", "detail-cache-size", fallback=1000))
+        # Setup the opt-in request profiling, an empty header disables profiling by header
+        self.profiler = profiling.Profiler(self.__mysqlConx.dbClient,
+                                           self.__config.getfloat("PROFILING", "sample-rate", fallback=0.0),
+                                           self.__config.get("PROFILING", "header", fallback="") or None,
+                                           self.__config.getfloat("PROFILING", "slow-threshold", fallback=1.0),
+                                           self.__config.getint("PROFILING", "slow-log-size", fallback=100),
+                                           self.__config['LOGGING']['LOGFOLDER'])
 
         """
         Trys to read the HSM login credentials from the auth-secret table, if no rows are present read the table again in 5 sec indefinitely until a line was successfully read
@@ -46,11 +83,30 @@ class Controller():
             if hsmData:
                 break
             else:
+                # the server already answers /ping meanwhile, /ready only once this is done
+                logging.getLogger('mlaps').warning("No hsm secret found in the database, retrying in 5 seconds")
                 time.sleep(5)
 
+        # The scheduler is started once all jobs have been added, the hsm client already hands it its standby token refills
+        self.__scheduler = BackgroundScheduler(executors={'default': ThreadPoolExecutor(self.schedulerThreads)})
+
         # Login to the HSM and obtain a token
         self.__hsmClient = hsmclient.HSMClient(self.getHSMHost(), hsmData.role_id,
-                                               hsmData.secret_id)
+                                               hsmData.secret_id,
+                                               poolSize=self.__config.getint("HSM", "pool-size", fallback=10),
+                                               timeout=self.__config.getint("HSM", "timeout", fallback=30),
+                                               keepAlive=self.__config.getint("HSM", "keep-alive", fallback=60),
+                                               maxUses=self.hsmTokenMaxUses,
+                                               standbyTokens=self.__config.getint("HSM", "standby-tokens", fallback=1),
+                                               scheduler=self.__scheduler,
+                                               # only worker 0 renews the secret id, the others pick it up from the db
+                                               readCredentials=self.__readHsmCredentials)
+
+        # Setup the bounded worker pool which signs the csrs of enrollments outside of the request and db session
+        self.__enrollmentPool = enrollmentPool.EnrollmentPool(self.__signEnrollment,
+                                                              self.__config.getint("ENROLL", "workers", fallback=4),
+                                                              self.__config.getint("ENROLL", "max-pending", fallback=100),
+                                                              self.__config.getint("ENROLL", "result-ttl", fallback=600))
 
         #After the hsm authenticated, renew secrets immediately in order to ensure correct timing between renewals
         #self.renewHsmSecret()
@@ -58,12 +114,44 @@ class Controller():
         """ Setup the interval scheduler to automatically renew the HSM token and login credentials """
         # 10800 is 3 hours in seconds
         # 7200 is 2 hours
-        self.__scheduler = BackgroundScheduler()
-        self.__scheduler.add_job(func=self.renewHsmSecret, trigger="interval", seconds=9000)
+        # The other workers pick the new secret up from the database with their next relogin
+        if worker == 0:
+            self.__scheduler.add_job(func=self.renewHsmSecret, trigger="interval", seconds=9000)
         self.__scheduler.add_job(func=self.reLoginHsm, trigger="interval", seconds=3500)
+        # Keep the standby tokens topped up and replace them before they expire, so no request ever waits for a login
+        self.__scheduler.add_job(func=self.__hsmClient.refreshStandbyTokens, trigger="interval",
+                                 seconds=self.__config.getint("HSM", "standby-refresh", fallback=60))
+
+        # Setup the write-behind buffer for checkins, flushed when full or by the scheduler every flush-interval seconds
+        self.__checkinBuffer = checkinBuffer.CheckinBuffer(self.__mysqlConx,
+                                                           self.__config.getint("CHECKIN", "buffer-size", fallback=500),
+                                                           self.__scheduler,
+                                                           onFlush=lambda uids: self.__machineCache.invalidate(
+                                                               *uids, shared=False))
+        self.__scheduler.add_job(func=self.__checkinBuffer.flush, trigger="interval",
+                                 seconds=self.__config.getint("CHECKIN", "flush-interval", fallback=10))
+        if worker == 0:
+            # Mark the passwords which passed their expiry as expired, outside of the dashboard requests
+            self.__scheduler.add_job(func=self.expireOverduePasswords, trigger="interval",
+                                     seconds=self.__config.getint("TABLES", "expire-interval", fallback=300))
+            # Roll old checkins up into daily summaries once a day
+            self.__scheduler.add_job(func=self.rollupCheckins, trigger="cron",
+                                     hour=self.__config.getint("CHECKIN", "rollup-hour", fallback=3))
+        if worker == 0 or isinstance(self.__sessions, sessionStore.MemorySessionStore):
+            # Remove expired update sessions and share links, also evicts the ones of a namespace expiring the soonest above max-size
+            self.__scheduler.add_job(func=self.sweepSessions, trigger="interval",
+                                     seconds=self.__config.getint("SESSIONS", "sweep-interval", fallback=60))
         self.__scheduler.start()
-        # Shut down the scheduler when exiting the app
-        atexit.register(lambda: self.__scheduler.shutdown())
+        # Shut down the scheduler and flush the buffered checkins when exiting the app
+        atexit.register(self.shutdown)
+
+    """
+    Stops the scheduler and the enrollment workers and writes all buffered checkins, registered to be called on exit
+    """
+    def shutdown(self):
+        self.__scheduler.shutdown()
+        self.__enrollmentPool.shutdown()
+        self.__checkinBuffer.flush()
 
     def getCompanyName(self) -> str:
         return self.__config["GENERAL"]["company-name"]
@@ -74,6 +162,30 @@ class Controller():
     def getHSMHost(self) -> str:
         return self.__config["HSM"]["host"]
 
+    def getHSMBatchSize(self) -> int:
+        return self.__config.getint("HSM", "batch-size", fallback=100)
+
+    """
+    Returns the number of db connections kept open between db sessions, by default enough for every thread of this
+    process using the db: the server threads, the enrollment workers and the scheduler executor plus a few for the
+    startup and the hsm token threads
+    """
+    def __dbPoolSize(self) -> int:
+        configured = self.__config.get("MYSQL", "pool-size", fallback="").strip()
+        if configured:
+            return int(configured)
+        return (self.__config.getint("SERVER", "threads", fallback=10) +
+                self.__config.getint("ENROLL", "workers", fallback=4) + self.schedulerThreads + 3)
+
+    def getPageSize(self) -> int:
+        return self.__config.getint("TABLES", "page-size", fallback=50)
+
+    def getTableStreaming(self) -> bool:
+        return self.__config.getboolean("TABLES", "streaming", fallback=False)
+
+    def getStreamChunkSize(self) -> int:
+        return self.__config.getint("TABLES", "stream-chunk-size", fallback=500)
+
     """
     Checks if the given UUID from a request is known in the database
     Returns a boolean according
@@ -86,46 +198,72 @@ class Controller():
                 return False
 
     """
-    Combines the index html template with the rendered machine html table
+    Combines the index html template with the rendered page of the machine html table
     Appends a csrf token to the response and returns it
     """
-    def handleIndex(self, sort_col: str, directionReverse) -> Response:
-        resp: Response = flask.make_response(flask.render_template("index.html",
-                                                         table=self.__tableBuilder.getMachineTable(sort_by=sort_col,
-                                                                                                   sort_reverse=directionReverse)))
+    def handleIndex(self, sort_col: str, directionReverse, search='', page=1) -> Response:
+        if self.getTableStreaming():
+            chunks = self.__tableBuilder.streamMachineTable(sort_by=sort_col, sort_reverse=directionReverse,
+                                                            search=search, chunkSize=self.getStreamChunkSize())
+            resp: Response = self.__streamResponse(flask.stream_template("index.html", tableChunks=chunks,
+                                                                         sort=sort_col, direction=directionReverse,
+                                                                         search=search))
+            resp.set_cookie('X-CSRFToken', generate_csrf(), secure=True, httponly=True)
+            return resp
+        table, pagination = self.__tableBuilder.getMachineTable(sort_by=sort_col, sort_reverse=directionReverse,
+                                                                search=search, page=max(page, 1),
+                                                                pageSize=self.getPageSize())
+        resp: Response = flask.make_response(flask.render_template("index.html", table=table, pagination=pagination,
+                                                                   sort=sort_col, direction=directionReverse,
+                                                                   search=search))
         resp.set_cookie('X-CSRFToken', generate_csrf(), secure=True, httponly=True)
         return resp
 
     """
-    Combines the accesslog html template with the rendered audit html table
-    """
-    def handleAccessLog(self, sort_col: str, directionReverse) -> str:
-        return flask.render_template("accesslog.html",
-                                     table=self.__tableBuilder.getAccessTable(sort_by=sort_col, sort_reverse=directionReverse))
-
-    """
-    Adds an checkin entry in the database with the given UUID,
+    Combines the accesslog html template with the rendered page of the audit html table
+    dateFrom and dateTo are expected as iso formatted dates (YYYY-MM-DD), invalid dates are ignored
+    """
+    def handleAccessLog(self, sort_col: str, directionReverse, search='', dateFrom='', dateTo='', page=1):
+        if self.getTableStreaming():
+            chunks = self.__tableBuilder.streamAccessTable(sort_by=sort_col, sort_reverse=directionReverse,
+                                                           search=search, dateFrom=self.__parseDate(dateFrom),
+                                                           dateTo=self.__parseDate(dateTo),
+                                                           chunkSize=self.getStreamChunkSize())
+            return self.__streamResponse(flask.stream_template("accesslog.html", tableChunks=chunks, sort=sort_col,
+                                                               direction=directionReverse, search=search,
+                                                               dateFrom=dateFrom, dateTo=dateTo))
+        table, pagination = self.__tableBuilder.getAccessTable(sort_by=sort_col, sort_reverse=directionReverse,
+                                                               search=search, dateFrom=self.__parseDate(dateFrom),
+                                                               dateTo=self.__parseDate(dateTo), page=max(page, 1),
+                                                               pageSize=self.getPageSize())
+        return flask.render_template("accesslog.html", table=table, pagination=pagination, sort=sort_col,
+                                     direction=directionReverse, search=search, dateFrom=dateFrom, dateTo=dateTo)
+
+    """
+    Buffers a checkin entry for the given UUID, which gets written with the next flush of the checkin buffer,
+    and updates the hostname and serialnumber if needed, all with a single read
     Checks if the password of given machine is expired
         if it is not, return a list with just boolean true
         if it is, return a list with boolean false and a new updatesessionid with is also saved in a dict
     """
     def handleCheckin(self, uid: str, hn: str, sn: str) -> list:
         huid = uuid.UUID(uid)
-        with orm.db_session:
-            if self.checkUUID(huid):
-                # uuid is known
-                self.__mysqlConx.createCheckin(huid)
-                if not self.__mysqlConx.updateMachineInfo(huid, sn, hn):
-                    return [False, "Failed to update machine with hostname and serialnumber"]
-                if self.__mysqlConx.checkPasswordValidityString(huid):
-                    return [True]
-                else:
-                    #usid is updateSessionID
-                    usid: str = self.get_random_string()
-                    self.__updateSessions.update({uid: usid})
-                    return [False, {'updateSessionID': usid}]
-            else:
-                return [False, "Failed to find uid in db"]
+        passwordValid = self.__mysqlConx.checkinMachine(huid, sn, hn)
+        if passwordValid is None:
+            return [False, "Failed to find uid in db"]
+        self.__checkinBuffer.add(huid)
+        # checkins are too frequent to share the new version with the other workers, they see it after the cache ttl
+        self.__machineCache.invalidate(huid, shared=False)
+        if passwordValid:
+            return [True]
+        else:
+            #usid is updateSessionID
+            usid: str = self.get_random_string()
+            # an update session id which wasn't stored would only be rejected by handleUpdatePassword
+            if not self.__sessions.set('update', uid, usid, self.__updateSessionTTL):
+                logging.getLogger('mlaps').error("Failed to store the update session of %s", uid)
+                return [False, "Failed to start the password update, try again later"]
+            return [False, {'updateSessionID': usid}]
 
 
     """
@@ -134,13 +272,13 @@ class Controller():
     """
     def handleUpdatePassword(self, password: str, uid: str, updateSessionID: str) -> list:
         logging.getLogger('mlaps').debug(updateSessionID)
-        logging.getLogger('mlaps').debug(self.__updateSessions)
 
         # Check if a password is needed and if the given updatesessionid is currently registered to the provided UUID
-        if not uid in self.__updateSessions:
+        usid = self.__sessions.get('update', uid)
+        if usid is None:
             logging.getLogger('mlaps').warning(f"Rejecting updatePassword payload of {uid} because the latest password is not expired")
             return [False, "Password not expired"]
-        elif not updateSessionID == self.__updateSessions.get(uid):
+        elif not updateSessionID == usid:
             logging.getLogger('mlaps').warning(f"Rejecting updatePassword payload of {uid} because the client sent an invalid updateSessionID")
             return [False, "Wrong UpdateSessionID was sent"]
 
@@ -148,9 +286,7 @@ class Controller():
             # Gets and checks if the given uuid is known as a machine
             machine: dbClient.dbClient.Machine = self.__mysqlConx.readMachine(uid)
             if machine:
-                # Check if the hsm token is still valid for the next vault request
-                self.checkHSMTokenValidity()
-                logging.getLogger('mlaps').debug(f"Trying to encrypt Password: '{password}'")
+                logging.getLogger('mlaps').debug("Trying to encrypt the new password of %s", uid)
                 # Sends the cleartext to the hsm and trys to read the response
                 password_encrpy: dict = self.__hsmClient.hsm_enc(password)
                 try:
@@ -163,6 +299,9 @@ class Controller():
                 res = self.__mysqlConx.createPassword(machine.id, password_encrpy)
                 # If everything worked, the updatesessionid is removed and a successful response is returned
                 if res:
+                    # committed before the other workers are told to rebuild the tables of the machine
+                    orm.commit()
+                    self.__machineCache.invalidate(machine.id)
                     return [True, "ok"]
                 else:
                     logging.getLogger('mlaps').warning(
@@ -181,19 +320,20 @@ class Controller():
     """
     def handleUpdatePasswordConfirmation(self, res,  uid: str, updateSessionID: str):
         logging.getLogger('mlaps').debug(updateSessionID)
-        logging.getLogger('mlaps').debug(self.__updateSessions)
 
         # Check if a password is needed and if the given updatesessionid is currently registered to the provided UUID
-        if not uid in self.__updateSessions:
+        usid = self.__sessions.get('update', uid)
+        if usid is None:
             logging.getLogger('mlaps').warning(f"Rejecting updatePasswordConfirmation payload of {uid} because the latest password is not expired")
             return [False, "Password not expired"]
-        elif not updateSessionID == self.__updateSessions.get(uid):
+        elif not updateSessionID == usid:
             logging.getLogger('mlaps').warning(f"Rejecting updatePasswordConfirmation payload of {uid} because the client sent an invalid updateSessionID")
             return [False, "Wrong UpdateSessionID was sent"]
 
         if self.__mysqlConx.updatePasswordSecStage(res, uuid.UUID(uid)):
-            logging.getLogger('mlaps').debug(f"Successfully set new status for newest password for machine {uid}")
-            self.__updateSessions.pop(uid)
+            logging.getLogger('mlaps').debug("Successfully set new status for newest password for machine %s", uid)
+            self.__machineCache.invalidate(uid)
+            self.__sessions.pop('update', uid)
             return [True, "Ok"]
         else:
             logging.getLogger('mlaps').warning(f"Rejecting updatePasswordConfirmation payload of {uid} because the db waa unable "
@@ -202,32 +342,79 @@ class Controller():
 
     """
     Trys to issue an new certificate for the machine with the given csr, hostname and serialnummber (not of which must be unique)
-    Returns a pem format certificate or an string with an error message what step failed
+    The machine is created in its own short db session, the csr is signed by the enrollment pool outside of it
+    Returns [True, pem format certificate] if the signing finished within the configured wait time,
+    [None, enrollment id] if it is still running and can be polled with handleEnrollStatus, or [False, error message]
     """
-    def handleEnrollClient(self, csr, hostname, serialnumber):
+    def handleEnrollClient(self, csr, hostname, serialnumber) -> list:
         # Generate a new UUID which will be the id for the machine
         uid = uuid.uuid4()
-        with orm.db_session:
-            # Create a new entry in the database
-            dbResp = self.__mysqlConx.createMachine(uid, serialnumber, hostname)
-            if dbResp:
-                # if the machine was successfully created,
-                # send the csr to the hsm signing endpoint to get a new certicate with the cn set to the previously created uuid
-                self.checkHSMTokenValidity()
-                hsmResp = self.__hsmClient.hsm_sign_csr(csr, str(uid))
-                # if the hsm returned a valid response, return the included certifcate
-                if hsmResp != False:
-                    # successfully enrolled
-                    return hsmResp["data"]["certificate"]
-                else:
-                    # error occurred
-                    logging.getLogger('mlaps').warning(f"Failed to sign the CSR in vault")
-                    self.__mysqlConx.removeMachine(uid)
-                    return "Failed to sign the CSR in vault"
-            else:
-                # error occurred
-                logging.getLogger('mlaps').error(f"Failed to create new machine in the DB")
-            return "Failed to create new machine in the DB"
+        # Create a new entry in the database
+        if not self.__mysqlConx.createMachine(uid, serialnumber, hostname):
+            # error occurred
+            logging.getLogger('mlaps').error(f"Failed to create new machine in the DB")
+            return [False, "Failed to create new machine in the DB"]
+        # announce the pending enrollment in the shared session store, the poll may reach another worker
+        if not self.__sessions.set('enroll', str(uid), {'result': None}, self.__enrollmentPool.resultTTL):
+            logging.getLogger('mlaps').error(f"Failed to store the pending enrollment of {uid}")
+            self.__mysqlConx.removeMachine(str(uid))
+            return [False, "Failed to enroll, the enrollment couldn't be stored"]
+        # if the machine was successfully created, hand the csr to the signing workers
+        future = self.__enrollmentPool.submit(uid, csr)
+        if future is None:
+            logging.getLogger('mlaps').warning(f"Rejecting enrollment of {uid}, too many enrollments are pending")
+            self.__sessions.pop('enroll', str(uid))
+            self.__mysqlConx.removeMachine(str(uid))
+            return [False, "Failed to enroll, too many enrollments are pending, try again later"]
+        try:
+            return self.__enrollResult(future.result(timeout=self.__config.getint("ENROLL", "wait", fallback=3)))
+        except concurrent.futures.TimeoutError:
+            return [None, str(uid)]
+
+    """
+    Returns the state of a pending enrollment in the same format as handleEnrollClient,
+    or None if the enrollment id is unknown or its result expired
+    The enrollment is looked up in the shared session store, since the poll may reach another worker than the one
+    signing the csr, only the cancellation on shutdown is known by the signing worker alone
+    """
+    def handleEnrollStatus(self, enrollID: str) -> list:
+        try:
+            uid = uuid.UUID(enrollID)
+        except ValueError:
+            return None
+        future = self.__enrollmentPool.get(uid)
+        if future is not None and future.cancelled():
+            return [False, "Failed to enroll, the signing was cancelled"]
+        entry = self.__sessions.get('enroll', str(uid))
+        if entry is None:
+            return None
+        if entry['result'] is None:
+            return [None, enrollID]
+        return self.__enrollResult(entry['result'])
+
+    def __enrollResult(self, res: str) -> list:
+        return [False, res] if res.startswith("Failed") else [True, res]
+
+    """
+    Sends the csr to the hsm signing endpoint to get a new certificate with the cn set to the id of the machine,
+    runs on a worker of the enrollment pool, the machine is removed again if the signing failed
+    The result is also stored in the shared session store for the polls of the client
+    Returns the pem format certificate or an error message starting with Failed
+    """
+    def __signEnrollment(self, uid: uuid.UUID, csr: str) -> str:
+        hsmResp = self.__hsmClient.hsm_sign_csr(csr, str(uid))
+        # if the hsm returned a valid response, return the included certifcate
+        if hsmResp != False:
+            # successfully enrolled
+            res = hsmResp["data"]["certificate"]
+        else:
+            # error occurred
+            logging.getLogger('mlaps').warning(f"Failed to sign the CSR in vault")
+            self.__mysqlConx.removeMachine(str(uid))
+            res = "Failed to sign the CSR in vault"
+        if not self.__sessions.set('enroll', str(uid), {'result': res}, self.__enrollmentPool.resultTTL):
+            logging.getLogger('mlaps').error(f"Failed to store the result of the enrollment of {uid}")
+        return res
 
     """
     Relogin to HSM vault since the generated token upon login expires
@@ -235,10 +422,16 @@ class Controller():
     def reLoginHsm(self):
         with orm.db_session:
             hsmData = self.__mysqlConx.readHSMSecret()
-        # recreate the hsmclient with the same login credentials
-        self.__hsmClient = hsmclient.HSMClient(self.getHSMHost(), hsmData.role_id,
-                                               hsmData.secret_id)
-        return self.__hsmClient.isAuthenticated
+        # login again with the same credentials, the hsmclient keeps its pooled connections
+        return self.__hsmClient.login(hsmData.role_id, hsmData.secret_id)
+
+    """
+    Returns the current hsm login credentials from the database as (role_id, secret_id), None if there are none
+    """
+    def __readHsmCredentials(self):
+        with orm.db_session:
+            hsmData = self.__mysqlConx.readHSMSecret()
+        return (hsmData.role_id, hsmData.secret_id) if hsmData else None
 
     """
     Generate new hsm secret id since it expires
@@ -247,7 +440,6 @@ class Controller():
         with orm.db_session:
             # get the current last line for the role id
             lastHsmLine = self.__mysqlConx.readHSMSecret()
-            self.checkHSMTokenValidity()
             # grep a new secret id from the hsm with still valid login credentials
             newHsmSecret = self.__hsmClient.hsm_get_new_secret()
             try:
@@ -260,9 +452,22 @@ class Controller():
             # save the new credentials to the database
             res = self.__mysqlConx.updateHsmSecret(newHsmEntry)
         logging.getLogger('mlaps').info(f"Tried renewing HSM secret with result: {res}")
-        # recreate the hsmclient with these login credentials
-        self.__hsmClient = hsmclient.HSMClient(self.getHSMHost(), newHsmEntry[0], newHsmEntry[1])
-        return self.__hsmClient.isAuthenticated
+        # login with these credentials, the hsmclient keeps its pooled connections
+        return self.__hsmClient.login(newHsmEntry[0], newHsmEntry[1])
+
+    """
+    Rolls the raw checkins older than the configured retention into daily per machine summaries and deletes them
+    A retention of 0 days keeps all raw checkins
+    Returns the number of rolled up checkins
+    """
+    def rollupCheckins(self) -> int:
+        retentionDays = self.__config.getint("CHECKIN", "retention-days", fallback=90)
+        if retentionDays <= 0:
+            return 0
+        before = datetime.datetime.utcnow() - datetime.timedelta(days=retentionDays)
+        res = self.__mysqlConx.rollupCheckins(before, self.__config.getint("CHECKIN", "rollup-batch-size", fallback=1000))
+        logging.getLogger('mlaps').info(f"Rolled up {res} checkins older than {before} into daily summaries")
+        return res
 
     """
     Get the requested password for a machine based on the mid from the database, decrypt it in the hsm and returns it in plaintext
@@ -295,24 +500,84 @@ class Controller():
     Returns the decrypted password as a string or an error 
     """
     def _decryptPassword(self, password : dbClient.dbClient.Password) -> str:
-        #check if a hsm request can be made
-        try:
-            self.checkHSMTokenValidity()
-        except ValueError as err:
-            logging.getLogger('mlaps').warning(str(err))
-            return "Decryption failed, HSM Token invalid"
         # try to decrypt the password in the hsm
         jsonResponse = self.__hsmClient.hsm_dec(password.password)
-        logging.getLogger('mlaps').debug(jsonResponse)
         # try to read the password from the hsm response
         try:
             clearText = jsonResponse['data']['plaintext']
             self.__mysqlConx.updatePasswordStatus(password)
             self.__mysqlConx.expirePasswordDelayed(password, hours=1)
+            self.__machineCache.invalidate(password.machine_id.id)
             return base64.b64decode(clearText).decode('UTF-8')
-        except KeyError:
+        except (KeyError, TypeError):
+            # hsm_dec returns False if no valid token could be obtained or the request failed
             return "Decryption failed in HSM"
 
+    """
+    Handle the batched decryption of the passwords, one hsm request and token use for all of them
+    Takes a list of the encrypted passwords as stored in the db
+    Returns a list with the decrypted password as a string or None if its decryption failed, for each password
+    """
+    def _decryptPasswords(self, ciphers: list) -> list:
+        jsonResponse = self.__hsmClient.hsm_dec_batch(ciphers)
+        try:
+            results = jsonResponse['data']['batch_results']
+        except (KeyError, TypeError):
+            return [None] * len(ciphers)
+        return [base64.b64decode(result['plaintext']).decode('UTF-8') if 'plaintext' in result else None
+                for result in results]
+
+    """
+    Decrypts the latest passwords of the given machines in batches of the configured hsm batch-size
+    and records every decrypted password in the audit log using the given name (logged in admin)
+    The passwords are read in one short db session and every batch is recorded in its own, no db session is held
+    while the hsm decrypts. A decrypted password is only exported if it was marked as seen and its access recorded
+    Returns the passwords as csv or None if an invalid machine id was supplied
+    """
+    def handleExportPasswords(self, admin_name: str, mids: list):
+        uids = self.__parseMids(mids)
+        if uids is None: return None
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(["Machine ID", "Hostname", "Serialnumber", "Password ID", "Password"])
+        batchSize = self.getHSMBatchSize()
+        passwords = self.__mysqlConx.getLatestSuccessfulPasswords(uids) or []
+        for start in range(0, len(passwords), batchSize):
+            batch = passwords[start:start + batchSize]
+            clearTexts = self._decryptPasswords([cipher for _, _, _, _, cipher in batch])
+            decrypted = [password for password, clearText in zip(batch, clearTexts) if clearText is not None]
+            recorded = self.__recordExport(admin_name, decrypted)
+            for (pwid, mid, hostname, serialnumber, _), clearText in zip(batch, clearTexts):
+                if clearText is None:
+                    clearText = "Decryption failed in HSM"
+                elif not recorded:
+                    clearText = "Failed to record the access"
+                # hostname and serialnumber are sent by the clients
+                writer.writerow([mid, self.__csvText(hostname), self.__csvText(serialnumber), pwid, clearText])
+        logging.getLogger('mlaps').info(f"{admin_name} exported {len(passwords)} passwords of {len(uids)} machines")
+        return out.getvalue()
+
+    # marks the given decrypted passwords as seen and records their access, in one short db session
+    def __recordExport(self, admin_name: str, passwords: list) -> bool:
+        if not passwords:
+            return True
+        with orm.db_session:
+            recorded = self.__mysqlConx.markPasswordsSeen([pwid for pwid, _, _, _, _ in passwords], hours=1) and \
+                all([self.__mysqlConx.createAccessEntry(admin_name, mid, pwid) for pwid, mid, _, _, _ in passwords])
+            if not recorded:
+                orm.rollback()
+                logging.getLogger('mlaps').error(f"Failed to record the export of {len(passwords)} passwords by {admin_name}")
+        if recorded:
+            self.__machineCache.invalidate(*{mid for _, mid, _, _, _ in passwords})
+        return recorded
+
+    """
+    Escapes a value for a csv cell, so a spreadsheet shows it as text instead of running it as formula
+    """
+    def __csvText(self, value) -> str:
+        value = "" if value is None else str(value)
+        return "'" + value if value.startswith(("=", "+", "-", "@", "\t", "\r")) else value
+
     """
     Trys to set the expiration data of the latest password from the given machine to the current time, therefore expiring it immediately
     Returns a string describing what step failed or a success message
@@ -330,6 +595,7 @@ class Controller():
             if pw:
                 res = self.__mysqlConx.expirePassword(pw)
                 if res:
+                    self.__machineCache.invalidate(pw.machine_id.id)
                     return f"Success: Password {returntext} is now marked as expired"
                 else:
                     return f"Error: Failed to mark Password {returntext} in db"
@@ -345,42 +611,61 @@ class Controller():
         with orm.db_session:
             res = self.__mysqlConx.disableMachine(mid)
             if res:
+                self.__machineCache.invalidate(mid)
                 return f"Machine {mid} was successfully disabled"
             else:
                 return f"Failed to disable machine {mid}"
 
     """
-    Returns the rendered machine table with the passed sorting column and direction, populated with all rows from the database
-    """
-    def handleGetMachineTable(self, sort_col='mid', direction=False):
-        return self.__tableBuilder.getMachineTable(sort_by=sort_col, sort_reverse=direction)
-
-    """
-    Returns the rendered machine table with the passed sorting column and direction, populated with all rows from the database
-    """
-    def handleGetAccessLogTable(self, sort_col='aid', direction=False):
-        return self.__tableBuilder.getAccessTable(sort_by=sort_col, sort_reverse=direction)
+    Returns the rendered page of the machine table with the passed sorting column, direction and filter, including the pagination
+    """
+    def handleGetMachineTable(self, sort_col='mid', direction=False, search='', page=1):
+        if self.getTableStreaming():
+            chunks = self.__tableBuilder.streamMachineTable(sort_by=sort_col, sort_reverse=direction, search=search,
+                                                            chunkSize=self.getStreamChunkSize())
+            return self.__streamResponse(flask.stream_template("machine_table.html", tableChunks=chunks,
+                                                               sort=sort_col, direction=direction, search=search))
+        table, pagination = self.__tableBuilder.getMachineTable(sort_by=sort_col, sort_reverse=direction, search=search,
+                                                                page=max(page, 1), pageSize=self.getPageSize())
+        return flask.render_template("machine_table.html", table=table, pagination=pagination, sort=sort_col,
+                                     direction=direction, search=search)
+
+    """
+    Returns the rendered page of the access log table with the passed sorting column, direction and filters, including the pagination
+    """
+    def handleGetAccessLogTable(self, sort_col='aid', direction=False, search='', dateFrom='', dateTo='', page=1):
+        if self.getTableStreaming():
+            chunks = self.__tableBuilder.streamAccessTable(sort_by=sort_col, sort_reverse=direction, search=search,
+                                                           dateFrom=self.__parseDate(dateFrom),
+                                                           dateTo=self.__parseDate(dateTo),
+                                                           chunkSize=self.getStreamChunkSize())
+            return self.__streamResponse(flask.stream_template("accesslog_table.html", tableChunks=chunks,
+                                                               sort=sort_col, direction=direction, search=search,
+                                                               dateFrom=dateFrom, dateTo=dateTo))
+        table, pagination = self.__tableBuilder.getAccessTable(sort_by=sort_col, sort_reverse=direction, search=search,
+                                                               dateFrom=self.__parseDate(dateFrom),
+                                                               dateTo=self.__parseDate(dateTo), page=max(page, 1),
+                                                               pageSize=self.getPageSize())
+        return flask.render_template("accesslog_table.html", table=table, pagination=pagination, sort=sort_col,
+                                     direction=direction, search=search, dateFrom=dateFrom, dateTo=dateTo)
+
+    """
+    Wraps a streamed template into a response, which tells nginx to pass the chunks on instead of buffering them
+    """
+    def __streamResponse(self, stream) -> Response:
+        resp = Response(stream, mimetype='text/html')
+        resp.headers['X-Accel-Buffering'] = 'no'
+        return resp
 
     """
-    Needs to be called before or after making a request to the HSM, since one token can only be used n times.
-    Returns None if the token is still valid or the token has been successfully renewed.
-    Raises an Exception if the token renewal failed
+    Parses an iso formatted date (YYYY-MM-DD) from a request argument, returns None if it is empty or invalid
     """
-    def checkHSMTokenValidity(self, uses=1):
-        if uses <= 0:
-            logging.getLogger('mlaps').warning(f"Illegal use of method (uses = {uses}), aborting")
-            return
-        # keep one use reserved for +-1 mistake and renewal
-        if self.__hsmClient.uses >= self.hsmTokenMaxUses - uses:
-            res = self.reLoginHsm()
-            if res:
-                logging.getLogger('mlaps').debug("HSM Token has been renewed with the last permitted request")
-                return
-            else:
-                raise ValueError("HSM Token is over its permitted uses and failed to renew")
-        else:
-            logging.getLogger('mlaps').debug(f"HSM Token is still valid, current uses: {self.__hsmClient.uses}")
-            return
+    def __parseDate(self, date: str):
+        try:
+            return datetime.date.fromisoformat(date) if date else None
+        except ValueError:
+            logging.getLogger('mlaps').warning(f"Ignoring invalid date filter {date}")
+            return None
 
     # https://www.hacksplaining.com/prevention/weak-session
     """
@@ -408,36 +693,30 @@ class Controller():
 
     """
     Associate a pw from a machine to a random string and also save at which time this association was requested
-    Return the random string
+    Return the random string or None if the share link couldn't be stored
     """
     def handleCreateShareLink(self, mid, pw, admin_name) -> str:
         tempStr: str = self.get_random_string(32)
-        curTime: datetime.datetime = datetime.datetime.now(datetime.timezone.utc)
 
+        #create entry for valid share link, it expires after share-link-ttl seconds, the pw is only kept hashed
+        # a link which wasn't stored would only answer "Share link expired"
+        if not self.__sessions.set('sharelink', tempStr, {'mid': mid, 'pw': self.__hashSharePassword(pw)}, self.__shareLinkTTL):
+            logging.getLogger('mlaps').error(f"Failed to store the share link of {mid}")
+            return None
         #create access log entry
         self.__mysqlConx.createAccessEntry(admin_name, mid, self.__mysqlConx.getLatestSuccessfulPassword(uuid.UUID(mid)).id)
-        #create entry for valid share link
-        self.__shareLinks.update({tempStr: {'creationTime': curTime, 'mid': mid, 'pw': pw}})
         return tempStr
 
     """
-    Check if an entry with key=randomStr exists in the shareLinks dict, if not it returns False
-    Then it returns True if the creationTime of the entry difference is under 15 minutes compared to current time otherwise it returns False
+    Returns True if a share link with key=randomStr exists and hasn't expired yet, otherwise it returns False
     """
     def checkSharePasswordStr(self, randomStr) -> bool:
-        logging.getLogger('mlaps').debug(self.__shareLinks)
         logging.getLogger('mlaps').debug(randomStr)
-        if randomStr in self.__shareLinks:
-            entry: dict = self.__shareLinks[randomStr]
-            curTime: datetime.datetime = datetime.datetime.now(datetime.timezone.utc)
-            if (entry['creationTime'] + datetime.timedelta(minutes=15)) > curTime:
-                logging.getLogger('mlaps').info("Found valid share link")
-                return True
-            logging.getLogger('mlaps').warning("Found expired share link")
-            return False
-        else:
-            logging.getLogger('mlaps').warning("No valid share link found")
-            return False
+        if randomStr and self.__sessions.get('sharelink', randomStr) is not None:
+            logging.getLogger('mlaps').info("Found valid share link")
+            return True
+        logging.getLogger('mlaps').warning("No valid share link found")
+        return False
 
     """
     Checks if the provided password is correct (how ever thats gonna work) 
@@ -445,45 +724,99 @@ class Controller():
     otherwise an error is returned
     """
     def handleSharePassword(self, rid: str, pw: str) -> str:
-        entry: dict = self.__shareLinks[rid]
-        if pw != entry['pw']:
+        entry: dict = self.__sessions.get('sharelink', rid)
+        if entry is None:
+            logging.getLogger('mlaps').warning("Share link expired before the password was sent " + rid)
+            return "Share link expired"
+        if not hmac.compare_digest(self.__hashSharePassword(pw), entry['pw']):
             logging.getLogger('mlaps').info("Wrong password was send for share password request" + rid)
             return "Wrong Password"
         with orm.db_session:
             password: dbClient.dbClient.Password = self.__mysqlConx.getLatestSuccessfulPassword(uuid.UUID(entry['mid']))
             return self._decryptPassword(password=password)
 
+    def __hashSharePassword(self, pw: str) -> str:
+        return hashlib.sha256(pw.encode("utf-8")).hexdigest()
+
     """
     Get all non disabled non enrolled machines from the db and disable them
     Returns a string describing who many machines have been disabled
     """
-    def handleDisableUnenrolledMachines(self) -> str:
-        with orm.db_session:
-            machines = self.__mysqlConx.getNonDisabledNonEnrolledMachines()
-            c = machines.count()
-            logging.getLogger('mlaps').debug(f"Found {c} non disabled non enrolled machines, going to disable")
-            for machine in machines:
-                machine.disabled = True
-            orm.commit()
-            return f"{c} machines have been successfully disabled"
+    def handleDisableUnenrolledMachines(self, minAgeDays: int = 0) -> str:
+        c = self.__mysqlConx.disableUnenrolledMachines(datetime.timedelta(days=minAgeDays))
+        if c is False:
+            return "Error: Failed to disable the not enrolled machines"
+        # the disabled machines aren't known, the other workers see them disabled after the cache ttl
+        self.__machineCache.clear()
+        logging.getLogger('mlaps').info(f"Disabled {c} non enrolled machines older than {minAgeDays} days")
+        return f"{c} machines have been successfully disabled"
 
     """
-    
+    Disables all machines of the given list of machine ids
+    Returns a string describing the result
+    """
+    def handleBulkDisableMachines(self, mids: list) -> str:
+        uids = self.__parseMids(mids)
+        if uids is None: return "Error: Invalid machine id supplied"
+        c = self.__mysqlConx.disableMachines(uids)
+        if c is False:
+            return f"Error: Failed to disable {len(uids)} machines"
+        self.__machineCache.invalidate(*uids)
+        return f"{c} machines have been successfully disabled"
+
+    """
+    Expires the passwords of all machines of the given list of machine ids
+    Returns a string describing the result
+    """
+    def handleBulkExpirePasswords(self, mids: list) -> str:
+        uids = self.__parseMids(mids)
+        if uids is None: return "Error: Invalid machine id supplied"
+        c = self.__mysqlConx.expireMachinesPasswords(uids)
+        if c is False:
+            return f"Error: Failed to expire the passwords of {len(uids)} machines"
+        self.__machineCache.invalidate(*uids)
+        return f"{c} passwords of {len(uids)} machines are now marked as expired"
+
+    """
+    Parses the given machine id strings, returns None if one of them isn't a valid uuid
+    """
+    def __parseMids(self, mids: list):
+        try:
+            return list(dict.fromkeys(uuid.UUID(mid) for mid in mids))
+        except ValueError:
+            return None
+
+    """
+    Renders the detail page of the machine with the given id, its tables are served from the machine cache
+    until the machine is written to
     """
     def handleDetailedMachine(self, mid: str):
         uMid = uuid.UUID(mid)
+        fragments = self.__machineCache.get(uMid, lambda: self.__buildMachineFragments(uMid))
+        return flask.render_template("machine.html", **fragments)
+
+    """
+    Builds the rendered tables of the machine detail page for the machine cache
+    Returns them and the seconds until the next valid password expires, since that changes its status on its own
+    """
+    def __buildMachineFragments(self, uMid: uuid.UUID) -> tuple:
         with orm.db_session:
             pwTable = self.__tableBuilder.getShortPasswordTable(uMid)
             dupTable = self.__tableBuilder.getPosDuplicatesTable(uMid)
-            checkTable = self.__tableBuilder.getCheckinTable(uMid)
+            checkTable = self.__tableBuilder.getCheckinTable(uMid, self.__config.getint("CHECKIN", "detail-limit", fallback=100))
             machine = self.__mysqlConx.readMachine(uMid)
             infoTable = self.__tableBuilder.getGeneralInfoTable({'UUID:': machine.id, 'Serialnumber:': machine.serialnumber,
                                                                  'Enrollment Timestamp': machine.enroll_time,
                                                                  'Enrollment Success': machine.enroll_success,
                                                                  'Is Disabled': machine.disabled})
-
-        return flask.render_template("machine.html", generalInfo=infoTable, hostName=machine.hostname,
-                                    posDuplicates=dupTable, passwords=pwTable, checkins=checkTable)
+            # rendered while the session is open, the cached html must not load anything lazily later
+            fragments = {'generalInfo': Markup(infoTable.__html__()), 'hostName': machine.hostname,
+                         'posDuplicates': Markup(dupTable.__html__()), 'passwords': Markup(pwTable.__html__()),
+                         'checkins': Markup(checkTable.__html__())}
+        timeNow = datetime.datetime.utcnow()
+        expiries = [item.expiredTime for item in pwTable.items
+                    if item.status != 'Expired' and item.expiredTime and item.expiredTime > timeNow]
+        return fragments, (min(expiries) - timeNow).total_seconds() if expiries else None
 
     """
     
@@ -491,8 +824,58 @@ class Controller():
     @orm.db_session
     def handleAdmin(self):
         db = self.__mysqlConx.dbClient.exists("SELECT * FROM auth_secret")
-        self.checkHSMTokenValidity(uses=2)
         vaultResult = self.__hsmClient.checkConnection()
-        log = self.logger.tail.contents()
-        return "Ok" if db else "Failed to fetch ", "Ok" if vaultResult is True else vaultResult, log
+        return "Ok" if db else "Failed to fetch ", "Ok" if vaultResult is True else vaultResult, \
+            self.__sessions.stats(), self.profiler.slowRequests(), self.__machineCache.stats()
+
+    """
+    Renders a page of the log tail of this process matching the filters, the newest records first
+    Without a cursor the whole table is rendered, with before the next older page of rows and with after only the rows
+    logged since then, which the admin page polls for. A poll finding more than a page of new rows also gets the
+    cursor to load the rest of them
+    Every worker process keeps its own tail, a cursor of another worker (by pid) restarts the tail of this worker
+    """
+    def handleLogTail(self, level='', search='', since='', before: int = None, after: int = None, pid: int = None):
+        if (before is not None or after is not None) and pid != os.getpid():
+            # the seq numbers of another worker's tail don't match this one's, replace the whole table
+            resp = flask.make_response(self.handleLogTail(level, search, since))
+            resp.headers['HX-Retarget'] = '#log-div'
+            resp.headers['HX-Reswap'] = 'innerHTML'
+            return resp
+        levelNo = logging.getLevelName(level.upper()) if level else 0
+        if not isinstance(levelNo, int):
+            levelNo = 0
+        try:
+            sinceTime = datetime.datetime.fromisoformat(since) if since else None
+        except ValueError:
+            logging.getLogger('mlaps').warning("Ignoring invalid time filter %s", since)
+            sinceTime = None
+        # records logged meanwhile are left to the next poll
+        latest = self.logger.tail.latest
+        entries, older = self.logger.tail.query(level=levelNo, search=search, since=sinceTime,
+                                                before=before if before is not None else latest + 1,
+                                                after=after or 0, limit=self.getPageSize())
+        template = "admin_log.html" if before is None and after is None else "admin_log_rows.html"
+        # the older rows of a poll only reach down to the rows shown before the poll
+        return flask.render_template(template, entries=entries, older=older, after=after,
+                                     latest=latest if before is None else None, pid=os.getpid(),
+                                     args={'level': level, 'search': search, 'since': since})
+
+    """
+    Marks the passwords of the non disabled machines which passed their expiry as expired, called by the scheduler
+    Returns the number of marked passwords
+    """
+    def expireOverduePasswords(self) -> int:
+        expired = self.__mysqlConx.expireOverduePasswords()
+        logging.getLogger('mlaps').debug("Marked %d overdue passwords as expired", expired)
+        return expired
+
+    """
+    Removes the expired update sessions and share links from the session store, called by the scheduler
+    Returns the number of removed entries
+    """
+    def sweepSessions(self) -> int:
+        swept = self.__sessions.sweep()
+        logging.getLogger('mlaps').debug("Swept %d expired session entries", swept)
+        return swept
 
@@ -0,0 +1,69 @@
+import datetime, logging, threading, uuid
+
+import dbClient
+
+
+class CheckinBuffer():
+    """
+    Write-behind buffer for checkins, keeps the checkin request path free of inserts
+    Checkins are collected in memory and written as one multi-row insert, either when maxSize checkins are buffered
+    or when flush is called by the interval job of the scheduler (and on shutdown)
+    onFlush is called with the ids of the machines whose checkins have been written
+    """
+    # the buffer keeps at most this many times maxSize checkins, if the database can't be reached
+    retainFactor = 10
+
+    def __init__(self, mysql_conx: dbClient.dbClient, maxSize: int, scheduler=None, onFlush=None):
+        self.__mysql = mysql_conx
+        self.maxSize = maxSize
+        self.__scheduler = scheduler
+        self.__onFlush = onFlush
+        self.__checkins = []
+        self.__lock = threading.Lock()
+        # serializes flushes, so a size triggered flush and the interval job don't write the same time
+        self.__flushLock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__checkins)
+
+    """
+    Buffers a checkin of the machine with the given id at the given time (defaults to now)
+    If the buffer is full, a flush is handed to the scheduler instead of being executed in the calling thread
+    """
+    def add(self, uid: uuid.UUID, checkinTime: datetime.datetime = None):
+        with self.__lock:
+            self.__checkins.append((uid, checkinTime or datetime.datetime.utcnow()))
+            full = len(self.__checkins) >= self.maxSize
+        if full:
+            if self.__scheduler is not None:
+                # a fixed id ensures only one pending flush job exists at a time
+                self.__scheduler.add_job(func=self.flush, id='checkin-buffer-flush', replace_existing=True)
+            else:
+                self.flush()
+
+    """
+    Writes all buffered checkins to the database
+    If the insert fails, the checkins are put back into the buffer to be retried with the next flush, the checkins
+    of removed machines are dropped by the insert instead
+    Returns the number of written checkins
+    """
+    def flush(self) -> int:
+        with self.__flushLock:
+            with self.__lock:
+                checkins, self.__checkins = self.__checkins, []
+            if not checkins:
+                return 0
+            written = self.__mysql.createCheckins(checkins)
+            if written is not None:
+                logging.getLogger('mlaps').debug("Flushed %d buffered checkins", len(written))
+                if self.__onFlush is not None and written:
+                    self.__onFlush({uid for uid, _ in written})
+                return len(written)
+            with self.__lock:
+                self.__checkins[:0] = checkins
+                dropped = len(self.__checkins) - self.maxSize * self.retainFactor
+                if dropped > 0:
+                    del self.__checkins[:dropped]
+                    logging.getLogger('mlaps').warning(f"Checkin buffer is over its limit, dropped the {dropped} oldest checkins")
+            logging.getLogger('mlaps').warning(f"Failed to flush {len(checkins)} buffered checkins, retrying with the next flush")
+            return 0
@@ -1,32 +1,46 @@
 import datetime, uuid
+import contextlib
 import logging
 import pprint
 
 from pony import orm
 from pony.orm import desc
 
+import dbPool, metrics
 
+
+# records the duration and the number of statements of every public method, see metrics.instrumentDB
+@metrics.instrumentDB
 class dbClient:
     dbClient = orm.Database()
 
-    def __init__(self, username, password, host, database, isdev):
+    """
+    Binds pony to the mysql database, see dbPool.PooledMySQLProvider for the pool settings
+    Every statement is only logged in devmode, otherwise a sqlSampleRate share of them is logged to the mlaps log
+    If replicaHost is given, the dashboard queries are read from it, see readSession
+    """
+    def __init__(self, username, password, host, database, isdev, poolSize=10, poolRecycle=3600, connectTimeout=10,
+                 readTimeout=30, sqlSampleRate=0.0, replicaHost=None):
         self.devmode = isdev
         self.dbClient.bind(
-            provider="mysql", host=host, user=username, passwd=password, db=database
+            provider=dbPool.PooledMySQLProvider, host=host, user=username, passwd=password, db=database,
+            connect_timeout=connectTimeout, read_timeout=readTimeout, write_timeout=readTimeout,
+            pool_size=poolSize, pool_recycle=poolRecycle, sql_sample_rate=sqlSampleRate, replica_host=replicaHost
         )
-        orm.set_sql_debug(True)
+        orm.set_sql_debug(isdev)
         self.dbClient.generate_mapping(create_tables=True)
 
     class Machine(dbClient.Entity):
         id = orm.PrimaryKey(uuid.UUID)
-        hostname = orm.Required(str)
-        serialnumber = orm.Required(str)
+        hostname = orm.Required(str, index=True)
+        serialnumber = orm.Required(str, index=True)
         enroll_time = orm.Required(datetime.datetime, precision=6)
         enroll_success = orm.Required(bool, default=False)
         disabled = orm.Required(bool, default=False)
         passwords = orm.Set("Password")
         access_log = orm.Set("AccessLog")
         check_in = orm.Set("Checkin")
+        checkin_summary = orm.Set("CheckinSummary")
 
     class Password(dbClient.Entity):
         id = orm.PrimaryKey(uuid.UUID)
@@ -37,11 +51,15 @@ class dbClient:
         password_received = orm.Required(datetime.datetime, precision=6)
         password_expiry = orm.Required(datetime.datetime, precision=6)
         access_log = orm.Set("AccessLog")
+        # latest (successfully set) password of a machine, see getLatestSuccessfulPassword and checkinMachine
+        orm.composite_index(machine_id, password_set, password_received)
+        # password with the latest expiry of a machine, see getLatestPasswordStatuses
+        orm.composite_index(machine_id, password_expiry)
 
     class AccessLog(dbClient.Entity):
         id = orm.PrimaryKey(int, auto=True, size=64)
         admin_kurzel = orm.Required(str)
-        getTime = orm.Required(datetime.datetime, precision=6)
+        getTime = orm.Required(datetime.datetime, precision=6, index=True)
         machine_id = orm.Required("Machine")
         password_id = orm.Required("Password")
 
@@ -54,7 +72,27 @@ class dbClient:
         id = orm.PrimaryKey(int, auto=True, size=64)
         uuid = orm.Required(uuid.UUID)
         mid = orm.Required("Machine")
-        checkin_time = orm.Required(datetime.datetime, precision=6)
+        # the single column index is used by the checkin rollup
+        checkin_time = orm.Required(datetime.datetime, precision=6, index=True)
+        # checkins of a machine ordered by time, see getMachinesCheckins
+        orm.composite_index(mid, checkin_time)
+
+    class CheckinSummary(dbClient.Entity):
+        id = orm.PrimaryKey(int, auto=True, size=64)
+        mid = orm.Required("Machine")
+        day = orm.Required(datetime.date)
+        checkins = orm.Required(int)
+        first_checkin = orm.Required(datetime.datetime, precision=6)
+        last_checkin = orm.Required(datetime.datetime, precision=6)
+        orm.composite_key(mid, day)
+
+    # short-lived state shared by all server processes, see sessionStore.DBSessionStore
+    class Session(dbClient.Entity):
+        namespace = orm.Required(str)
+        name = orm.Required(str)
+        value = orm.Required(orm.LongStr)
+        expires = orm.Required(datetime.datetime, precision=6, index=True)
+        orm.PrimaryKey(namespace, name)
 
     ##### Vault Methods #####
 
@@ -73,6 +111,18 @@ class dbClient:
 
     ##### Read Methods #####
 
+    """
+    db_session for the read only dashboard queries, run against the read replica if one is configured
+    Inside an already running db_session it is a plain nested db_session, so it never moves writes to the replica
+    """
+    @contextlib.contextmanager
+    def readSession(self):
+        readReplica = getattr(self.dbClient.provider, 'readReplica', None)
+        if readReplica is None or orm.core.local.db_session is not None:
+            readReplica = contextlib.nullcontext
+        with readReplica(), orm.db_session:
+            yield
+
     @orm.db_session
     def readMachine(self, uid):
         try:
@@ -104,27 +154,153 @@ class dbClient:
             logging.getLogger('mlaps').error(e)
             return None
 
+    """
+    Returns the latest successfully set password of every non disabled machine with one of the given ids
+    as (password id, machine id, hostname, serialnumber, encrypted password) tuples, so they outlive the db_session
+    Machines without such a password are left out
+    """
     @orm.db_session
+    def getLatestSuccessfulPasswords(self, mids: list):
+        try:
+            passwords = []
+            for start in range(0, len(mids), self.bulkSize):
+                chunk = mids[start:start + self.bulkSize]
+                passwords += orm.select(
+                    (p.id, p.machine_id.id, p.machine_id.hostname, p.machine_id.serialnumber, p.password)
+                    for p in self.Password
+                    if p.machine_id.id in chunk and p.password_set == True and p.machine_id.disabled == False
+                    and p.password_received == orm.max(q.password_received for q in self.Password
+                                                       if q.machine_id == p.machine_id and q.password_set == True)
+                ).without_distinct()[:]
+            return passwords
+        except Exception as e:
+            logging.getLogger('mlaps').error(e)
+            return None
+
+    # positions of the sortable machine table columns in the machine query projection
+    machineSortColumns = {'mid': 1, 'hostname': 2, 'serialnumber': 3, 'enroll_time': 4, 'enroll_success': 5}
+    # positions of the sortable access table columns in the access log query projection
+    accessSortColumns = {'aid': 1, 'admin_kurzel': 2, 'getTime': 3, 'mid': 4, 'pwid': 5, 'mhn': 6, 'msn': 7}
+    # attributes of the sortable columns, compared to the last streamed row by the keyset pagination
+    machineSortAttributes = {'mid': 'm.id', 'hostname': 'm.hostname', 'serialnumber': 'm.serialnumber',
+                             'enroll_time': 'm.enroll_time', 'enroll_success': 'm.enroll_success'}
+    accessSortAttributes = {'aid': 'a.id', 'admin_kurzel': 'a.admin_kurzel', 'getTime': 'a.getTime',
+                            'mid': 'a.machine_id.id', 'pwid': 'a.password_id.id', 'mhn': 'a.machine_id.hostname',
+                            'msn': 'a.machine_id.serialnumber'}
+    # number of ids bound to a single statement of a bulk operation
+    bulkSize = 500
+
+    """
+    Returns a list of dicts, one for every non disabled machine, with the status of its latest password
+    The whole list is built with a constant number of queries, independent of the fleet size
+    """
     def getMachineList(self):
         try:
-            allMachines = self.Machine.select().where(lambda m: m.disabled == False)
-            return self.__convertQueryToDict(allMachines)
+            with self.readSession():
+                machines = self.__machineQuery()[:]
+                return self.__machineRowsToDicts(machines, self.getLatestPasswordStatuses())
+        except Exception as e:
+            logging.getLogger('mlaps').error(e)
+            return False
+
+    """
+    Returns one page of the non disabled machines as a list of dicts and the total number of matching machines
+    Sorting, filtering by hostname/serialnumber and the page limits are all applied in the database
+    """
+    def getMachinePage(self, sort_by='mid', sort_reverse=False, search='', page=1, pageSize=50):
+        try:
+            with self.readSession():
+                query = self.__machineQuery(search)
+                return self.__machinePage(query, sort_by, sort_reverse, page, pageSize), query.count()
         except Exception as e:
             logging.getLogger('mlaps').error(e)
             return False
 
     """
-    Returns a list of dict, ig
+    Yields all non disabled machines matching the filter in the given order as lists of at most chunkSize dicts
+    Every chunk is fetched in its own short db_session, so no connection is held while the caller processes a chunk
+    The chunks continue after the sort value and id of the last row, so every machine is yielded at most once even if
+    machines are added or removed while streaming
+    """
+    def iterMachineChunks(self, sort_by='mid', sort_reverse=False, search='', chunkSize=500):
+        try:
+            sort_by = sort_by if sort_by in self.machineSortColumns else 'mid'
+            last = None
+            while True:
+                with self.readSession():
+                    query = self.__afterRow(self.__machineQuery(search), self.machineSortAttributes[sort_by], 'm.id',
+                                            sort_reverse, last)
+                    chunk = self.__machinePage(query, sort_by, sort_reverse, 1, chunkSize)
+                if chunk: yield chunk
+                if len(chunk) < chunkSize: return
+                last = self.__rowKey(chunk[-1], self.machineSortColumns[sort_by])
+        except Exception as e:
+            logging.getLogger('mlaps').error(e)
+
+    """
+    Returns a dict mapping the id of every non disabled machine to the status of its password with the latest expiry
+    A password which passed its expiry is Expired, even if expireOverduePasswords didn't mark it yet
+    If mids is given, only the statuses of these machines are returned
+    Machines without any password are not included
     """
     @orm.db_session
+    def getLatestPasswordStatuses(self, mids=None):
+        latest = orm.select((p.machine_id.id, p.status, p.password_expiry) for p in self.Password
+                            if p.machine_id.disabled == False
+                            and p.password_expiry == orm.max(q.password_expiry for q in self.Password
+                                                             if q.machine_id == p.machine_id)).without_distinct()
+        if mids is not None:
+            if not mids: return {}
+            latest = latest.where(lambda p: p.machine_id.id in mids)
+        timeNow = datetime.datetime.utcnow()
+        return {mid: 'Expired' if expiry <= timeNow else status for mid, status, expiry in latest}
+
+    """
+    Returns a list of dicts, one for every recorded password access, including the serialnumber and hostname of the machine
+    The rows are fetched as plain tuples of a single joined query, no entity gets loaded
+    """
     def getAccessLog(self):
         try:
-            allAccess = self.AccessLog.select()
-            return self.__convertQueryToDict(allAccess)
+            with self.readSession():
+                return self.__accessRowsToDicts(self.__accessLogQuery()[:])
+        except Exception as e:
+            logging.getLogger('mlaps').error(e)
+            return False
+
+    """
+    Returns one page of the access log as a list of dicts and the total number of matching entries
+    search is matched against the admin name, hostname and serialnumber, dateFrom and dateTo limit the access time
+    """
+    def getAccessLogPage(self, sort_by='aid', sort_reverse=False, search='', dateFrom=None, dateTo=None, page=1,
+                         pageSize=50):
+        try:
+            with self.readSession():
+                query = self.__accessLogQuery(search, dateFrom, dateTo)
+                return self.__accessLogPage(query, sort_by, sort_reverse, page, pageSize), query.count()
         except Exception as e:
             logging.getLogger('mlaps').error(e)
             return False
 
+    """
+    Yields the access log entries matching the filters in the given order as lists of at most chunkSize dicts
+    Every chunk is fetched in its own short db_session, so no connection is held while the caller processes a chunk
+    The chunks continue after the sort value and id of the last row, like iterMachineChunks
+    """
+    def iterAccessLogChunks(self, sort_by='aid', sort_reverse=False, search='', dateFrom=None, dateTo=None, chunkSize=500):
+        try:
+            sort_by = sort_by if sort_by in self.accessSortColumns else 'aid'
+            last = None
+            while True:
+                with self.readSession():
+                    query = self.__afterRow(self.__accessLogQuery(search, dateFrom, dateTo),
+                                            self.accessSortAttributes[sort_by], 'a.id', sort_reverse, last)
+                    chunk = self.__accessLogPage(query, sort_by, sort_reverse, 1, chunkSize)
+                if chunk: yield chunk
+                if len(chunk) < chunkSize: return
+                last = self.__rowKey(chunk[-1], self.accessSortColumns[sort_by])
+        except Exception as e:
+            logging.getLogger('mlaps').error(e)
+
     """
     """
     @orm.db_session
@@ -136,11 +312,13 @@ class dbClient:
             return False
 
     """
+    Returns the checkins of the given machine, newest first, at most limit checkins if a limit is given
     """
     @orm.db_session
-    def getMachinesCheckins(self, mid: uuid.UUID):
+    def getMachinesCheckins(self, mid: uuid.UUID, limit: int = None):
         try:
-            return self.Checkin.select(lambda c: c.mid.id == mid).order_by(lambda d: orm.desc(d.checkin_time))
+            checkins = self.Checkin.select(lambda c: c.mid.id == mid).order_by(lambda d: orm.desc(d.checkin_time))
+            return checkins.limit(limit) if limit else checkins
         except Exception as e:
             logging.getLogger('mlaps').error(e)
             return False
@@ -228,6 +406,31 @@ class dbClient:
         else:
             return False
 
+    """
+    Returns the value of the session entry with the given namespace and name or None if it is unknown or expired
+    """
+    @orm.db_session
+    def getSession(self, namespace: str, name: str):
+        try:
+            session = self.Session.get(namespace=namespace, name=name)
+            return session.value if session and session.expires > datetime.datetime.utcnow() else None
+        except Exception as e:
+            logging.getLogger('mlaps').error(e)
+            return None
+
+    """
+    Returns the number of live and of expired, not yet swept session entries as a tuple or None on error
+    """
+    @orm.db_session
+    def countSessions(self):
+        try:
+            now = datetime.datetime.utcnow()
+            live = orm.count(s for s in self.Session if s.expires > now)
+            return live, orm.count(s for s in self.Session) - live
+        except Exception as e:
+            logging.getLogger('mlaps').error(e)
+            return None
+
     ##### Update Methods #####
 
     @orm.db_session
@@ -254,6 +457,51 @@ class dbClient:
             logging.getLogger('mlaps').error(e)
             return False
 
+    """
+    Disables every non disabled machine which never enrolled successfully with a single UPDATE
+    If minAge is given, only machines whose enrollment started at least minAge ago are disabled
+    Returns the number of disabled machines or False on error
+    """
+    @orm.db_session
+    def disableUnenrolledMachines(self, minAge: datetime.timedelta = None):
+        try:
+            enrolledBefore = datetime.datetime.utcnow() - (minAge or datetime.timedelta(0))
+            cursor = self.dbClient.execute("UPDATE Machine SET disabled = 1 "
+                                           "WHERE disabled = 0 AND enroll_success = 0 AND enroll_time <= $enrolledBefore")
+            return cursor.rowcount
+        except Exception as e:
+            orm.rollback()
+            logging.getLogger('mlaps').error(e)
+            return False
+
+    """
+    Disables all machines with the given ids, one UPDATE per bulkSize ids
+    Returns the number of machines which have been disabled or False on error
+    """
+    @orm.db_session
+    def disableMachines(self, uids: list):
+        try:
+            return self.__bulkUpdate("UPDATE Machine SET disabled = 1 WHERE disabled = 0 AND id IN ({ids})", uids)
+        except Exception as e:
+            orm.rollback()
+            logging.getLogger('mlaps').error(e)
+            return False
+
+    """
+    Expires all not yet expired passwords of the machines with the given ids, one UPDATE per bulkSize ids
+    Returns the number of passwords which have been expired or False on error
+    """
+    @orm.db_session
+    def expireMachinesPasswords(self, uids: list):
+        try:
+            timeNow = datetime.datetime.utcnow()
+            return self.__bulkUpdate("UPDATE Password SET password_expiry = $timeNow "
+                                     "WHERE password_expiry > $timeNow AND machine_id IN ({ids})", uids, timeNow=timeNow)
+        except Exception as e:
+            orm.rollback()
+            logging.getLogger('mlaps').error(e)
+            return False
+
     @orm.db_session
     def checkPasswordStatus(self, pw):
         if pw.status == 'Expired': return
@@ -264,6 +512,19 @@ class dbClient:
         except Exception as e:
             logging.getLogger('mlaps').error(e)
 
+    """
+    Marks every password of the non disabled machines which passed its expiry, but isn't marked as expired yet, as
+    expired with a single UPDATE, run by the scheduler. The dashboard shows them as expired before already
+    Returns the number of passwords which have been marked
+    """
+    @orm.db_session
+    def expireOverduePasswords(self):
+        timeNow = datetime.datetime.utcnow()
+        cursor = self.dbClient.execute("UPDATE Password SET status = 'Expired' "
+                                       "WHERE status <> 'Expired' AND password_expiry <= $timeNow "
+                                       "AND machine_id IN (SELECT id FROM Machine WHERE disabled = 0)")
+        return cursor.rowcount
+
     @orm.db_session
     def updatePasswordStatus(self, pw):
         try:
@@ -272,6 +533,23 @@ class dbClient:
         except Exception as e:
             logging.getLogger('mlaps').error(e)
 
+    """
+    Marks the passwords with the given ids as seen and lets them expire in the given number of hours,
+    one UPDATE per bulkSize ids
+    Returns True if the passwords have been marked
+    """
+    @orm.db_session
+    def markPasswordsSeen(self, pwids: list, hours=1):
+        try:
+            expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=hours)
+            self.__bulkUpdate("UPDATE Password SET status = 'Seen', password_expiry = $expiry WHERE id IN ({ids})",
+                              pwids, expiry=expiry)
+            return True
+        except Exception as e:
+            orm.rollback()
+            logging.getLogger('mlaps').error(e)
+            return False
+
     @orm.db_session
     def updatePasswordSecStage(self, res : str, mid):
         pw = self.Password.select(lambda c: c.machine_id.id == mid and c.password_set == False).order_by(
@@ -309,6 +587,55 @@ class dbClient:
             logging.getLogger('mlaps').error(e)
             return False
 
+    """
+    Handles a checkin of the machine with the given id with a single read
+    The hostname and serialnumber are only written if they changed or the machine isn't marked as enrolled yet,
+    the checkin itself is not recorded here but buffered by the caller (see createCheckins)
+    Returns None if the machine is unknown or the checkin failed, otherwise whether the latest successfully set
+    password is still valid (same result as checkPasswordValidityString)
+    """
+    @orm.db_session
+    def checkinMachine(self, uid: uuid.UUID, serialnumber: str, hostname: str):
+        try:
+            state = orm.select((m.hostname, m.serialnumber, m.enroll_success, m.disabled,
+                                orm.max(p.password_expiry for p in m.passwords if p.password_set
+                                        and p.password_received == orm.max(r.password_received for r in m.passwords
+                                                                           if r.password_set)))
+                               for m in self.Machine if m.id == uid).without_distinct()[:]
+            if not state:
+                logging.getLogger('mlaps').warning(f"Checkin of unknown machine {uid}")
+                return None
+            oldHostname, oldSerialnumber, enrolled, disabled, passwordExpiry = state[0]
+            if (oldHostname, oldSerialnumber, enrolled) != (hostname, serialnumber, True):
+                mid = uid.bytes
+                enrollSuccess = True
+                self.dbClient.execute("UPDATE Machine SET hostname = $hostname, serialnumber = $serialnumber, "
+                                      "enroll_success = $enrollSuccess WHERE id = $mid")
+                orm.commit()
+            return not disabled and passwordExpiry is not None and passwordExpiry > datetime.datetime.utcnow()
+        except Exception as e:
+            logging.getLogger('mlaps').error(e)
+            return None
+
+    """
+    Creates or replaces the session entry with the given namespace and name, expiring in ttl seconds
+    """
+    @orm.db_session
+    def setSession(self, namespace: str, name: str, value: str, ttl: float):
+        try:
+            expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+            session = self.Session.get_for_update(namespace=namespace, name=name)
+            if session:
+                session.value = value
+                session.expires = expires
+            else:
+                self.Session(namespace=namespace, name=name, value=value, expires=expires)
+            orm.commit()
+            return True
+        except Exception as e:
+            logging.getLogger('mlaps').error(e)
+            return False
+
     ##### Create Methods #####
 
     @orm.db_session
@@ -324,6 +651,43 @@ class dbClient:
             logging.getLogger('mlaps').error(e)
             return False
 
+    """
+    Inserts the given checkins, a list of (machine id, checkin time) tuples, with a single multi-row insert
+    Checkins of machines which don't exist (anymore) are skipped, so they don't fail the insert of all the others
+    Returns the list of the saved checkins or None if the insert failed
+    """
+    @orm.db_session
+    def createCheckins(self, checkins: list):
+        try:
+            mids = list({uid for uid, _ in checkins})
+            existing = set()
+            for start in range(0, len(mids), self.bulkSize):
+                chunk = mids[start:start + self.bulkSize]
+                existing.update(orm.select(m.id for m in self.Machine if m.id in chunk))
+            if len(existing) < len(mids):
+                skipped = [uid for uid, _ in checkins if uid not in existing]
+                logging.getLogger('mlaps').warning("Skipped %d checkins of %d removed machines",
+                                                   len(skipped), len(mids) - len(existing))
+                checkins = [checkin for checkin in checkins if checkin[0] in existing]
+            if not checkins:
+                return checkins
+            uuidConverter = self.Checkin.uuid.converters[0]
+            midConverter = self.Checkin.mid.converters[0]
+            timeConverter = self.Checkin.checkin_time.converters[0]
+            rows = [(uuidConverter.py2sql(uid), midConverter.py2sql(uid), timeConverter.py2sql(checkinTime))
+                    for uid, checkinTime in checkins]
+            placeholder = '?' if self.dbClient.provider.paramstyle == 'qmark' else '%s'
+            cursor = self.dbClient.get_connection().cursor()
+            # the mysql driver rewrites executemany of a plain INSERT ... VALUES into one multi-row insert
+            cursor.executemany(f"INSERT INTO Checkin (uuid, mid, checkin_time) "
+                               f"VALUES ({placeholder}, {placeholder}, {placeholder})", rows)
+            orm.commit()
+            return checkins
+        except Exception as e:
+            logging.getLogger('mlaps').error(e)
+            orm.rollback()
+            return None
+
     @orm.db_session
     def createPassword(self, machine_id, password):
         timeNow = datetime.datetime.utcnow()
@@ -383,6 +747,53 @@ class dbClient:
 
     #### Delete Methods ####
 
+    """
+    Rolls all raw checkins older than before up into the daily per machine checkin summaries and deletes them
+    The checkins are processed in batches of batchSize, each in its own transaction
+    Returns the number of rolled up checkins
+    """
+    def rollupCheckins(self, before: datetime.datetime, batchSize: int = 1000) -> int:
+        total = 0
+        while True:
+            rolled = self.__rollupCheckinBatch(before, batchSize)
+            total += rolled
+            if rolled < batchSize:
+                return total
+
+    @orm.db_session
+    def __rollupCheckinBatch(self, before: datetime.datetime, batchSize: int) -> int:
+        try:
+            batch = orm.select((c.id, c.mid.id, c.checkin_time) for c in self.Checkin
+                               if c.checkin_time < before).without_distinct().order_by(1).limit(batchSize)[:]
+            if not batch:
+                return 0
+            days = {}
+            for cid, mid, checkinTime in batch:
+                count, first, last = days.get((mid, checkinTime.date()), (0, checkinTime, checkinTime))
+                days[(mid, checkinTime.date())] = (count + 1, min(first, checkinTime), max(last, checkinTime))
+            # load the already existing summaries of the affected machines and days with one query
+            mids = list({mid for mid, day in days})
+            firstDay, lastDay = min(day for mid, day in days), max(day for mid, day in days)
+            summaries = {(s.mid.id, s.day): s for s in self.CheckinSummary.select(
+                lambda s: s.mid.id in mids and s.day >= firstDay and s.day <= lastDay)}
+            for (mid, day), (count, first, last) in days.items():
+                summary = summaries.get((mid, day))
+                if summary:
+                    summary.checkins += count
+                    summary.first_checkin = min(summary.first_checkin, first)
+                    summary.last_checkin = max(summary.last_checkin, last)
+                else:
+                    self.CheckinSummary(mid=mid, day=day, checkins=count, first_checkin=first, last_checkin=last)
+            # the batch consists of exactly the old checkins up to its highest id
+            maxId = batch[-1][0]
+            self.Checkin.select(lambda c: c.checkin_time < before and c.id <= maxId).delete(bulk=True)
+            orm.commit()
+            return len(batch)
+        except Exception as e:
+            logging.getLogger('mlaps').error(e)
+            orm.rollback()
+            return 0
+
     @orm.db_session
     def removeMachine(self, uid):
         try:
@@ -399,42 +810,116 @@ class dbClient:
             return False
 
 
+    """
+    Deletes the session entry with the given namespace and name and returns its value, None if it is unknown or expired
+    """
+    @orm.db_session
+    def popSession(self, namespace: str, name: str):
+        try:
+            session = self.Session.get_for_update(namespace=namespace, name=name)
+            if not session:
+                return None
+            value = session.value if session.expires > datetime.datetime.utcnow() else None
+            session.delete()
+            orm.commit()
+            return value
+        except Exception as e:
+            logging.getLogger('mlaps').error(e)
+            return None
+
+    """
+    Deletes all expired session entries with a single DELETE and, for every namespace with more than maxSize entries
+    left, also its entries expiring the soonest
+    Returns the number of deleted entries as a tuple (expired, evicted) or False on error
+    """
+    @orm.db_session
+    def sweepSessions(self, maxSize: int = None):
+        try:
+            now = datetime.datetime.utcnow()
+            expired = self.dbClient.execute("DELETE FROM Session WHERE expires <= $now").rowcount
+            evicted = 0
+            if maxSize is not None:
+                for namespace, size in orm.select((s.namespace, orm.count(s)) for s in self.Session)[:]:
+                    over = size - maxSize
+                    if over > 0:
+                        for session in orm.select(s for s in self.Session if s.namespace == namespace)\
+                                .order_by(self.Session.expires)[:over]:
+                            session.delete()
+                        evicted += over
+            orm.commit()
+            return expired, evicted
+        except Exception as e:
+            orm.rollback()
+            logging.getLogger('mlaps').error(e)
+            return False
+
     #### Helper Methods ####
-    def __convertQueryToDict(self, query):
-        allDict = list()
-        for entry in query:
-            if isinstance(entry, self.AccessLog):
-                newEntry = entry.to_dict()
-                with orm.db_session:
-                    machine: dbClient.Machine = self.readMachine(newEntry['machine_id'])
-                    newEntry.update({'machine_serialnumber': machine.serialnumber,
-                                     'machine_hostname': machine.hostname})
-                repl = {"id": "aid"}
-                allDict.append({repl.get(k, k): newEntry[k] for k in newEntry})
-            elif isinstance(entry, self.Machine):
-                # pw cam be ether a string that contains 'Unknown' or a password object
-                if list(entry.passwords):
-                    pw = entry.passwords.order_by(desc(self.Password.password_expiry)).first()
-                else:
-                    pw = 'Unknown'
-
-                newEntry = entry.to_dict()
-                repl = {"id": "mid"}
-                res = {
-                    repl.get(key, key): newEntry[key]
-                    for key in newEntry if key not in ["passwords", "access_log", "check_in"]
-                }
-
-                if list(entry.passwords):
-                    self.checkPasswordStatus(pw)
-                    res.update({'password_status': pw.status})
-                else:
-                    res.update({'password_status': pw})
 
-                allDict.append(res)
-            else:
-                allDict.append(entry.to_dict())
-        return allDict
+    # runs the sql once for every bulkSize ids, {ids} is replaced by their parameters, returns the number of changed rows
+    def __bulkUpdate(self, sql, uids, **params):
+        uids = list(dict.fromkeys(uids))
+        changed = 0
+        for start in range(0, len(uids), self.bulkSize):
+            ids = {f"id{i}": uid.bytes for i, uid in enumerate(uids[start:start + self.bulkSize])}
+            cursor = self.dbClient.execute(sql.format(ids=", ".join(f"${name}" for name in ids)), dict(params, **ids))
+            changed += cursor.rowcount
+        return changed
+
+    def __machineQuery(self, search=''):
+        query = orm.select((m.id, m.hostname, m.serialnumber, m.enroll_time, m.enroll_success, m.disabled)
+                           for m in self.Machine if m.disabled == False).without_distinct()
+        if search:
+            query = query.where(lambda m: search in m.hostname or search in m.serialnumber)
+        return query
+
+    def __machinePage(self, query, sort_by, sort_reverse, page, pageSize):
+        column = self.machineSortColumns.get(sort_by, 1)
+        machines = query.order_by(-column if sort_reverse else column, 1).page(page, pageSize)
+        statuses = self.getLatestPasswordStatuses([machine[0] for machine in machines])
+        return self.__machineRowsToDicts(machines, statuses)
+
+    def __machineRowsToDicts(self, machines, statuses):
+        return [{'mid': mid, 'hostname': hostname, 'serialnumber': serialnumber, 'enroll_time': enroll_time,
+                 'enroll_success': enroll_success, 'disabled': disabled, 'password_status': statuses.get(mid, 'Unknown')}
+                for mid, hostname, serialnumber, enroll_time, enroll_success, disabled in machines]
+
+    def __accessLogQuery(self, search='', dateFrom=None, dateTo=None):
+        query = orm.select((a.id, a.admin_kurzel, a.getTime, a.machine_id.id, a.password_id.id,
+                            a.machine_id.hostname, a.machine_id.serialnumber)
+                           for a in self.AccessLog).without_distinct()
+        if search:
+            query = query.where(lambda a: search in a.admin_kurzel or search in a.machine_id.hostname
+                                          or search in a.machine_id.serialnumber)
+        if dateFrom:
+            query = query.where(lambda a: a.getTime >= dateFrom)
+        if dateTo:
+            query = query.where(lambda a: a.getTime < dateTo)
+        return query
+
+    def __accessLogPage(self, query, sort_by, sort_reverse, page, pageSize):
+        column = self.accessSortColumns.get(sort_by, 1)
+        return self.__accessRowsToDicts(query.order_by(-column if sort_reverse else column, 1).page(page, pageSize))
+
+    """
+    Restricts the query to the rows sorted after the given (sort value, id) of the last row, for the keyset pagination
+    The rows are sorted by the attribute in the given direction and then by the ascending id, see __machinePage
+    """
+    def __afterRow(self, query, attribute, idAttribute, sort_reverse, last):
+        if last is None:
+            return query
+        lastValue, lastId = last
+        return query.where(f"{attribute} {'<' if sort_reverse else '>'} lastValue "
+                           f"or {attribute} == lastValue and {idAttribute} > lastId")
+
+    # returns the (sort value, id) of the given row dict, its values are in the order of the query projection
+    def __rowKey(self, row, column):
+        values = list(row.values())
+        return values[column - 1], values[0]
+
+    def __accessRowsToDicts(self, allAccess):
+        return [{'aid': aid, 'admin_kurzel': admin_kurzel, 'getTime': getTime, 'machine_id': machine_id,
+                 'password_id': password_id, 'machine_hostname': hostname, 'machine_serialnumber': serialnumber}
+                for aid, admin_kurzel, getTime, machine_id, password_id, hostname, serialnumber in allAccess]
 
     @orm.db_session
     def maintainLastFiveSuccessfulPasswords(self, mid):
@@ -444,7 +929,7 @@ class dbClient:
                 lambda c: orm.desc(c.password_received)
             )
             if len(pws) <= n:
-                logging.getLogger('mlaps').info(f"Machine {mid} has less or equal to {n} passwords saved, returning all")
+                logging.getLogger('mlaps').info("Machine %s has less or equal to %d passwords saved, returning all", mid, n)
                 return pws
             vcount = 0
             wantedPws = []
@@ -461,7 +946,7 @@ class dbClient:
                 if len(wantedPws) == 0:
                     pw.delete()
                     rmcount += 1
-            logging.getLogger('mlaps').debug(f"Removed {rmcount} password from machine {mid}")
+            logging.getLogger('mlaps').debug("Removed %d password from machine %s", rmcount, mid)
         except Exception as e:
             logging.getLogger('mlaps').error(e)
             return None
@@ -0,0 +1,153 @@
+import contextlib, logging, random, threading, time, weakref
+
+from pony.orm.dbapiprovider import Pool, wrap_dbapi_exceptions
+from pony.orm.dbproviders.mysql import MySQLProvider
+
+
+class PoolLimits:
+    """
+    Limits shared by all thread local connections of a pool
+    size is the number of connections kept open between db sessions, recycle the max age of a connection in seconds
+    """
+
+    def __init__(self, size=10, recycle=3600):
+        self.size = size
+        self.recycle = recycle
+        self.open = 0
+        self.__lock = threading.Lock()
+
+    def opened(self):
+        with self.__lock:
+            self.open += 1
+
+    def closed(self):
+        with self.__lock:
+            self.open -= 1
+
+    def oversized(self):
+        return self.size is not None and self.open > self.size
+
+
+class ThreadGuard:
+    """
+    Only referenced by the thread local state of a pool, so it is freed once its thread exited
+    """
+
+
+class RecyclingPool(Pool):
+    """
+    Pony keeps one connection per thread, this pool additionally reconnects connections older than the recycle time
+    before they are reused and closes connections after a db session while more than size connections are open
+    The connection of a thread which exited without closing it isn't counted as open anymore
+    """
+
+    def __init__(self, dbapi_module, limits: PoolLimits, *args, **kwargs):
+        # called separately in each thread
+        Pool.__init__(self, dbapi_module, *args, **kwargs)
+        self.limits = limits
+        self.connectedAt = None
+        self.__guard = None
+        # counts the connection of this thread as closed, once when it's dropped or when the thread exited
+        self.__closed = None
+
+    def connect(self):
+        if self.con is not None and self.limits.recycle and time.monotonic() - self.connectedAt > self.limits.recycle:
+            self.drop(self.con)
+        return Pool.connect(self)
+
+    def _connect(self):
+        Pool._connect(self)
+        self.connectedAt = time.monotonic()
+        self.limits.opened()
+        self.__guard = ThreadGuard()
+        self.__closed = weakref.finalize(self.__guard, self.limits.closed)
+
+    def release(self, con):
+        Pool.release(self, con)
+        if self.limits.oversized():
+            self.drop(con)
+
+    def drop(self, con):
+        try:
+            Pool.drop(self, con)
+        finally:
+            self.__countClosed()
+
+    def disconnect(self):
+        if self.con is not None:
+            self.__countClosed()
+        Pool.disconnect(self)
+
+    def __countClosed(self):
+        if self.__closed is not None:
+            self.__closed()
+            self.__closed = self.__guard = None
+
+
+class PooledMySQLProvider(MySQLProvider):
+    """
+    MySQL provider with a size limited and recycling connection pool, sampled sql logging and an optional read replica
+    Besides the arguments of pymysql.connect it takes pool_size, pool_recycle, sql_sample_rate and replica_host
+    Sessions started in readReplica() get their connection from the replica pool, all others from the primary
+    """
+
+    def __init__(self, *args, **kwargs):
+        replicaHost = kwargs.pop('replica_host', None)
+        self.sqlSampleRate = kwargs.pop('sql_sample_rate', 0.0)
+        self.route = threading.local()
+        self.replicaPool = None
+        if replicaHost:
+            # the replica connections are read only, a write routed there by mistake fails instead of diverging
+            self.replicaPool = self.get_pool(*args, **dict(kwargs, host=replicaHost,
+                                                           init_command="SET SESSION TRANSACTION READ ONLY"))
+        MySQLProvider.__init__(self, *args, **kwargs)
+
+    def get_pool(self, *args, **kwargs):
+        limits = PoolLimits(kwargs.pop('pool_size', 10), kwargs.pop('pool_recycle', 3600))
+        pool = MySQLProvider.get_pool(self, *args, **kwargs)
+        return RecyclingPool(pool.dbapi_module, limits, *pool.args, **pool.kwargs)
+
+    """
+    Routes the db sessions started by the current thread inside this context to the read replica, if one is configured
+    """
+    @contextlib.contextmanager
+    def readReplica(self):
+        previous = getattr(self.route, 'replica', False)
+        self.route.replica = self.replicaPool is not None
+        try:
+            yield
+        finally:
+            self.route.replica = previous
+
+    def connect(self):
+        if getattr(self.route, 'replica', False):
+            return self.replicaPool.connect()
+        return self.pool.connect()
+
+    @wrap_dbapi_exceptions
+    def release(self, connection, cache=None):
+        if cache is not None and cache.db_session is not None and cache.db_session.ddl:
+            self.drop(connection, cache)
+        else:
+            self.__poolOf(connection).release(connection)
+
+    def drop(self, connection, cache=None):
+        self.__poolOf(connection).drop(connection)
+        if cache is not None:
+            cache.in_transaction = False
+
+    @wrap_dbapi_exceptions
+    def disconnect(self):
+        self.pool.disconnect()
+        if self.replicaPool is not None:
+            self.replicaPool.disconnect()
+
+    def execute(self, cursor, sql, arguments=None, returning_id=False):
+        if self.sqlSampleRate and random.random() < self.sqlSampleRate:
+            logging.getLogger('mlaps').info("Sampled SQL: %s", sql)
+        return MySQLProvider.execute(self, cursor, sql, arguments, returning_id)
+
+    def __poolOf(self, connection):
+        if self.replicaPool is not None and connection is self.replicaPool.con:
+            return self.replicaPool
+        return self.pool
@@ -0,0 +1,60 @@
+import concurrent.futures, threading, time, uuid
+
+
+class EnrollmentPool():
+    """
+    Runs the csr signing of enrollments on a bounded pool of worker threads, outside of any request or db session
+    At most maxPending enrollments are queued or running at a time, further ones are rejected until one finished.
+    The results are kept for resultTTL seconds, so clients which didn't wait for the signing can poll for them
+    """
+
+    def __init__(self, sign, workers=4, maxPending=100, resultTTL=600):
+        # sign(uid, csr) returns the certificate or a string starting with "Failed"
+        self.__sign = sign
+        self.maxPending = maxPending
+        self.resultTTL = resultTTL
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="enroll")
+        self.__pending = threading.BoundedSemaphore(maxPending)
+        self.__lock = threading.Lock()
+        # uid -> (future, time it finished or None)
+        self.__enrollments = {}
+
+    """
+    Queues the signing of the csr for the machine with the given id
+    Returns the future of the signing or None if maxPending enrollments are already queued
+    """
+    def submit(self, uid: uuid.UUID, csr: str):
+        if not self.__pending.acquire(blocking=False):
+            return None
+        self.__purge()
+        future = self.__executor.submit(self.__sign, uid, csr)
+        with self.__lock:
+            self.__enrollments[uid] = (future, None)
+        future.add_done_callback(lambda f: self.__finished(uid, f))
+        return future
+
+    """
+    Returns the future of the enrollment of the machine with the given id or None if it is unknown or expired
+    """
+    def get(self, uid: uuid.UUID):
+        self.__purge()
+        with self.__lock:
+            entry = self.__enrollments.get(uid)
+        return entry[0] if entry else None
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+    def __finished(self, uid, future):
+        self.__pending.release()
+        with self.__lock:
+            if uid in self.__enrollments:
+                self.__enrollments[uid] = (future, time.monotonic())
+
+    # drops the results which have been kept for longer than resultTTL
+    def __purge(self):
+        expired = time.monotonic() - self.resultTTL
+        with self.__lock:
+            for uid in [uid for uid, (_, finished) in self.__enrollments.items()
+                        if finished is not None and finished < expired]:
+                del self.__enrollments[uid]
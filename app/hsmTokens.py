@@ -0,0 +1,230 @@
+import collections, logging, threading, time
+
+import hvac
+import metrics
+
+
+class HSMToken():
+    """
+    A vault token with the hvac client using it and the number of its uses which have been handed out
+    """
+
+    def __init__(self, client: hvac.Client, maxUses: int, ttl: int = None):
+        self.client = client
+        self.maxUses = maxUses
+        self.uses = 0
+        self.expiresAt = time.monotonic() + ttl if ttl else None
+
+    def remaining(self) -> int:
+        return self.maxUses - self.uses
+
+    def secondsLeft(self) -> float:
+        return self.expiresAt - time.monotonic() if self.expiresAt is not None else float('inf')
+
+    def reserve(self, uses: int) -> bool:
+        if self.remaining() < uses or self.secondsLeft() <= 0:
+            return False
+        self.uses += uses
+        return True
+
+
+class HSMTokenManager():
+    """
+    Owns the vault login and the token uses of the hsm client, safe to be used by any number of threads
+    Every vault request reserves its uses with acquire and gets the client of a token which still has them.
+    Up to standbySize pre-authenticated standby tokens are kept, which replace a used up token without any login on
+    the request path. They are refilled by refill, called by the scheduler or right after a standby token was used.
+    Only if no standby token is left, a new token is requested in the background once the current one has at most
+    renewMargin uses or renewBefore seconds left, while its remaining uses are still handed out. If the token is used
+    up before the new one arrived, the requests wait for it. There is never more than one such login in flight.
+    If a renewal or refill fails with the stored credentials, they are re-read with readCredentials, if given, and the
+    login is retried once, since another process may have rotated the secret id meanwhile.
+    """
+
+    def __init__(self, url, session, maxUses=10, timeout=30, renewMargin=3, renewBefore=300, standbySize=1,
+                 scheduler=None, readCredentials=None):
+        self.url = url
+        self.session = session
+        self.maxUses = maxUses
+        self.timeout = timeout
+        self.renewMargin = renewMargin
+        self.renewBefore = renewBefore
+        self.standbySize = standbySize
+        self.__scheduler = scheduler
+        self.readCredentials = readCredentials
+        self.__cond = threading.Condition()
+        self.__token = None
+        self.__standby = collections.deque()
+        # serializes refills, a refill which is already running makes any other one a no-op
+        self.__refillLock = threading.Lock()
+        self.__credentials = None
+        self.__loggingIn = False
+        # incremented after every finished login, so waiting requests know a login failed
+        self.__logins = 0
+        self.__lastLoginOk = False
+
+    @property
+    def uses(self) -> int:
+        token = self.__token
+        return token.uses if token is not None else 0
+
+    @property
+    def isAuthenticated(self) -> bool:
+        with self.__cond:
+            return any(token.secondsLeft() > 0 for token in [self.__token, *self.__standby] if token is not None)
+
+    @property
+    def standby(self) -> int:
+        return len(self.__standby)
+
+    """
+    Logs in with the given credentials and replaces the current token, they are used for all following renewals
+    Returns whether the login succeeded, on failure the current token and credentials are kept
+    """
+    def login(self, role_id, secret_id) -> bool:
+        with self.__cond:
+            self.__loggingIn = True
+        loggedIn = self.__relogin('login', (role_id, secret_id))
+        if loggedIn:
+            self.__scheduleRefill()
+        return loggedIn
+
+    """
+    Tops the standby tokens up to standbySize and replaces those which are about to expire
+    Returns the number of standby tokens
+    """
+    def refill(self) -> int:
+        if not self.__refillLock.acquire(blocking=False):
+            return self.standby
+        try:
+            with self.__cond:
+                for token in [token for token in self.__standby if token.secondsLeft() <= self.renewBefore]:
+                    self.__standby.remove(token)
+                missing = self.standbySize - len(self.__standby)
+                credentials = self.__credentials
+            for _ in range(missing):
+                try:
+                    token, used = self.__requestTokenRereading(credentials)
+                    metrics.hsmLogins.inc('standby', 'ok')
+                except Exception as e:
+                    metrics.hsmLogins.inc('standby', 'failed')
+                    logging.getLogger('mlaps').error(f"Failed to refill the standby hsm tokens: {e}")
+                    break
+                with self.__cond:
+                    self.__standby.append(token)
+                    if used != credentials:
+                        self.__credentials = credentials = used
+                    self.__cond.notify_all()
+            logging.getLogger('mlaps').debug("%d standby hsm tokens are ready", self.standby)
+            return self.standby
+        finally:
+            self.__refillLock.release()
+
+    """
+    Reserves the given number of uses of a valid token and returns the hvac client using it
+    Raises a ValueError if no token could be obtained
+    """
+    def acquire(self, uses=1) -> hvac.Client:
+        renew = promoted = False
+        with self.__cond:
+            while True:
+                token = self.__token
+                reserved = token is not None and token.reserve(uses)
+                while not reserved and self.__standby:
+                    # the current token is used up, continue with a standby token without any login
+                    token = self.__token = self.__standby.popleft()
+                    promoted = True
+                    reserved = token.reserve(uses)
+                if reserved:
+                    if self.__needsRenewal(token) and not self.__standby and not self.__loggingIn:
+                        self.__loggingIn = renew = True
+                    break
+                if not self.__loggingIn:
+                    # this request does the login all others wait for
+                    self.__loggingIn = True
+                    token = None
+                    break
+                logins = self.__logins
+                # wait for the running login or a refilled standby token
+                if not self.__cond.wait_for(lambda: self.__logins != logins or self.__standby, self.timeout):
+                    raise ValueError("HSM Token is over its permitted uses and failed to renew")
+                if self.__logins != logins and not self.__lastLoginOk and not self.__standby:
+                    raise ValueError("HSM Token is over its permitted uses and failed to renew")
+        if promoted:
+            self.__scheduleRefill()
+        if renew:
+            threading.Thread(target=self.__relogin, args=('renewal',), name="hsm-token-renewal", daemon=True).start()
+        if token is not None:
+            return token.client
+        # no token is left, the request waits for this login
+        if not self.__relogin('blocking'):
+            raise ValueError("HSM Token is over its permitted uses and failed to renew")
+        return self.acquire(uses)
+
+    # hands a refill to the scheduler, so the calling request doesn't wait for the logins
+    def __scheduleRefill(self):
+        if self.standbySize <= 0:
+            return
+        if self.__scheduler is not None:
+            # a fixed id ensures only one pending refill job exists at a time
+            self.__scheduler.add_job(func=self.refill, id='hsm-token-refill', replace_existing=True)
+        else:
+            threading.Thread(target=self.refill, name="hsm-token-refill", daemon=True).start()
+
+    def __needsRenewal(self, token: HSMToken) -> bool:
+        return token.remaining() <= self.renewMargin or token.secondsLeft() <= self.renewBefore
+
+    """
+    Requests a new token with the given credentials, or the stored ones, and installs it, the caller marks the login
+    as in flight. Given credentials are only stored once they logged in successfully
+    The kind of the login (login, renewal or blocking) is only used for the metrics
+    """
+    def __relogin(self, kind: str, newCredentials: tuple = None) -> bool:
+        with self.__cond:
+            credentials = newCredentials or self.__credentials
+        token = None
+        try:
+            if newCredentials is None:
+                token, newCredentials = self.__requestTokenRereading(credentials)
+            else:
+                token = self.__requestToken(*newCredentials)
+            logging.getLogger('mlaps').debug("Successfully authenticated to Vault")
+        except Exception as e:
+            logging.getLogger('mlaps').error(str(e))
+        metrics.hsmLogins.inc(kind, 'ok' if token is not None else 'failed')
+        with self.__cond:
+            if token is not None:
+                self.__token = token
+                if newCredentials is not None:
+                    self.__credentials = newCredentials
+            self.__loggingIn = False
+            self.__lastLoginOk = token is not None
+            self.__logins += 1
+            self.__cond.notify_all()
+        return token is not None
+
+    """
+    Requests a new token with the given stored credentials, if that fails re-reads the credentials and retries once
+    with them if they changed. Returns the token and the credentials it was requested with
+    """
+    def __requestTokenRereading(self, credentials: tuple) -> tuple:
+        try:
+            return self.__requestToken(*credentials), credentials
+        except Exception:
+            if self.readCredentials is None:
+                raise
+            current = self.readCredentials()
+            if not current or tuple(current) == tuple(credentials):
+                raise
+            logging.getLogger('mlaps').info("Hsm login failed, retrying with the re-read secret id")
+            return self.__requestToken(*current), tuple(current)
+
+    def __requestToken(self, role_id, secret_id) -> HSMToken:
+        # every token gets its own lightweight client on the shared session, so requests still using the previous
+        # token aren't affected by the swap
+        client = hvac.Client(url=self.url, timeout=self.timeout, session=self.session)
+        resp = client.auth.approle.login(role_id=role_id, secret_id=secret_id)
+        auth = resp.get('auth') if resp else None
+        if not auth or not auth.get('client_token'):
+            raise ValueError('error, could not authenticate')
+        return HSMToken(client, auth.get('num_uses') or self.maxUses, auth.get('lease_duration'))
@@ -1,59 +1,101 @@
 from typing import Union
 
-import hvac, base64, logging
+import hvac, base64, logging, socket, requests, hsmTokens, metrics
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 from os import environ as env
 
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTP adapter which enables tcp keep-alive probes on the pooled
+    connections, so idle connections to the vault aren't silently dropped.
+    """
+    def __init__(self, keepAlive=60, **kwargs):
+        self.keepAlive = keepAlive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if self.keepAlive and hasattr(socket, 'TCP_KEEPIDLE'):
+            options += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepAlive),
+                        (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, self.keepAlive)]
+        kwargs['socket_options'] = options
+        super().init_poolmanager(*args, **kwargs)
+
+
 class HSMClient():
     # tracks the uses of the current hsm token, to know when to renew it
-    uses = 0
+    @property
+    def uses(self) -> int:
+        return self.__tokens.uses
+
     # keeps track of the current status to the vault without using a token usage everything checking
-    isAuthenticated = False
+    @property
+    def isAuthenticated(self) -> bool:
+        return self.__tokens.isAuthenticated
 
+    @metrics.timed(metrics.vaultLatency, profile='vault')
     def checkConnection(self) -> Union[bool, str]:
         if not self.isAuthenticated: return "Not initialized/Failed to initialize hsmclient"
-        self.uses += 2
-        sealStatus = bool(self.__hsmClient.seal_status['sealed'])
-        authenticationStatus = self.__hsmClient.is_authenticated()
-        logging.getLogger('mlaps').debug(f"Connection to Vault is authenticated: {authenticationStatus}, Vault is sealed: {sealStatus}")
-        self.isAuthenticated = authenticationStatus
-        return True
-
-    def __init__(self, host, role_id, secret_id):
         try:
-            # try to initialize the hsm connection with the given credentials
-            self.isAuthenticated = self.__hsmlogin(host, role_id, secret_id)
+            client = self.__tokens.acquire(uses=2)
+            sealStatus = bool(client.seal_status['sealed'])
+            authenticationStatus = client.is_authenticated()
         except Exception as e:
-            logging.getLogger('mlaps').error(str(e))
+            return str(e)
+        logging.getLogger('mlaps').debug("Connection to Vault is authenticated: %s, Vault is sealed: %s", authenticationStatus, sealStatus)
+        return True if authenticationStatus else "Vault rejected the current token"
 
-    def __hsmlogin(self,url,role,secret):
-        # calls the hsm library to login
-        self.__hsmClient = hvac.Client(url="http://{}:8200/".format(url))
-        # pass the credentials to the approle login endpoint
-        self.__hsmClient.auth.approle.login(
-                role_id=role,
-                secret_id=secret,
-                )
-        # check if the credentials worked
-        if self.__hsmClient.is_authenticated():
-            logging.getLogger('mlaps').debug("Successfully authenticated to Vault")
-            return True
-        else:
-            raise Exception('error, could not authenticate')
+    """
+    Creates the vault client on one long-lived pooled http session and logs in with the given credentials
+    parameters:
+        poolSize: number of connections kept open to the vault
+        timeout: timeout of every vault request in seconds
+        keepAlive: idle seconds before tcp keep-alive probes are sent on a pooled connection, 0 to use the os default
+        maxUses: number of allowed usages of a token, if the login response doesn't state it
+        standbyTokens: number of pre-authenticated tokens kept ready, refilled through the given scheduler
+        readCredentials: returns the current (role_id, secret_id), used to retry a failed renewal with a rotated secret
+    """
+    def __init__(self, host, role_id, secret_id, poolSize=10, timeout=30, keepAlive=60, maxUses=10, standbyTokens=1,
+                 scheduler=None, readCredentials=None):
+        session = requests.Session()
+        adapter = KeepAliveAdapter(keepAlive=keepAlive, pool_connections=1, pool_maxsize=poolSize)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        # the token manager logs in and hands out the token uses, see hsmTokens.HSMTokenManager
+        self.__tokens = hsmTokens.HSMTokenManager("http://{}:8200/".format(host), session, maxUses=maxUses,
+                                                  timeout=timeout, standbySize=standbyTokens, scheduler=scheduler,
+                                                  readCredentials=readCredentials)
+        self.login(role_id, secret_id)
+
+    """
+    Logs in with the given credentials and swaps the token, the http session and its connections are kept
+    Returns whether the login succeeded
+    """
+    def login(self, role_id, secret_id) -> bool:
+        return self.__tokens.login(role_id, secret_id)
+
+    """
+    Tops up the pre-authenticated standby tokens and replaces those about to expire, called by the scheduler
+    Returns the number of standby tokens
+    """
+    def refreshStandbyTokens(self) -> int:
+        return self.__tokens.refill()
 
     """
     Sends the given password to the hsm for encryption and returns the entire response
     parameters:
         plaintext: plain plaintext password as utf-8 string, not base64 encoded
     """
+    @metrics.timed(metrics.vaultLatency, metrics.vaultErrors, profile='vault')
     def hsm_enc(self, plaintext: str):
         try:
             # base64 encode the given password, hsm expects the text to be encoded
             encod_pw = str(base64.b64encode(bytes(plaintext,"utf-8")),"utf-8")
-            logging.getLogger('mlaps').debug(encod_pw)
-            # increment the hsm token usage, even if it fails it counts as a request
-            self.uses += 1
+            # reserve a use of a valid hsm token, even if the request fails it counts as a use
+            client = self.__tokens.acquire()
             # actually send the request to encrypt to the hsm
-            cipher = self.__hsmClient.secrets.transit.encrypt_data(
+            cipher = client.secrets.transit.encrypt_data(
                 name = 'client-passwords',
                 plaintext = encod_pw,
             )
@@ -69,30 +111,82 @@ class HSMClient():
     parameters:
         cipher: encrypted password as utf-8 string in hsm format, not base64 encoded
     """
+    @metrics.timed(metrics.vaultLatency, metrics.vaultErrors, profile='vault')
     def hsm_dec(self, cipher):
         try:
-            # increment the hsm token usage, even if it fails it counts as a request
-            self.uses += 1
+            # reserve a use of a valid hsm token, even if the request fails it counts as a use
+            client = self.__tokens.acquire()
             # actually send the request to decrypt to the hsm
-            plain = self.__hsmClient.secrets.transit.decrypt_data(
+            plain = client.secrets.transit.decrypt_data(
                 name = 'client-passwords',
                 ciphertext = cipher,
             )
-            logging.getLogger('mlaps').debug(plain)
+            logging.getLogger('mlaps').debug("Decrypted a password")
             # return the entire response
             return plain
         except Exception as e:
             logging.getLogger('mlaps').error(str(e))
         return False
+
+    """
+    Sends all given passwords to the hsm for encryption in a single request and returns the entire response,
+    the ciphertexts are in data.batch_results in the order of the passwords, a failed item only has an error set
+    Counts as one token use, independent of the number of passwords
+    parameters:
+        plaintexts: list of plain passwords as utf-8 strings, not base64 encoded
+    """
+    @metrics.timed(metrics.vaultLatency, metrics.vaultErrors, profile='vault')
+    def hsm_enc_batch(self, plaintexts: list):
+        try:
+            batch = [{'plaintext': str(base64.b64encode(bytes(plaintext, "utf-8")), "utf-8")} for plaintext in plaintexts]
+            # reserve a use of a valid hsm token, even if the request fails it counts as a use
+            client = self.__tokens.acquire()
+            # actually send the request to encrypt the whole batch to the hsm
+            cipher = client.secrets.transit.encrypt_data(
+                name = 'client-passwords',
+                batch_input = batch,
+            )
+            logging.getLogger('mlaps').debug("Encrypted a batch of %d passwords", len(batch))
+            # return the entire response
+            return cipher
+        except Exception as e:
+            logging.getLogger('mlaps').error(str(e))
+        return False
+
+    """
+    Sends all given ciphers to the hsm for decryption in a single request and returns the entire response,
+    the plaintexts are in data.batch_results in the order of the ciphers, a failed item only has an error set
+    Counts as one token use, independent of the number of ciphers
+    parameters:
+        ciphers: list of encrypted passwords as utf-8 strings in hsm format, not base64 encoded
+    """
+    @metrics.timed(metrics.vaultLatency, metrics.vaultErrors, profile='vault')
+    def hsm_dec_batch(self, ciphers: list):
+        try:
+            # reserve a use of a valid hsm token, even if the request fails it counts as a use
+            client = self.__tokens.acquire()
+            # actually send the request to decrypt the whole batch to the hsm
+            plain = client.secrets.transit.decrypt_data(
+                name = 'client-passwords',
+                batch_input = [{'ciphertext': cipher} for cipher in ciphers],
+            )
+            logging.getLogger('mlaps').debug("Decrypted a batch of %d passwords", len(ciphers))
+            # return the entire response
+            return plain
+        except Exception as e:
+            logging.getLogger('mlaps').error(str(e))
+        return False
+
     """
     Sends the given csr to the hsm for signing with the given common_name to be set as the cn
     """
+    @metrics.timed(metrics.vaultLatency, metrics.vaultErrors, profile='vault')
     def hsm_sign_csr(self,csr, common_name):
         try:
-            # increment the hsm token usage, even if it fails it counts as a request
-            self.uses += 1
+            # reserve a use of a valid hsm token, even if the request fails it counts as a use
+            client = self.__tokens.acquire()
             # send the actual request to the hsm with the common_name set
-            signed_cert = self.__hsmClient.secrets.pki.sign_certificate(
+            signed_cert = client.secrets.pki.sign_certificate(
                 name='mlaps',
                 csr=csr,
                 common_name=common_name
@@ -107,12 +201,13 @@ class HSMClient():
     """
     Sends a request for a new secret id to the hsm and returns the entire response
     """
+    @metrics.timed(metrics.vaultLatency, metrics.vaultErrors, profile='vault')
     def hsm_get_new_secret(self):
         try:
-            # increment the hsm token usage, even if it fails it counts as a request
-            self.uses += 1
+            # reserve a use of a valid hsm token, even if the request fails it counts as a use
+            client = self.__tokens.acquire()
             # send the actual request to the hsm
-            resp = self.__hsmClient.auth.approle.generate_secret_id(
+            resp = client.auth.approle.generate_secret_id(
                 role_name='client-passwords',
             )
             logging.getLogger('mlaps').debug(resp)
@@ -1,45 +1,183 @@
-import os, logging, collections
-from logging.handlers import RotatingFileHandler
+import os, logging, collections, json, queue, atexit, datetime, uuid, threading
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from typing import Union
 
 
 class Logger():
-    def __init__(self, level: Union[int, str], logLocation: str, numberOfLinesToRetain: int):
+    """
+    Sets up the logging of the app. The loggers only put the records into a queue, a background thread formats them
+    and writes them to the log file and the tail shown on the admin page, so logging never waits for the disk
+    parameters:
+        jsonFormat: write the log file as one json object per line instead of plain text
+        queueSize: records waiting for the writer, further records are dropped until it caught up
+    """
+    def __init__(self, level: Union[int, str], logLocation: str, numberOfLinesToRetain: int, jsonFormat: bool = False,
+                 queueSize: int = 10000):
         os.makedirs(logLocation, exist_ok=True)
 
         self.tail = TailLogger(numberOfLinesToRetain)
         formatter = logging.Formatter('%(asctime)s - %(name)s@%(funcName)s - %(levelname)s - %(message)s')
 
         log_handler = self.tail.log_handler
-        log_handler.setFormatter(formatter)
         logFile_handler = RotatingFileHandler(f"{logLocation.rstrip(os.sep)}/mlaps.log", encoding='utf8',maxBytes=100000, backupCount=1)
-        logFile_handler.setFormatter(formatter)
+        logFile_handler.setFormatter(JsonFormatter() if jsonFormat else formatter)
+
+        self.queue_handler = DroppingQueueHandler(queue.Queue(queueSize))
+        self.listener = QueueListener(self.queue_handler.queue, log_handler, logFile_handler)
+        self.listener.start()
+        self.__running = True
+        # atexit runs the handlers in reverse order, so everything logged by handlers registered later is written
+        atexit.register(self.stop)
 
         rootLogger = logging.getLogger()
-        rootLogger.addHandler(log_handler)
-        rootLogger.addHandler(logFile_handler)
+        rootLogger.addHandler(self.queue_handler)
         rootLogger.setLevel(int(level) if str.isnumeric(level) else level)
 
+    """
+    Writes the queued records and stops the writer thread, registered to be called on exit
+    """
+    def stop(self):
+        if self.__running:
+            self.__running = False
+            logging.getLogger().removeHandler(self.queue_handler)
+            self.listener.stop()
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Handler putting the records into the queue of the writer thread without ever blocking the logging thread
+    If the queue is full the record is dropped, the number of dropped records is logged once there is room again
+    """
+
+    immutableTypes = (str, int, float, bool, type(None), uuid.UUID, datetime.datetime, datetime.date)
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the message is only formatted here if its arguments could change until the writer formats it, plain values
+        # are left to the writer thread just like the time and the layout of the line
+        if not (isinstance(record.msg, str) and isinstance(record.args, tuple) and
+                all(isinstance(arg, self.immutableTypes) for arg in record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # the traceback keeps the frames of the logging thread alive, its text is enough for the writer
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            try:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': 'mlaps', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': "Dropped %d log records, the log writer couldn't keep up", 'args': (dropped,)}))
+            except queue.Full:
+                self.dropped += dropped
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one json object per line for log collectors
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'function': record.funcName,
+            'message': record.getMessage(),
+        }
+        exc_text = record.exc_text or (self.formatException(record.exc_info) if record.exc_info else None)
+        if exc_text:
+            entry['exception'] = exc_text
+        return json.dumps(entry, default=str)
+
+
+# one record of the tail, seq numbers the records of the process in the order they were written
+LogEntry = collections.namedtuple('LogEntry', ['seq', 'time', 'level', 'levelname', 'logger', 'message'])
+
 
 #https://stackoverflow.com/a/37967421
 class TailLogHandler(logging.Handler):
 
-    def __init__(self, log_queue):
+    def __init__(self, tail):
         logging.Handler.__init__(self)
-        self.log_queue = log_queue
+        self.tail = tail
 
     def emit(self, record):
-        self.log_queue.append(self.format(record))
+        message = record.getMessage()
+        if record.exc_text:
+            message = f"{message}\n{record.exc_text}"
+        self.tail.append(datetime.datetime.fromtimestamp(record.created), record.levelno, record.levelname,
+                         record.name, message)
 
 
 class TailLogger(object):
+    """
+    Keeps the latest maxlen log records for the admin page in a ring buffer, indexed by their seq number
+    Queries scan from a cursor towards older records and stop once a page is filled, so their cost doesn't depend on
+    the retention
+    """
 
     def __init__(self, maxlen):
-        self._log_queue = collections.deque(maxlen=maxlen)
-        self._log_handler = TailLogHandler(self._log_queue)
+        self.maxlen = max(int(maxlen), 1)
+        self._entries = [None] * self.maxlen
+        # seq of the newest record, the record seq is stored at seq % maxlen
+        self._last = 0
+        self._lock = threading.Lock()
+        self._log_handler = TailLogHandler(self)
+
+    def append(self, time: datetime.datetime, level: int, levelname: str, logger: str, message: str):
+        with self._lock:
+            seq = self._last + 1
+            # stored before it is published as latest, the queries read without the lock
+            self._entries[seq % self.maxlen] = LogEntry(seq, time, level, levelname, logger, message)
+            self._last = seq
 
-    def contents(self):
-        return '\n'.join(self._log_queue)
+    @property
+    def latest(self) -> int:
+        return self._last
+
+    """
+    Returns up to limit records matching the filters, the newest first, and the cursor for the next older page
+    parameters:
+        level: minimal level of the records
+        search: case insensitive text the message or the logger name contain
+        since: only records written at or after this time
+        before: only records older than this seq, the cursor returned by the previous page
+        after: only records newer than this seq, the latest seq of the previous fetch for incremental updates
+    The returned cursor is None if there are no older records left
+    """
+    def query(self, level: int = 0, search: str = '', since: datetime.datetime = None, before: int = None,
+              after: int = 0, limit: int = 50) -> tuple:
+        search = search.lower()
+        last = self._last
+        # records older than first have been overwritten
+        first = max(last - self.maxlen + 1, 1, after + 1)
+        seq = min(last, before - 1) if before is not None else last
+        page = []
+        while seq >= first and len(page) < limit:
+            entry = self._entries[seq % self.maxlen]
+            # overwritten by a newer record while scanning, so this and all older records are gone
+            if entry.seq != seq:
+                return page, None
+            seq -= 1
+            # the records are written in the order they were logged, all further ones are older
+            if since is not None and entry.time < since:
+                return page, None
+            if entry.level >= level and (not search or search in entry.message.lower() or search in entry.logger.lower()):
+                page.append(entry)
+        return page, seq + 1 if seq >= first else None
 
     @property
     def log_handler(self):
@@ -0,0 +1,90 @@
+import collections, logging, threading, time, uuid
+
+import sessionStore
+
+
+class MachineCache():
+    """
+    Cache of the rendered tables of the machine detail page, keyed by the machine id
+    Every entry is stamped with the version of its machine when it was built and only served while the version is
+    unchanged, every write to a machine bumps its version. A version has two parts:
+        the local version of this process, bumped by every write, also the frequent checkins
+        the shared stamp in the session store, bumped by the admin and password writes, so they invalidate the entries
+        of the other workers too (unless the memory session store is used)
+    Entries also expire after ttl seconds at the latest, which bounds how long checkins handled by other workers and
+    changes of other machines (the possible duplicates) take to show up
+    """
+    namespace = 'machine'
+
+    def __init__(self, store: sessionStore.SessionStore, ttl: float = 60, maxSize: int = 1000):
+        self.__store = store
+        self.ttl = ttl
+        self.maxSize = maxSize
+        # machine id -> (local version, shared stamp, monotonic expiry, fragments), the least recently used first
+        self.__entries = collections.OrderedDict()
+        self.__versions = {}
+        # bumped by clear, part of every version
+        self.__generation = 0
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    """
+    Returns the cached fragments of the given machine, or builds them with the given function if they are missing or
+    outdated. build returns the fragments and the seconds until they expire on their own, None if only by ttl
+    """
+    def get(self, mid, build):
+        key = self.__key(mid)
+        # the version is taken before building, so a write while building invalidates the built fragments
+        with self.__lock:
+            version = (self.__generation, self.__versions.get(key, 0))
+        stamp = self.__store.get(self.namespace, key)
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] == version and entry[1] == stamp and entry[2] > now:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return entry[3]
+            self.misses += 1
+        fragments, expiresIn = build()
+        ttl = self.ttl if expiresIn is None else min(self.ttl, expiresIn)
+        if ttl > 0:
+            with self.__lock:
+                self.__entries[key] = (version, stamp, now + ttl, fragments)
+                self.__entries.move_to_end(key)
+                while len(self.__entries) > self.maxSize:
+                    self.__entries.popitem(last=False)
+        return fragments
+
+    """
+    Bumps the version of the given machines, shared with the other workers unless shared is False
+    """
+    def invalidate(self, *mids, shared: bool = True):
+        keys = [self.__key(mid) for mid in mids]
+        with self.__lock:
+            for key in keys:
+                self.__versions[key] = self.__versions.get(key, 0) + 1
+                self.__entries.pop(key, None)
+        if shared:
+            for key in keys:
+                if not self.__store.set(self.namespace, key, uuid.uuid4().hex, self.ttl):
+                    logging.getLogger('mlaps').warning("Failed to share the new version of machine %s", key)
+
+    """
+    Drops all entries of this process, for writes to machines which aren't known by id
+    """
+    def clear(self):
+        with self.__lock:
+            self.__generation += 1
+            self.__entries.clear()
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {'entries': len(self.__entries), 'maxSize': self.maxSize, 'hits': self.hits, 'misses': self.misses}
+
+    def __key(self, mid) -> str:
+        try:
+            return str(mid if isinstance(mid, uuid.UUID) else uuid.UUID(str(mid)))
+        except ValueError:
+            return str(mid)
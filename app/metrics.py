@@ -0,0 +1,201 @@
+import abc, bisect, functools, inspect, threading, time
+
+import profiling
+
+
+class Metric(abc.ABC):
+    """
+    Base of the in-process metrics, a value per combination of label values
+    Every process keeps its own values, with several workers each scrape of /metrics only sees the answering worker
+    """
+    type = None
+
+    def __init__(self, name: str, help: str, labelNames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            values = {labels: self._copy(value) for labels, value in self._values.items()}
+        for labels, value in sorted(values.items()):
+            lines.extend(self._renderValue(labels, value))
+        return lines
+
+    def _copy(self, value):
+        return value
+
+    """
+    Returns the exposition lines of the value with the given label values
+    """
+    @abc.abstractmethod
+    def _renderValue(self, labels: tuple, value) -> list:
+        pass
+
+    def _labels(self, labels: tuple, extra: dict = None) -> str:
+        pairs = list(zip(self.labelNames, labels)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels) -> float:
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def _renderValue(self, labels, value):
+        return [f"{self.name}{self._labels(labels)} {value}"]
+
+
+class Histogram(Metric):
+    """
+    Histogram with fixed buckets, observing only counts into the bucket of the value, they are summed up on render
+    """
+    type = "histogram"
+    defaultBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, help: str, labelNames: tuple = (), buckets: tuple = defaultBuckets):
+        super().__init__(name, help, labelNames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # count per bucket plus the +Inf bucket, then the sum of all values
+                entry = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    def count(self, *labels) -> int:
+        with self._lock:
+            entry = self._values.get(labels)
+            return sum(entry[:-1]) if entry else 0
+
+    def _copy(self, value):
+        return list(value)
+
+    def _renderValue(self, labels, value):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), value[:-1]):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{self._labels(labels, {'le': bound})} {cumulative}")
+        lines.append(f"{self.name}_sum{self._labels(labels)} {value[-1]}")
+        lines.append(f"{self.name}_count{self._labels(labels)} {cumulative}")
+        return lines
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    """
+    Returns all metrics in the prometheus text exposition format
+    """
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+REGISTRY = Registry()
+
+requestLatency = REGISTRY.register(Histogram(
+    "mlaps_http_request_duration_seconds", "Duration of the http requests by flask route", ("route", "method", "status")))
+dbLatency = REGISTRY.register(Histogram(
+    "mlaps_db_call_duration_seconds", "Duration of the calls of dbClient methods", ("method",)))
+dbQueries = REGISTRY.register(Counter(
+    "mlaps_db_queries_total", "Number of sql statements sent to the database by dbClient method", ("method",)))
+vaultLatency = REGISTRY.register(Histogram(
+    "mlaps_vault_request_duration_seconds", "Duration of the vault requests by HSMClient method", ("method",)))
+vaultErrors = REGISTRY.register(Counter(
+    "mlaps_vault_errors_total", "Number of failed vault requests by HSMClient method", ("method",)))
+hsmLogins = REGISTRY.register(Counter(
+    "mlaps_hsm_logins_total", "Number of vault logins for hsm tokens by kind and result", ("kind", "result")))
+
+
+"""
+Decorator recording the duration of every call of the decorated method in the given histogram, labeled by its name
+If errors is given, calls returning False are counted in it. If profile is given, the duration is also added to this
+attribute of the profile of the current request, see profiling.RequestProfile
+"""
+def timed(histogram: Histogram, errors: Counter = None, profile: str = None):
+    def decorator(func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                res = func(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                histogram.observe(duration, name)
+                requestProfile = profiling.current() if profile else None
+                if requestProfile is not None:
+                    setattr(requestProfile, profile, getattr(requestProfile, profile) + duration)
+            if errors is not None and res is False:
+                errors.inc(name)
+            return res
+        return inner
+    return decorator
+
+
+_dbCall = threading.local()
+
+
+"""
+Class decorator recording the duration and the number of sql statements of every public method of a dbClient
+Only the outermost call is recorded if a method calls another one. Generators and context managers are left alone,
+their calls return before any query ran
+"""
+def instrumentDB(cls):
+    for name, func in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.isfunction(func) or inspect.isgeneratorfunction(inspect.unwrap(func)):
+            continue
+        setattr(cls, name, _instrumentDBMethod(func))
+    return cls
+
+
+def _instrumentDBMethod(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    def inner(self, *args, **kwargs):
+        if getattr(_dbCall, 'active', False):
+            return func(self, *args, **kwargs)
+        _dbCall.active = True
+        queries = queryCount(self.dbClient)
+        start = time.perf_counter()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            dbLatency.observe(time.perf_counter() - start, name)
+            # negative if the stats have been merged meanwhile
+            dbQueries.inc(name, amount=max(queryCount(self.dbClient) - queries, 0))
+            _dbCall.active = False
+    return inner
+
+
+# pony counts the statements of every thread in its local stats, the entry None is the total
+def queryCount(db) -> int:
+    total = db.local_stats.get(None)
+    return total.db_count if total is not None else 0
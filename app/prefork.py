@@ -0,0 +1,155 @@
+import configparser, logging, os, signal, socket, struct, sys, time
+
+from cheroot.wsgi import Server as WSGIServer
+
+
+class PreforkServer():
+    """
+    Pre-fork process model for the production server. The master binds the listening socket once and forks the given
+    number of workers which all accept on it, so the kernel spreads the connections over the processes and every
+    worker serves its own app with its own cheroot thread pool.
+    The master only supervises, it restarts a worker which died with the same index and forwards SIGTERM and SIGINT.
+    The workers have to serve with serve, so they stop gracefully on these signals.
+    """
+
+    stopSignals = {signal.SIGTERM, signal.SIGINT}
+    # seconds to wait before restarting a worker, so a worker failing on startup doesn't fork in a tight loop
+    restartDelay = 1
+
+    def __init__(self, bindAddr: tuple, workers: int, backlog: int = 128):
+        self.workers = workers
+        self.socket = socket.create_server(bindAddr, backlog=backlog)
+        # pid -> index of the worker
+        self.__children = {}
+        self.__stopping = False
+
+    """
+    Forks the workers and returns the index of the worker, only ever returns in the worker processes
+    The master supervises the workers until it is stopped and exits once all of them exited
+    """
+    def run(self) -> int:
+        for worker in range(self.workers):
+            if self.__spawn(worker):
+                return worker
+        signal.signal(signal.SIGTERM, self.__stop)
+        signal.signal(signal.SIGINT, self.__stop)
+        logging.getLogger('mlaps').info(f"Started {self.workers} workers listening on {self.socket.getsockname()}")
+        while self.__children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            worker = self.__children.pop(pid, None)
+            if worker is None or self.__stopping:
+                continue
+            logging.getLogger('mlaps').warning(f"Worker {worker} (pid {pid}) exited with status {status}, restarting it")
+            time.sleep(self.restartDelay)
+            if not self.__stopping and self.__spawn(worker):
+                return worker
+        self.socket.close()
+        sys.exit(0)
+
+    # returns True in the forked worker and False in the master
+    def __spawn(self, worker: int) -> bool:
+        # a stop signal handled between the fork and registering the worker would miss the worker
+        signal.pthread_sigmask(signal.SIG_BLOCK, self.stopSignals)
+        try:
+            pid = os.fork()
+            if pid == 0:
+                self.__children.clear()
+                # a worker which isn't serving yet has nothing to clean up, serve installs the graceful stop
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                return True
+            self.__children[pid] = worker
+            return False
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, self.stopSignals)
+
+    def __stop(self, signum, frame):
+        self.__stopping = True
+        for pid in list(self.__children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+"""
+Serves with the given server until the process gets SIGTERM or SIGINT, then stops the server gracefully
+The server is only interrupted while serving, so the process exits normally and its atexit handlers run
+"""
+def serve(server: WSGIServer):
+    server.prepare()
+    try:
+        signal.signal(signal.SIGTERM, stopServing)
+        signal.signal(signal.SIGINT, stopServing)
+        server.serve()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+def stopServing(signum, frame):
+    # only the first signal interrupts, the cleanup after it must not be interrupted again
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+class PreboundWSGIServer(WSGIServer):
+    """
+    cheroot server which accepts on the listening socket bound by the master instead of binding its own
+    """
+
+    def __init__(self, listener: socket.socket, wsgi_app, **kwargs):
+        self.__listener = listener
+        super().__init__(listener.getsockname()[:2], wsgi_app, **kwargs)
+
+    def bind(self, family, type, proto=0):
+        self.socket = self.__listener
+
+
+"""
+Creates the cheroot server for the given wsgi app, tuned by the [SERVER] section of the given config
+It accepts on the listener bound by the master if one is given, otherwise it binds bindAddr itself
+"""
+def createServer(config: configparser.ConfigParser, bindAddr: tuple, wsgi_app, listener: socket.socket = None):
+    kwargs = {
+        'numthreads': config.getint("SERVER", "threads", fallback=10),
+        'max': config.getint("SERVER", "max-threads", fallback=-1),
+        # backlog of the listening socket, connections the kernel accepts before a thread of cheroot picks them up
+        'request_queue_size': config.getint("SERVER", "request-queue-size", fallback=5),
+        'timeout': config.getint("SERVER", "timeout", fallback=10),
+        'shutdown_timeout': config.getint("SERVER", "shutdown-timeout", fallback=5),
+        # accepted connections waiting for a free thread, -1 is unbounded
+        'accepted_queue_size': config.getint("SERVER", "accepted-queue-size", fallback=-1),
+        'accepted_queue_timeout': config.getint("SERVER", "accepted-queue-timeout", fallback=10),
+    }
+    server = PreboundWSGIServer(listener, wsgi_app, **kwargs) if listener else WSGIServer(bindAddr, wsgi_app, **kwargs)
+    # 0 is unlimited
+    server.max_request_body_size = config.getint("SERVER", "max-request-body-size", fallback=0)
+    server.max_request_header_size = config.getint("SERVER", "max-request-header-size", fallback=0)
+    return server
+
+
+"""
+Returns the current load of the given server process as a dict
+    threads, busyThreads, maxThreads: worker threads of cheroot, maxThreads is None if unbounded
+    acceptedQueue: accepted connections waiting for a free thread
+    acceptQueue, acceptBacklog: connections waiting in the kernel for an accept on the listening socket and the
+                                size of that backlog, both None if the platform doesn't report them
+"""
+def serverGauges(server: WSGIServer) -> dict:
+    pool = server.requests
+    threads = len(getattr(pool, '_threads', []))
+    acceptQueue = acceptBacklog = None
+    if server.socket is not None and hasattr(socket, 'TCP_INFO'):
+        try:
+            # for a listening socket linux reports the current and the maximum length of its accept queue in the
+            # tcpi_unacked and tcpi_sacked fields of struct tcp_info, which follow 8 bytes and 4 ints
+            info = server.socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 32)
+            acceptQueue, acceptBacklog = struct.unpack_from("II", info, 24)
+        except OSError:
+            pass
+    return {'threads': threads, 'busyThreads': threads - pool.idle, 'maxThreads': server.maxthreads,
+            'acceptedQueue': pool.qsize, 'acceptQueue': acceptQueue, 'acceptBacklog': acceptBacklog}
@@ -0,0 +1,148 @@
+import collections, datetime, logging, os, random, threading, time
+from logging.handlers import RotatingFileHandler
+
+
+class RequestProfile():
+    """
+    Wall time of one request split into the time spent in the database, in vault and rendering templates
+    Only the thread handling the request adds to it, requested is set if the client asked for the profile by the header
+    """
+
+    def __init__(self, method: str, path: str, queries: int = 0, dbTime: float = 0.0, requested: bool = False):
+        self.method = method
+        self.path = path
+        self.requested = requested
+        self.time = datetime.datetime.now()
+        self.start = time.perf_counter()
+        self.total = None
+        self.status = None
+        self.vault = 0.0
+        self.template = 0.0
+        # pony's totals of this thread when the request started, the request's share is their difference at the end
+        self.__queries = queries
+        self.__dbTime = dbTime
+        self.queries = 0
+        self.db = 0.0
+        self.__templateStart = None
+
+    def finish(self, status: int, queries: int = 0, dbTime: float = 0.0):
+        self.total = time.perf_counter() - self.start
+        self.status = status
+        self.queries = max(queries - self.__queries, 0)
+        self.db = max(dbTime - self.__dbTime, 0.0)
+
+    def templateStarted(self):
+        self.__templateStart = time.perf_counter()
+
+    def templateRendered(self):
+        if self.__templateStart is not None:
+            self.template += time.perf_counter() - self.__templateStart
+            self.__templateStart = None
+
+    """
+    Returns the profile as value of a Server-Timing header, shown by the developer tools of the browsers
+    """
+    def serverTiming(self) -> str:
+        return ", ".join(f"{name};dur={duration * 1000:.1f}" for name, duration in
+                         (("db", self.db), ("vault", self.vault), ("template", self.template), ("total", self.total)))
+
+    def __str__(self):
+        return (f"{self.method} {self.path} {self.status} took {self.total * 1000:.0f}ms: db {self.db * 1000:.0f}ms "
+                f"({self.queries} queries), vault {self.vault * 1000:.0f}ms, template {self.template * 1000:.0f}ms")
+
+
+_local = threading.local()
+
+
+"""
+Returns the profile of the request the current thread handles or None if it isn't profiled
+"""
+def current():
+    return getattr(_local, 'profile', None)
+
+
+# receivers of flask's before_render_template and template_rendered signals
+def templateStarted(sender, template, context, **extra):
+    profile = current()
+    if profile is not None:
+        profile.templateStarted()
+
+
+def templateRendered(sender, template, context, **extra):
+    profile = current()
+    if profile is not None:
+        profile.templateRendered()
+
+
+class Profiler():
+    """
+    Opt-in profiling of requests, a request is profiled if it is sampled or if it sends the profiling header and the
+    client is authorized to profile, only the latter get their profile back (see RequestProfile.requested).
+    Profiled requests taking at least slowThreshold seconds are written to the slow log, a file next to the app log,
+    and the latest slowLogSize of them are kept for the admin page
+    parameters:
+        db: the pony database whose per thread query stats give the db time and the number of sql statements
+        sampleRate: share of the requests which are profiled, 0 profiles none
+        header: name of the request header which enables profiling for the request, None to ignore any header
+    """
+
+    def __init__(self, db=None, sampleRate: float = 0.0, header: str = None, slowThreshold: float = 1.0,
+                 slowLogSize: int = 100, logFolder: str = None):
+        self.db = db
+        self.sampleRate = sampleRate
+        self.header = header
+        self.slowThreshold = slowThreshold
+        self.__slow = collections.deque(maxlen=slowLogSize)
+        self.__slowLogger = logging.getLogger('mlaps.slow')
+        # the slow log only goes to its own file, not to the app log
+        self.__slowLogger.propagate = False
+        if logFolder and not self.__slowLogger.handlers:
+            handler = RotatingFileHandler(os.path.join(logFolder, "slow.log"), encoding='utf8', maxBytes=100000,
+                                          backupCount=1)
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+            self.__slowLogger.addHandler(handler)
+
+    @property
+    def enabled(self) -> bool:
+        return self.sampleRate > 0 or self.header is not None
+
+    """
+    Starts profiling the request of the current thread if it is sampled or sent the header
+    authorized returns whether the client may enable profiling by the header, it is only called if the header is sent
+    and every client may if it is None
+    Returns the profile or None if the request isn't profiled
+    """
+    def begin(self, method: str, path: str, headers, authorized=None) -> RequestProfile:
+        _local.profile = None
+        requested = self.header is not None and bool(headers.get(self.header)) and (authorized is None or authorized())
+        if not requested and not (self.sampleRate > 0 and random.random() < self.sampleRate):
+            return None
+        _local.profile = RequestProfile(method, path, *self.__dbStats(), requested=requested)
+        return _local.profile
+
+    """
+    Finishes the profile of the request of the current thread and records it if it was slow
+    Returns the finished profile or None if the request wasn't profiled
+    """
+    def end(self, status: int) -> RequestProfile:
+        profile = current()
+        if profile is None:
+            return None
+        _local.profile = None
+        profile.finish(status, *self.__dbStats())
+        if profile.total >= self.slowThreshold:
+            self.__slow.append(profile)
+            self.__slowLogger.warning(str(profile))
+        return profile
+
+    """
+    Returns the latest slow requests of this process, the newest first
+    """
+    def slowRequests(self) -> list:
+        return list(reversed(self.__slow))
+
+    def __dbStats(self) -> tuple:
+        total = self.db.local_stats.get(None) if self.db is not None else None
+        if total is None or not total.db_count:
+            return 0, 0.0
+        return total.db_count, total.sum_time
@@ -0,0 +1,248 @@
+import abc, collections, heapq, json, logging, sqlite3, threading, time
+
+import dbClient
+
+
+class SessionStore(abc.ABC):
+    """
+    Key value store with an expiry for every entry, for the short-lived state which has to be shared by all server
+    processes (update sessions, share links and pending enrollments). Entries are grouped by a namespace, values must be json serializable
+    Expired entries are never returned, get and pop return None for them just like for unknown keys. They are only
+    removed by sweep, which is run by the scheduler. maxSize applies to every namespace on its own, if a namespace
+    has more entries, its ones expiring the soonest are evicted. So a flood of update sessions never evicts share links
+    or pending enrollments
+    """
+
+    def __init__(self, maxSize: int = None):
+        self.maxSize = maxSize
+        # number of entries removed by sweep since the start, because they expired or because of maxSize
+        self.swept = 0
+        self.evicted = 0
+
+    """
+    Stores the value under the key until ttl seconds from now, replacing an existing entry
+    Returns whether the value was stored
+    """
+    @abc.abstractmethod
+    def set(self, namespace: str, key: str, value, ttl: float) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def get(self, namespace: str, key: str):
+        pass
+
+    @abc.abstractmethod
+    def pop(self, namespace: str, key: str):
+        pass
+
+    """
+    Removes all expired entries and returns their number
+    """
+    @abc.abstractmethod
+    def sweep(self) -> int:
+        pass
+
+    """
+    Returns the number of live and of expired, not yet swept entries as a tuple
+    """
+    @abc.abstractmethod
+    def count(self) -> tuple:
+        pass
+
+    def stats(self) -> dict:
+        live, expired = self.count()
+        return {'live': live, 'expired': expired, 'swept': self.swept, 'evicted': self.evicted,
+                'maxSize': self.maxSize}
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Keeps the entries in a dict of this process, only usable if the app runs in a single process
+    A heap per namespace ordered by the expiry indexes the entries, so sweeping and evicting never scan the whole dict.
+    Replaced or popped entries leave stale heap items behind, which are skipped and dropped once they're on top
+    """
+
+    def __init__(self, maxSize: int = None):
+        super().__init__(maxSize)
+        # (namespace, key) -> (expires, value)
+        self.__entries = {}
+        # namespace -> heap of (expires, key), an item is stale if the entry is gone or has another expiry
+        self.__expiries = collections.defaultdict(list)
+        # namespace -> number of entries
+        self.__sizes = collections.Counter()
+        self.__lock = threading.Lock()
+
+    def set(self, namespace, key, value, ttl) -> bool:
+        expires = time.time() + ttl
+        with self.__lock:
+            if (namespace, key) not in self.__entries:
+                while self.maxSize and self.__sizes[namespace] >= self.maxSize and self.__popSoonest(namespace):
+                    self.evicted += 1
+                self.__sizes[namespace] += 1
+            self.__entries[(namespace, key)] = (expires, value)
+            expiries = self.__expiries[namespace]
+            heapq.heappush(expiries, (expires, key))
+            # rebuild the heap once the stale items outnumber the entries of the namespace
+            if len(expiries) > 2 * self.__sizes[namespace] + 64:
+                expiries[:] = [(expires, entry[1]) for entry, (expires, _) in self.__entries.items()
+                               if entry[0] == namespace]
+                heapq.heapify(expiries)
+        return True
+
+    def get(self, namespace, key):
+        with self.__lock:
+            entry = self.__entries.get((namespace, key))
+        return entry[1] if entry and entry[0] > time.time() else None
+
+    def pop(self, namespace, key):
+        with self.__lock:
+            entry = self.__entries.pop((namespace, key), None)
+            if entry is not None:
+                self.__sizes[namespace] -= 1
+        return entry[1] if entry and entry[0] > time.time() else None
+
+    def sweep(self) -> int:
+        now = time.time()
+        swept = 0
+        with self.__lock:
+            for namespace, expiries in self.__expiries.items():
+                while expiries and expiries[0][0] <= now:
+                    expires, key = heapq.heappop(expiries)
+                    entry = self.__entries.get((namespace, key))
+                    if entry is not None and entry[0] == expires:
+                        del self.__entries[(namespace, key)]
+                        self.__sizes[namespace] -= 1
+                        swept += 1
+            self.swept += swept
+        return swept
+
+    def count(self) -> tuple:
+        now = time.time()
+        with self.__lock:
+            expired = sum(1 for expires, _ in self.__entries.values() if expires <= now)
+            return len(self.__entries) - expired, expired
+
+    # removes the entry of the namespace expiring the soonest, returns False if it has no entry, the lock must be held
+    def __popSoonest(self, namespace: str) -> bool:
+        expiries = self.__expiries[namespace]
+        while expiries:
+            expires, key = heapq.heappop(expiries)
+            entry = self.__entries.get((namespace, key))
+            if entry is not None and entry[0] == expires:
+                del self.__entries[(namespace, key)]
+                self.__sizes[namespace] -= 1
+                return True
+        return False
+
+
+class DBSessionStore(SessionStore):
+    """
+    Keeps the entries in the Session table of the mysql database, shared by all processes and nodes
+    """
+
+    def __init__(self, mysql_conx: dbClient.dbClient, maxSize: int = None):
+        super().__init__(maxSize)
+        self.__mysql = mysql_conx
+
+    def set(self, namespace, key, value, ttl) -> bool:
+        return self.__mysql.setSession(namespace, key, json.dumps(value), ttl)
+
+    def get(self, namespace, key):
+        value = self.__mysql.getSession(namespace, key)
+        return json.loads(value) if value is not None else None
+
+    def pop(self, namespace, key):
+        value = self.__mysql.popSession(namespace, key)
+        return json.loads(value) if value is not None else None
+
+    # maxSize is only enforced here, by every node sweeping the table
+    def sweep(self) -> int:
+        res = self.__mysql.sweepSessions(self.maxSize)
+        if not res:
+            return 0
+        self.swept += res[0]
+        self.evicted += res[1]
+        return res[0]
+
+    def count(self) -> tuple:
+        return self.__mysql.countSessions() or (0, 0)
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    Keeps the entries in a sqlite file, shared by all processes of one node
+    Stand-in for a shared key value store if the app runs in several processes, but on a single node
+    """
+
+    def __init__(self, path: str, maxSize: int = None):
+        super().__init__(maxSize)
+        self.path = path
+        self.__local = threading.local()
+        with self.__connection() as con:
+            con.execute("CREATE TABLE IF NOT EXISTS sessions (namespace TEXT NOT NULL, key TEXT NOT NULL, "
+                        "value TEXT NOT NULL, expires REAL NOT NULL, PRIMARY KEY (namespace, key))")
+            con.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+
+    def set(self, namespace, key, value, ttl) -> bool:
+        try:
+            with self.__connection() as con:
+                con.execute("INSERT OR REPLACE INTO sessions (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+                            (namespace, key, json.dumps(value), time.time() + ttl))
+            return True
+        except sqlite3.Error as e:
+            logging.getLogger('mlaps').error(e)
+            return False
+
+    def get(self, namespace, key):
+        row = self.__connection().execute("SELECT value FROM sessions WHERE namespace = ? AND key = ? AND expires > ?",
+                                          (namespace, key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def pop(self, namespace, key):
+        with self.__connection() as con:
+            # locks the file before reading, so only one process gets the entry
+            con.execute("BEGIN IMMEDIATE")
+            row = con.execute("SELECT value, expires FROM sessions WHERE namespace = ? AND key = ?",
+                              (namespace, key)).fetchone()
+            con.execute("DELETE FROM sessions WHERE namespace = ? AND key = ?", (namespace, key))
+        return json.loads(row[0]) if row and row[1] > time.time() else None
+
+    # maxSize is only enforced here, evicting the entries of every namespace expiring the soonest
+    def sweep(self) -> int:
+        with self.__connection() as con:
+            swept = con.execute("DELETE FROM sessions WHERE expires <= ?", (time.time(),)).rowcount
+            evicted = 0
+            if self.maxSize:
+                evicted = con.execute("DELETE FROM sessions WHERE rowid IN (SELECT rowid FROM (SELECT rowid, row_number() "
+                                      "OVER (PARTITION BY namespace ORDER BY expires DESC) AS n FROM sessions) WHERE n > ?)",
+                                      (self.maxSize,)).rowcount
+        self.swept += swept
+        self.evicted += evicted
+        return swept
+
+    def count(self) -> tuple:
+        total, expired = self.__connection().execute("SELECT count(*), coalesce(sum(expires <= ?), 0) FROM sessions",
+                                                      (time.time(),)).fetchone()
+        return total - expired, expired
+
+    # one connection per thread, a connection used as context manager commits or rolls back its transaction
+    def __connection(self) -> sqlite3.Connection:
+        con = getattr(self.__local, 'con', None)
+        if con is None:
+            con = self.__local.con = sqlite3.connect(self.path, timeout=10)
+            con.execute("PRAGMA journal_mode=WAL")
+        return con
+
+
+"""
+Creates the session store of the given backend (memory, mysql or sqlite)
+"""
+def createSessionStore(backend: str, mysql_conx: dbClient.dbClient = None, sqlitePath: str = None,
+                       maxSize: int = None) -> SessionStore:
+    if backend == "mysql":
+        return DBSessionStore(mysql_conx, maxSize)
+    if backend == "sqlite":
+        return SqliteSessionStore(sqlitePath, maxSize)
+    if backend != "memory":
+        logging.getLogger('mlaps').warning(f"Unknown session store backend {backend}, falling back to memory")
+    return MemorySessionStore(maxSize)
@@ -1,15 +1,49 @@
 #!/PATH/TO/YOUR/PYTHON3
-import functools
-import os, logging, Controller, sys, base64, customSessionInterface, distinguishedname
-from flask_oidc import OpenIDConnect
-from flask import Flask, request, jsonify, make_response, send_from_directory, render_template, Response, session
-import flask_wtf.csrf
-from cheroot.wsgi import Server as WSGIServer, PathInfoDispatcher
-from markupsafe import Markup
+# only light imports here, the listener is bound before flask and the controller are imported, see startup.StartupApp
+import os, sys, prefork, startup
+from cheroot.wsgi import PathInfoDispatcher
+
+
+"""
+Returns the wrapper for checking if the logged-in user has the correct role assigned (webaccess-mlaps)
+getUser returns the info of the logged-in user, None if nobody is logged in
+If the user has the correct role, the called function gets executed
+If the user is doesn't have the role, the wrapper returns Not Authorized and the called function doesn't get executed
+The wrapper only runs if it is applied below @app.route, flask registers the function app.route is applied to
+"""
+def permissionRequired(getUser):
+    import functools, logging
+
+    def checkPermission(func):
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            user = getUser()
+            logging.getLogger('mlaps').debug(user)
+            if isAdmin(user): return func(*args, **kwargs)
+            return "Not Authorized"
+        return inner
+    return checkPermission
+
+
+# returns whether the given oidc user info is of a logged in user with the admin role
+def isAdmin(user) -> bool:
+    return user is not None and user["groups"] is not None and 'webaccess_mlaps' in user['groups']
+
+
+"""
+Builds the flask app with all routes on the given initialised controller
+parameters:
+    worker: index of this worker process, shown on the admin page
+    server: the cheroot server of this worker whose load is shown on the admin page, None for the development server
+"""
+def createApp(contr, secretKey: bytes, devmode: bool, worker: int = 0, server=None):
+    import logging, base64, customSessionInterface, distinguishedname, time, metrics, profiling
+    from flask_oidc import OpenIDConnect
+    from flask import Flask, request, jsonify, make_response, send_from_directory, render_template, Response, session, url_for, g, \
+        before_render_template, template_rendered
+    import flask_wtf.csrf
+    from markupsafe import Markup
 
-if __name__ == "__main__":
-    devmode = '-dev' in list(sys.argv)
-    contr = Controller.Controller()
     app = Flask(__name__)
     companyName = contr.getCompanyName()
     #use customsessioninterface to not send cookies on api calls
@@ -17,7 +51,7 @@ if __name__ == "__main__":
 
     app.config.update(
         {
-            "SECRET_KEY": os.urandom(24),
+            "SECRET_KEY": secretKey,
             "OIDC_COOKIE_SECURE": True,
             "OIDC_CLIENT_SECRETS": "app/secrets.json",
             "OIDC_ID_TOKEN_COOKIE_SECURE": True,
@@ -38,6 +72,30 @@ if __name__ == "__main__":
     oidc = OpenIDConnect(app)
     csrf = flask_wtf.CSRFProtect(app)
 
+    # record the duration of every request by route for /metrics, and profile the sampled requests and the ones of
+    # admins sending the profiling header, see profiling.Profiler
+    @app.before_request
+    def startRequestTimer():
+        g.requestStart = time.perf_counter()
+        contr.profiler.begin(request.method, request.path, request.headers,
+                             authorized=lambda: isAdmin(get_oidc_user_info()))
+
+    @app.after_request
+    def recordRequest(response):
+        start = g.get('requestStart')
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            metrics.requestLatency.observe(time.perf_counter() - start, route, request.method, response.status_code)
+        profile = contr.profiler.end(response.status_code)
+        # only the admins asking for it get the timings, sampled profiles are only recorded
+        if profile is not None and profile.requested:
+            response.headers['Server-Timing'] = profile.serverTiming()
+        return response
+
+    if contr.profiler.enabled:
+        before_render_template.connect(profiling.templateStarted, app)
+        template_rendered.connect(profiling.templateRendered, app)
+
 
     def get_oidc_user_info() -> dict:
         if oidc.user_loggedin:
@@ -48,20 +106,7 @@ if __name__ == "__main__":
         else:
             return None
 
-    """
-    Wrapper for checking if the logged-in user has the correct role assigned (webaccess-mlaps)
-    If the user has the correct role, the called function gets executed
-    If the user is doesn't have the role, the wrapper returns Not Authorized and the called function doesn't get executed
-    """
-    def checkPermission(func):
-        @functools.wraps(func)
-        def inner(*args, **kwargs):
-            user = get_oidc_user_info()
-            logging.getLogger('mlaps').debug(user)
-            if user["groups"] is None: return "Not Authorized"
-            if 'webaccess_mlaps' in user['groups']: return func(*args, **kwargs)
-            return "Not Authorized"
-        return inner
+    checkPermission = permissionRequired(get_oidc_user_info)
 
     #Returns the favicon in the app/static folder called LAPS.ico
     @app.route('/favicon.ico')
@@ -85,6 +130,14 @@ if __name__ == "__main__":
     def healthCheck():
         return "pong"
 
+    """
+    Returns the request, database and vault metrics of this worker in the prometheus text format
+    Requires no authentication, like the healthcheck
+    """
+    @app.route("/metrics", methods=['GET'])
+    def handleMetrics():
+        return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
     """
     Handles the index call of the website
     Requires a valid client SSL certificate and the correct oidc role
@@ -96,7 +149,39 @@ if __name__ == "__main__":
     def home():
         # returning a response
         return contr.handleIndex(sort_col=request.args.get('sort', default='mid', type=str),
-                                            directionReverse=request.args.get('direction', default='asc', type=str))
+                                            directionReverse=request.args.get('direction', default='asc', type=str),
+                                            search=request.args.get('search', default='', type=str),
+                                            page=request.args.get('page', default=1, type=int))
+
+    """
+    Handles the htmx call to fetch a page of the machine table
+    Requires a valid client SSL certificate and the correct oidc role
+    Returns the rendered table page with its pagination in plain html
+    """
+    @app.route("/api/machineTable", methods=['GET'])
+    @oidc.require_login
+    @checkPermission
+    def handleMachineTable():
+        return contr.handleGetMachineTable(sort_col=request.args.get('sort', default='mid', type=str),
+                                           direction=request.args.get('direction', default='asc', type=str),
+                                           search=request.args.get('search', default='', type=str),
+                                           page=request.args.get('page', default=1, type=int))
+
+    """
+    Handles the htmx call to fetch the log tail of the admin page, filtered by level, text and time
+    Requires a valid client SSL certificate and the correct oidc role
+    Returns the rendered log table, or only its older rows for before and its new rows for after in plain html
+    """
+    @app.route("/api/logTail", methods=['GET'])
+    @oidc.require_login
+    @checkPermission
+    def handleLogTail():
+        return contr.handleLogTail(level=request.args.get('level', default='', type=str),
+                                   search=request.args.get('search', default='', type=str),
+                                   since=request.args.get('since', default='', type=str),
+                                   before=request.args.get('before', default=None, type=int),
+                                   after=request.args.get('after', default=None, type=int),
+                                   pid=request.args.get('pid', default=None, type=int))
 
     """
     Handles the access log call
@@ -109,7 +194,27 @@ if __name__ == "__main__":
     def handle_access_log():
         # returning a response
         return contr.handleAccessLog(sort_col=request.args.get('sort', default='aid', type=str),
-                                             directionReverse=request.args.get('direction', default='asc', type=str))
+                                             directionReverse=request.args.get('direction', default='asc', type=str),
+                                             search=request.args.get('search', default='', type=str),
+                                             dateFrom=request.args.get('from', default='', type=str),
+                                             dateTo=request.args.get('to', default='', type=str),
+                                             page=request.args.get('page', default=1, type=int))
+
+    """
+    Handles the htmx call to fetch a page of the access log table
+    Requires a valid client SSL certificate and the correct oidc role
+    Returns the rendered table page with its pagination in plain html
+    """
+    @app.route("/api/accessLogTable", methods=['GET'])
+    @oidc.require_login
+    @checkPermission
+    def handleAccessLogTable():
+        return contr.handleGetAccessLogTable(sort_col=request.args.get('sort', default='aid', type=str),
+                                             direction=request.args.get('direction', default='asc', type=str),
+                                             search=request.args.get('search', default='', type=str),
+                                             dateFrom=request.args.get('from', default='', type=str),
+                                             dateTo=request.args.get('to', default='', type=str),
+                                             page=request.args.get('page', default=1, type=int))
 
     """
     Handles the api call to enroll a machine
@@ -117,6 +222,7 @@ if __name__ == "__main__":
     Is also exempted from csrf protection, since this is a "public" endpoint
     Expects json input, {"csr":csr(encoded in base64, utf-8), "hn":hostname, "sn":serialnumber}
     Returns ether a new machine certificate or an error with information why the enrollment failed in a simple http response
+    If the signing takes longer than the configured wait time, 202 is returned with the enrollment id and the url to poll
     """
     @csrf.exempt
     @app.route('/api/enroll', methods=['POST'])
@@ -126,14 +232,30 @@ if __name__ == "__main__":
         csr = base64.b64decode(csr_bencoded).decode('UTF-8')
         serialnumber = json_data["sn"]
         hostname = json_data["hn"]
-        res = contr.handleEnrollClient(csr,hostname,serialnumber)
-        if not res.startswith("Failed"):
-            resp = make_response(jsonify({"response": res}), 200)
-            resp.headers['Content-Type'] = 'application/json'
-        else:
-            resp = make_response(jsonify({"response": res}), 400)
-            resp.headers['Content-Type'] = 'application/json'
+        return enrollResponse(contr.handleEnrollClient(csr,hostname,serialnumber))
 
+    """
+    Handles the poll of an enrollment which was answered with 202
+    Doesnt require any authentication or authorization
+    Returns the same responses as the enroll call, or 404 if the enrollment is unknown or its result expired
+    """
+    @app.route('/api/enroll/<enrollID>', methods=['GET'])
+    def handle_enroll_status(enrollID):
+        res = contr.handleEnrollStatus(enrollID)
+        if res is None:
+            return make_response(jsonify({"response": "Enrollment not found"}), 404)
+        return enrollResponse(res)
+
+    def enrollResponse(res: list) -> Response:
+        if res[0] is True:
+            resp = make_response(jsonify({"response": res[1]}), 200)
+        elif res[0] is None:
+            resp = make_response(jsonify({"response": "pending", "enrollID": res[1],
+                                          "poll": url_for('handle_enroll_status', enrollID=res[1])}), 202)
+            resp.headers['Retry-After'] = '2'
+        else:
+            resp = make_response(jsonify({"response": res[1]}), 400)
+        resp.headers['Content-Type'] = 'application/json'
         return resp
 
     """
@@ -151,11 +273,11 @@ if __name__ == "__main__":
         serialnumber = json_data["sn"]
         hostname = json_data["hn"]
         parsedDN = distinguishedname.string_to_dn(request.headers.get("ssl-client", "dnNotFound"))
-        logging.getLogger('mlaps').debug(f"parsed dn from cert: {parsedDN}")
+        logging.getLogger('mlaps').debug("parsed dn from cert: %s", parsedDN)
         if not parsedDN: return "Failed to read certificate correctly", 410
         uid: str = next((dnPart[3:] for dnPart in sum(parsedDN, []) if dnPart.startswith("CN=")), ("uidNotFound"))
         if uid == "uidNotFound": return "Failed to read uid from certificate", 411
-        logging.getLogger('mlaps').debug(f"handling checkin for uuid: {uid}")
+        logging.getLogger('mlaps').debug("handling checkin for uuid: %s", uid)
         res: list = contr.handleCheckin(uid, hostname, serialnumber)
         logging.getLogger('mlaps').debug(res)
         if res[0] == True:
@@ -224,9 +346,9 @@ if __name__ == "__main__":
     Requires also a json input in the format {"mid":uuid} or {"pwid":uuid}
     Returns a bootstrap modal in plain html with the decrypted password
     """
+    @app.route('/api/getPassword', methods=['GET'])
     @oidc.require_login
     @checkPermission
-    @app.route('/api/getPassword', methods=['GET'])
     def handleShowPassword() -> str:
         pw: str = contr.handleGetPassword(admin_name=get_oidc_user_info()['username'], mid=request.args.get('mid', default=""),
                                           pwid=request.args.get('pwid', default=""))
@@ -239,9 +361,9 @@ if __name__ == "__main__":
     Requires also a json input in the format {"mid":uuid} or {"pwid":uuid}
     Returns a bootstrap toast in plain html with the confirmation or error message why it failed
     """
+    @app.route('/api/expirePassword', methods=['GET'])
     @oidc.require_login
     @checkPermission
-    @app.route('/api/expirePassword', methods=['GET'])
     def handleExpireNow() -> str:
         msg: str = contr.handleExpireNowButton(mid=request.args.get('mid', default=""),
                                                pwid=request.args.get('pwid', default=""))
@@ -254,9 +376,9 @@ if __name__ == "__main__":
     Requires 
     Returns a bootstrap toast in plain html with 
     """
+    @app.route('/api/disableMachine', methods=['GET'])
     @oidc.require_login
     @checkPermission
-    @app.route('/api/disableMachine', methods=['GET'])
     def handleDisableMachine() -> str:
         msg: str = contr.handleDisableMachine(request.args.get('mid'))
         resp: str = render_template("toast.html", body=msg)
@@ -267,9 +389,9 @@ if __name__ == "__main__":
     Requires a valid client ssl certificate and correct oidc role
     Returns a modal with a input field
     """
+    @app.route('/api/createSharelinkPassword', methods=['GET'])
     @oidc.require_login
     @checkPermission
-    @app.route('/api/createSharelinkPassword', methods=['GET'])
     def handleCreateShareLinkPassword() -> str:
         return render_template("admin_sharelink_modal.html", mid=request.args.get('mid'))
 
@@ -278,13 +400,16 @@ if __name__ == "__main__":
     Requires a valid client ssl certificate and correct oidc role
     Returns a modal with the generated link
     """
-    @oidc.require_login
-    @checkPermission
     @csrf.exempt
     @app.route('/api/createSharelink', methods=['POST'])
+    @oidc.require_login
+    @checkPermission
     def handleCreateShareLink() -> Response:
         link = contr.handleCreateShareLink(request.form['mid'], request.form['password'],get_oidc_user_info()['username'])
-        resp = make_response(render_template("modal.html", title="Sharable link", body=f"https://{request.host}/share_password?rid={link}"))
+        if link is None:
+            resp = make_response(render_template("modal.html", title="Sharable link", body="Failed to store the share link, try again later"))
+        else:
+            resp = make_response(render_template("modal.html", title="Sharable link", body=f"https://{request.host}/share_password?rid={link}"))
         resp.headers['HX-Trigger'] = 'closeModal'
         return resp
 
@@ -322,20 +447,63 @@ if __name__ == "__main__":
     Requires a valid client ssl certificate and correct oidc role
     Returns a bootstrap toast with raw html
     """
+    @app.route('/api/disableUnenrolledMachines', methods=['GET'])
     @oidc.require_login
     @checkPermission
-    @app.route('/api/disableUnenrolledMachines', methods=['GET'])
     def handleDisableUnenrolledMachines():
-        msg = contr.handleDisableUnenrolledMachines()
+        msg = contr.handleDisableUnenrolledMachines(request.args.get('min-age-days', default=0, type=int))
         resp = render_template("toast.html", body=msg)
         return resp
 
     """
-    
+    Handle the api call to disable all machines selected in the machine table
+    Requires a valid client ssl certificate and correct oidc role
+    Returns a bootstrap toast with raw html
     """
+    @app.route('/api/bulkDisableMachines', methods=['POST'])
     @oidc.require_login
     @checkPermission
+    def handleBulkDisableMachines():
+        msg = contr.handleBulkDisableMachines(request.form.getlist('mid'))
+        resp = render_template("toast.html", body=msg)
+        return resp
+
+    """
+    Handle the api call to expire the passwords of all machines selected in the machine table
+    Requires a valid client ssl certificate and correct oidc role
+    Returns a bootstrap toast with raw html
+    """
+    @app.route('/api/bulkExpirePasswords', methods=['POST'])
+    @oidc.require_login
+    @checkPermission
+    def handleBulkExpirePasswords():
+        msg = contr.handleBulkExpirePasswords(request.form.getlist('mid'))
+        resp = render_template("toast.html", body=msg)
+        return resp
+
+    """
+    Handle the api call to export the latest passwords of all machines selected in the machine table
+    Requires a valid client ssl certificate and correct oidc role
+    Returns a csv file with the decrypted passwords, every exported password is recorded in the access log
+    """
+    @app.route('/api/exportPasswords', methods=['POST'])
+    @oidc.require_login
+    @checkPermission
+    def handleExportPasswords():
+        export = contr.handleExportPasswords(get_oidc_user_info()['username'], request.form.getlist('mid'))
+        if export is None:
+            return make_response("Invalid machine id supplied", 400)
+        resp = make_response(export)
+        resp.headers['Content-Type'] = 'text/csv'
+        resp.headers['Content-Disposition'] = 'attachment; filename=mlaps-passwords.csv'
+        return resp
+
+    """
+    
+    """
     @app.route('/detailedMachine', methods=['GET'])
+    @oidc.require_login
+    @checkPermission
     def handleDetailedMachine():
         args = request.args.to_dict()
         if "mid" not in args:
@@ -348,24 +516,51 @@ if __name__ == "__main__":
     """
 
     """
+    @app.route('/admin', methods=['GET'])
     @oidc.require_login
     @checkPermission
-    @app.route('/admin', methods=['GET'])
     def handleAdminPage():
-        db, vault, log = contr.handleAdmin()
-        return make_response(render_template("admin.html", dbconnection=db, vaultconnection=vault, log=log))
+        db, vault, sessions, slow, machineCache = contr.handleAdmin()
+        # the load of the cheroot server of this worker, the development server has none
+        gauges = prefork.serverGauges(server) if server else None
+        return make_response(render_template("admin.html", dbconnection=db, vaultconnection=vault,
+                                             sessions=sessions, server=gauges, worker=worker, slow=slow,
+                                             machineCache=machineCache))
 
 
     logging.getLogger('mlaps').info("Server initialized")
+    return app
+
+
+if __name__ == "__main__":
+    devmode = '-dev' in list(sys.argv)
+    serverConfig = startup.readConfig(devmode)
+    bindAddr = (serverConfig.get("SERVER", "host", fallback="0.0.0.0"), serverConfig.getint("SERVER", "port", fallback=8080))
+    workers = 1 if devmode else serverConfig.getint("SERVER", "workers", fallback=1)
+    # the secret key is created before forking, sessions and csrf tokens have to be valid in every worker
+    secretKey = os.urandom(24)
+    # with several workers the process forks here, everything below runs in every worker with its own controller
+    master = prefork.PreforkServer(bindAddr, workers, serverConfig.getint("SERVER", "request-queue-size", fallback=5)) \
+        if workers > 1 else None
+    worker = master.run() if master else 0
 
     if devmode:
+        import Controller
+        app = createApp(Controller.Controller(worker, workers), secretKey, devmode)
         app.run(host="0.0.0.0", debug=True, port=8080)  # to allow for debugging and auto-reload
     else:
-        d = PathInfoDispatcher({'/': app})
-        server = WSGIServer(('0.0.0.0', 8080), d)
-        try:
-            server.start()
-        except KeyboardInterrupt:
-            server.stop()
+        # the listener is bound and answers /ping right away, the controller and the app are built in the background
+        # and /ready answers 200 once they are, all other requests get a 503 until then
+        startupApp = startup.StartupApp(serverConfig.getint("SERVER", "startup-retry-after", fallback=5))
+        server = prefork.createServer(serverConfig, bindAddr, PathInfoDispatcher({'/': startupApp}),
+                                      master.socket if master else None)
+
+        def initialize():
+            import Controller
+            return createApp(Controller.Controller(worker, workers), secretKey, devmode, worker, server)
+
+        startupApp.initialize(initialize, server)
+        # stops gracefully on SIGTERM and SIGINT, so the buffered checkins are flushed by the atexit handler
+        prefork.serve(server)
     #app.run(host="localhost", debug=True, port=8050,ssl_context=('web.crt', 'web.key'))  # to allow for debugging and auto-reload
 
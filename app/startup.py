@@ -0,0 +1,62 @@
+import configparser, logging, threading, time
+
+
+"""
+Reads the config, the development config in development mode
+"""
+def readConfig(devmode: bool) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read('app/config-dev.ini' if devmode else 'app/config.ini')
+    return config
+
+
+class StartupApp():
+    """
+    WSGI app which is served as soon as the listener is bound, while the real app is still initialised in the
+    background (importing flask, pony, hvac etc., waiting for the hsm secret and logging in to the hsm)
+    /ping always answers, so the process counts as alive right away. /ready answers 503 until the app is initialised
+    and 200 afterwards, all other requests get a 503 with a Retry-After header until then and are passed to the app
+    once it is ready.
+    """
+
+    def __init__(self, retryAfter: int = 5):
+        self.retryAfter = retryAfter
+        self.app = None
+        self.startedAt = time.monotonic()
+        # seconds from the creation until the app was ready
+        self.startupTime = None
+
+    """
+    Builds the app with the given function in a background thread and serves it once it is built
+    If building the app fails, the given cheroot server is interrupted with the error, so the process exits
+    """
+    def initialize(self, build, server=None):
+        def run():
+            try:
+                app = build()
+            except Exception as e:
+                logging.getLogger('mlaps').exception(f"Failed to initialise the app: {e}")
+                if server is not None:
+                    server.interrupt = e
+                return
+            self.startupTime = time.monotonic() - self.startedAt
+            self.app = app
+            logging.getLogger('mlaps').info(f"App is ready after {self.startupTime:.2f} seconds")
+        threading.Thread(target=run, name="startup", daemon=True).start()
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == '/ping':
+            return self.__respond(start_response, '200 OK', b"pong")
+        app = self.app
+        if path == '/ready':
+            return self.__respond(start_response, '200 OK', b"ready") if app is not None else \
+                self.__respond(start_response, '503 Service Unavailable', b"starting")
+        if app is None:
+            return self.__respond(start_response, '503 Service Unavailable', b"starting",
+                                  [('Retry-After', str(self.retryAfter))])
+        return app(environ, start_response)
+
+    def __respond(self, start_response, status: str, body: bytes, headers: list = None):
+        start_response(status, [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))] + (headers or []))
+        return [body]
@@ -3,14 +3,13 @@ import logging
 import uuid
 
 from flask_table import Table, Col, DatetimeCol, LinkCol
+from flask_table.html import element
 from flask import url_for
+from markupsafe import Markup
 import dbClient
 
 
 class TableBuilder():
-    # sorts the passed items according to the passed sort column with the given reverse order
-    def get_sorted_by(self, items, sort, reverse: bool = False):
-        return sorted(items, key=lambda x: getattr(x, sort), reverse=reverse)
     """
     Needs a database connection to pull the data to populate the tables
     """
@@ -18,30 +17,76 @@ class TableBuilder():
         self.mysql = mysql_conx
 
     """
-    Renders a html table filled with all enrolled machines in the given order and sorting
+    Renders one page of the html table filled with all recorded password decryptions in the given order and sorting
+    Sorting, filtering and paging are done by the database, returns the table and its pagination
+    dateFrom and dateTo are both inclusive dates
     """
-    def getAccessTable(self, sort_by='aid',sort_reverse=False):
-        # gets all recorded password access from the database
-        data = self.mysql.getAccessLog()
+    def getAccessTable(self, sort_by='aid', sort_reverse=False, search='', dateFrom: datetime.date = None,
+                       dateTo: datetime.date = None, page=1, pageSize=50):
+        # gets one page of the recorded password access from the database
+        res = self.mysql.getAccessLogPage(sort_by=sort_by, sort_reverse=(sort_reverse == 'desc'), search=search,
+                                          dateFrom=datetime.datetime.combine(dateFrom, datetime.time()) if dateFrom else None,
+                                          dateTo=datetime.datetime.combine(dateTo + datetime.timedelta(days=1), datetime.time()) if dateTo else None,
+                                          page=page, pageSize=pageSize)
+        data, total = res if res else ([], 0)
         # creates compatible row objects from the table object
         items = list()
         for entry in data:
             items.append(AccessEntry(**entry))
         logging.getLogger('mlaps').debug(sort_by)
         # renders the table with all parameters given and the generated rows
-        return AccessTable(self.get_sorted_by(items, sort=sort_by, reverse=(sort_reverse == 'desc')), classes=['table table-striped table-dark'], sort_by=sort_by, sort_reverse=(sort_reverse == 'desc'))
+        table = AccessTable(items, classes=['table table-striped table-dark'], sort_by=sort_by, sort_reverse=(sort_reverse == 'desc'))
+        table.queryArgs = {'search': search, 'from': dateFrom or '', 'to': dateTo or ''}
+        return table, Pagination(page, pageSize, total)
     """
-    Renders a html table filled with all recorded password decryptinos in the given order and sorting
+    Renders one page of the html table filled with all enrolled machines in the given order and sorting
+    Sorting, filtering and paging are done by the database, returns the table and its pagination
     """
-    def getMachineTable(self, sort_by='mid',sort_reverse=False):
-        # greps all known machines from the database
-        data = self.mysql.getMachineList()
+    def getMachineTable(self, sort_by='mid', sort_reverse=False, search='', page=1, pageSize=50):
+        # greps one page of the known machines from the database
+        res = self.mysql.getMachinePage(sort_by=sort_by, sort_reverse=(sort_reverse == 'desc'), search=search,
+                                        page=page, pageSize=pageSize)
+        data, total = res if res else ([], 0)
         # creates compatible row objects from the table object
         items = list()
         for entry in data: items.append(MachineEntry(**entry))
         logging.getLogger('mlaps').debug(sort_by)
         # renders the table with all parameters given and the generated rows
-        return MachineTable(self.get_sorted_by(items, sort=sort_by, reverse=(sort_reverse == 'desc')), classes=['table table-striped table-dark'], sort_by=sort_by, sort_reverse=(sort_reverse == 'desc'))
+        table = MachineTable(items, classes=['table table-striped table-dark'], sort_by=sort_by, sort_reverse=(sort_reverse == 'desc'))
+        table.queryArgs = {'search': search}
+        return table, Pagination(page, pageSize, total)
+
+    """
+    Streams the html table filled with all recorded password decryptions matching the filters in the given order
+    Yields the table head first and then the rows chunk by chunk, as they are fetched from the database
+    """
+    def streamAccessTable(self, sort_by='aid', sort_reverse=False, search='', dateFrom: datetime.date = None,
+                          dateTo: datetime.date = None, chunkSize=500):
+        table = AccessTable([], classes=['table table-striped table-dark'], sort_by=sort_by, sort_reverse=(sort_reverse == 'desc'))
+        table.queryArgs = {'search': search, 'from': dateFrom or '', 'to': dateTo or ''}
+        chunks = self.mysql.iterAccessLogChunks(sort_by=sort_by, sort_reverse=(sort_reverse == 'desc'), search=search,
+                                                dateFrom=datetime.datetime.combine(dateFrom, datetime.time()) if dateFrom else None,
+                                                dateTo=datetime.datetime.combine(dateTo + datetime.timedelta(days=1), datetime.time()) if dateTo else None,
+                                                chunkSize=chunkSize)
+        return self.__streamTable(table, ([AccessEntry(**entry) for entry in chunk] for chunk in chunks))
+
+    """
+    Streams the html table filled with all enrolled machines matching the filter in the given order
+    Yields the table head first and then the rows chunk by chunk, as they are fetched from the database
+    """
+    def streamMachineTable(self, sort_by='mid', sort_reverse=False, search='', chunkSize=500):
+        table = MachineTable([], classes=['table table-striped table-dark'], sort_by=sort_by, sort_reverse=(sort_reverse == 'desc'))
+        table.queryArgs = {'search': search}
+        chunks = self.mysql.iterMachineChunks(sort_by=sort_by, sort_reverse=(sort_reverse == 'desc'), search=search,
+                                              chunkSize=chunkSize)
+        return self.__streamTable(table, ([MachineEntry(**entry) for entry in chunk] for chunk in chunks))
+
+    # yields the opening tags and head of the given table, one string of rows per chunk of items and the closing tags
+    def __streamTable(self, table: Table, chunks):
+        yield Markup(element('table', attrs=table.get_html_attrs())[:-len('</table>')] + table.thead() + '<tbody>')
+        for items in chunks:
+            yield Markup(''.join(table.tr(item) for item in items))
+        yield Markup('</tbody></table>')
 
     def getShortPasswordTable(self, mid: uuid.UUID):
         pws = self.mysql.getMachinesPasswords(mid)
@@ -51,8 +96,8 @@ class TableBuilder():
             shortPasswordList.append(ShortPasswordEntry(pwid=pw.id, isSet=pw.password_set, status=pw.status, receivedTime=pw.password_received, expiredTime=pw.password_expiry))
         return ShortPasswordTable(shortPasswordList, classes=['table table-striped table-dark'])
 
-    def getCheckinTable(self, mid: uuid.UUID):
-        checkins = self.mysql.getMachinesCheckins(mid)
+    def getCheckinTable(self, mid: uuid.UUID, limit: int = None):
+        checkins = self.mysql.getMachinesCheckins(mid, limit)
         checkinList = list()
         for checkin in checkins:
             checkinList.append(CheckinListEntry(ckid=checkin.id, cktime=checkin.checkin_time))
@@ -72,6 +117,23 @@ class TableBuilder():
         return GeneralInfoTable(infolist, classes=['table table-striped table-dark'])
 
 
+class Pagination():
+    # describes which page of how many is shown, used by the pagination template
+    def __init__(self, page: int, pageSize: int, total: int):
+        self.page = page
+        self.pageSize = pageSize
+        self.total = total
+        self.pages = max(1, -(-total // pageSize))
+
+    @property
+    def hasPrev(self) -> bool:
+        return self.page > 1
+
+    @property
+    def hasNext(self) -> bool:
+        return self.page < self.pages
+
+
 class PasswordCol(Col):
     """Class that will just output whatever it is given and will not
     escape it.
@@ -95,28 +157,39 @@ class ExpiryCol(Col):
         <button class="btn btn-danger btn-sm" hx-get="{url_for('.handleDisableMachine', mid=content)}" hx-target="#toast-div" hx-swap="beforeend" hx-confirm="Are you sure you wish to disable the machine?" >Disable Machine</button>
         """
 
+class SelectCol(Col):
+    """Column with a checkbox to select the machine of the row for the
+    bulk actions of the machine table.
+    """
+    def td_format(self, content):
+        return f'<input class="form-check-input" type="checkbox" name="mid" value="{content}" form="bulk-form">'
+
 class MachineTable(Table):
     # structure/columns of the machine table
+    select = SelectCol('', allow_sort=False)
     mid = LinkCol('ID of Machine', 'handleDetailedMachine', url_kwargs=dict(mid='mid'), attr='mid')
     hostname = Col('Hostname')
     serialnumber = Col('Serialnumber')
     enroll_time = DatetimeCol('Enrollment Timestamp', datetime_format="medium")
     enroll_success = Col('Enrollment Successful')
-    password_status = Col('Password Status')
-    password = PasswordCol('Password')
+    password_status = Col('Password Status', allow_sort=False)
+    password = PasswordCol('Password', allow_sort=False)
     allow_sort = True
+    # additional query arguments (the active filters) which are kept when sorting
+    queryArgs = {}
 
     def sort_url(self, col_key, reverse=False):
         if reverse:
             direction = 'desc'
         else:
             direction = 'asc'
-        return url_for('home', sort=col_key, direction=direction)
+        return url_for('home', sort=col_key, direction=direction, **self.queryArgs)
 
 class MachineEntry():
     def __init__(self, mid, hostname, serialnumber, enroll_time,enroll_success, disabled, password_status='Unknown'):
         # here all fields defined in the table must be filled, also need to be in sync with the table
         self.mid = mid
+        self.select = mid
         self.hostname = hostname
         self.serialnumber = serialnumber
         self.password = mid
@@ -135,13 +208,15 @@ class AccessTable(Table):
     mhn = Col('Machine Hostname')
     pwid = Col('Password ID')
     allow_sort = True
+    # additional query arguments (the active filters) which are kept when sorting
+    queryArgs = {}
 
     def sort_url(self, col_key, reverse=False):
         if reverse:
             direction = 'desc'
         else:
             direction = 'asc'
-        return url_for('handle_access_log', sort=col_key, direction=direction)
+        return url_for('handle_access_log', sort=col_key, direction=direction, **self.queryArgs)
 
 class AccessEntry():
     def __init__(self, aid, admin_kurzel, getTime, machine_id, machine_serialnumber, machine_hostname, password_id):
@@ -202,6 +277,7 @@ class PosDuplicateTable(Table):
 class PosDuplicateEntry():
     def __init__(self, mid, hostname, serialnumber):
         self.mid = mid
+        self.select = mid
         self.hostname = hostname
         self.serialnumber = serialnumber
         self.expireButton = mid
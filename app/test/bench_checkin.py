@@ -0,0 +1,76 @@
+"""
+Load test for the checkin path
+Seeds an in memory database with a fleet and reports how many checkins per second and queries per checkin
+the previous multi query path and the single read checkinMachine path with the checkin buffer achieve
+Run from the test folder with: python bench_checkin.py
+"""
+import contextlib
+import datetime
+import io
+import logging
+import random
+import time
+import uuid
+
+from checkinBuffer import CheckinBuffer
+from fixtures.db import DBMock
+from pony import orm
+
+FLEET_SIZE = 2000
+CHECKINS = 5000
+
+
+def seed(db: DBMock):
+    timeNow = datetime.datetime.utcnow()
+    mids = []
+    with orm.db_session:
+        for i in range(FLEET_SIZE):
+            machine = db.Machine(id=uuid.uuid4(), hostname=f"host-{i}", serialnumber=f"serial-{i}",
+                                 enroll_time=timeNow, enroll_success=True, disabled=False)
+            db.Password(id=uuid.uuid4(), machine_id=machine, password="cipher", status='Unseen', password_set=True,
+                        password_received=timeNow, password_expiry=timeNow + datetime.timedelta(days=7))
+            mids.append(machine.id)
+    return mids
+
+
+# the checkin path as it was before: checkUUID, createCheckin, updateMachineInfo, checkPasswordValidityString
+def multiQueryCheckin(db: DBMock, buffer: CheckinBuffer, mid: uuid.UUID, serialnumber: str, hostname: str):
+    with orm.db_session:
+        if db.readMachine(mid):
+            db.createCheckin(mid)
+            db.updateMachineInfo(mid, serialnumber, hostname)
+            return db.checkPasswordValidityString(mid)
+
+
+# the current checkin path: checkinMachine and the write-behind buffer
+def singleQueryCheckin(db: DBMock, buffer: CheckinBuffer, mid: uuid.UUID, serialnumber: str, hostname: str):
+    valid = db.checkinMachine(mid, serialnumber, hostname)
+    buffer.add(mid)
+    return valid
+
+
+def run(name, checkin):
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = DBMock()
+    orm.set_sql_debug(False)
+    try:
+        mids = seed(db)
+        machines = {mid: (f"serial-{i}", f"host-{i}") for i, mid in enumerate(mids)}
+        buffer = CheckinBuffer(db, maxSize=500)
+        db.dbClient.merge_local_stats()
+        start = time.perf_counter()
+        for _ in range(CHECKINS):
+            mid = random.choice(mids)
+            checkin(db, buffer, mid, *machines[mid])
+        buffer.flush()
+        duration = time.perf_counter() - start
+        queries = sum(stat.db_count for sql, stat in db.dbClient.local_stats.items() if sql is not None)
+        print(f"{name:>12}: {CHECKINS / duration:>8.0f} checkins/s, {queries / CHECKINS:.1f} queries per checkin")
+    finally:
+        db.reset_db()
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    run("multi query", multiQueryCheckin)
+    run("single query", singleQueryCheckin)
@@ -0,0 +1,54 @@
+"""
+Benchmark for building the machine list of the index page
+Seeds an in memory database with fleets of growing size and reports the time and the number of
+issued queries it takes to build the machine list
+Run from the test folder with: python bench_machine_list.py
+"""
+import contextlib
+import datetime
+import io
+import logging
+import time
+import uuid
+
+from fixtures.db import DBMock
+from pony import orm
+
+FLEET_SIZES = [100, 1000, 5000, 20000]
+PASSWORDS_PER_MACHINE = 5
+
+
+def seed(db: DBMock, size: int):
+    timeNow = datetime.datetime.utcnow()
+    with orm.db_session:
+        for i in range(size):
+            machine = db.Machine(id=uuid.uuid4(), hostname=f"host-{i}", serialnumber=f"serial-{i}",
+                                 enroll_time=timeNow, enroll_success=True, disabled=False)
+            for j in range(PASSWORDS_PER_MACHINE):
+                db.Password(id=uuid.uuid4(), machine_id=machine, password="cipher", status='Unseen',
+                            password_set=True, password_received=timeNow - datetime.timedelta(days=7 * j),
+                            password_expiry=timeNow + datetime.timedelta(days=7 - 7 * j))
+
+
+def run(size: int):
+    # the fixture enables the sql debug output while creating the tables
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = DBMock()
+    orm.set_sql_debug(False)
+    try:
+        seed(db, size)
+        db.dbClient.merge_local_stats()
+        start = time.perf_counter()
+        machines = db.getMachineList()
+        duration = time.perf_counter() - start
+        queries = sum(stat.db_count for sql, stat in db.dbClient.local_stats.items() if sql is not None)
+        assert len(machines) == size
+        print(f"{size:>8} machines: {duration * 1000:>9.1f} ms, {queries} queries")
+    finally:
+        db.reset_db()
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    for fleetSize in FLEET_SIZES:
+        run(fleetSize)
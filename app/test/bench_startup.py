@@ -0,0 +1,79 @@
+"""
+Startup benchmark of the server process
+Starts a server process the previous eager way (importing everything and waiting for the hsm before binding) and the
+lazy way of starter.py (binding first and initialising in the background) and reports when /ping and /ready answer.
+The database and hsm aren't needed, their wait is simulated with HSM_WAIT seconds
+Run from the test folder with: python bench_startup.py
+"""
+import os
+import subprocess
+import sys
+import time
+
+import requests
+
+HSM_WAIT = 2.0
+RUNS = 3
+
+# the heavy modules the controller and the flask app pull in
+IMPORTS = "import Controller, tableBuilder, flask, flask_wtf.csrf, markupsafe"
+
+EAGER = f"""
+import time, prefork, startup, configparser
+{IMPORTS}
+time.sleep({HSM_WAIT})
+app = startup.StartupApp()
+app.app = lambda environ, start_response: start_response('200 OK', []) or [b""]
+server = prefork.createServer(configparser.ConfigParser(), ('127.0.0.1', 0), app)
+server.prepare()
+print(server.bind_addr[1], flush=True)
+server.serve()
+"""
+
+LAZY = f"""
+import time, prefork, startup, configparser
+app = startup.StartupApp()
+server = prefork.createServer(configparser.ConfigParser(), ('127.0.0.1', 0), app)
+
+def initialize():
+    {IMPORTS}
+    time.sleep({HSM_WAIT})
+    return lambda environ, start_response: start_response('200 OK', []) or [b""]
+
+app.initialize(initialize, server)
+server.prepare()
+print(server.bind_addr[1], flush=True)
+server.serve()
+"""
+
+
+def waitFor(url, start):
+    while True:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return time.perf_counter() - start
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.005)
+
+
+def run(name, script):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.abspath(".."), os.path.abspath(".")]))
+    pings, readies = [], []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "-c", script], stdout=subprocess.PIPE, text=True, env=env)
+        try:
+            url = f"http://127.0.0.1:{process.stdout.readline().strip()}/"
+            pings.append(waitFor(url + "ping", start))
+            readies.append(waitFor(url + "ready", start))
+        finally:
+            process.kill()
+            process.wait()
+            process.stdout.close()
+    print(f"{name:>6}: /ping after {min(pings):.3f}s, /ready after {min(readies):.3f}s (best of {RUNS})")
+
+
+if __name__ == "__main__":
+    run("eager", EAGER)
+    run("lazy", LAZY)
@@ -0,0 +1,33 @@
+import configparser
+import inspect
+import re
+import Controller
+
+# the attributes Controller.__init__ sets up, by whether they are private
+ATTRIBUTES = {name: bool(private) for private, name in
+              re.findall(r"self\.(__)?(\w+) *=", inspect.getsource(Controller.Controller.__init__))}
+
+
+class ControllerMock(Controller.Controller):
+    """
+    Controller with only the collaborators a test needs, a real one needs the database secrets, the hsm and starts
+    the scheduler. Collaborators are given by the names of the attributes Controller.__init__ sets, the config as a
+    dict of sections. Names __init__ doesn't set raise a TypeError, so renaming an attribute breaks the tests loudly
+    """
+
+    def __init__(self, config: dict = None, **collaborators):
+        parser = configparser.ConfigParser()
+        parser.read_dict(config or {})
+        self.use(config=parser, **collaborators)
+
+    """
+    Sets the given collaborators, for the ones which need the controller itself
+    Returns the controller
+    """
+    def use(self, **collaborators):
+        unknown = set(collaborators) - set(ATTRIBUTES)
+        if unknown:
+            raise TypeError(f"Controller.__init__ doesn't set {', '.join(sorted(unknown))}")
+        for name, value in collaborators.items():
+            setattr(self, f"_Controller__{name}" if ATTRIBUTES[name] else name, value)
+        return self
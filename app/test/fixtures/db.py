@@ -1,8 +1,12 @@
 from dbClient import *
 from pony import orm
+import freezegun
 import pytest
 import logging
 
+# pony resolves the types of projected attributes by identity, which breaks if freezegun patches its datetime
+freezegun.configure(extend_ignore_list=['pony'])
+
 
 class DBMock(dbClient):
     def __init__(self):
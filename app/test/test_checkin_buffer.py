@@ -0,0 +1,71 @@
+import unittest
+import uuid
+from fixtures.db import DBMock
+from freezegun import freeze_time
+from pony import orm
+from checkinBuffer import CheckinBuffer
+
+
+class TestCheckinBuffer(unittest.TestCase):
+    def setUp(self):
+        self.db = DBMock()
+        self.uid = uuid.UUID("61877565-5fe5-4175-9f2b-d24704df0b74")
+        self.db.createMachine(self.uid, "test", "testitest")
+
+    def tearDown(self):
+        self.db.reset_db()
+
+    def countCheckins(self):
+        with orm.db_session:
+            return self.db.getMachinesCheckins(self.uid).count()
+
+    @freeze_time("2022-01-14")
+    def testFlushWhenFull(self):
+        """Test the buffer writes its checkins once maxSize is reached"""
+        buffer = CheckinBuffer(self.db, maxSize=3)
+        buffer.add(self.uid)
+        buffer.add(self.uid)
+        assert self.countCheckins() == 0
+        buffer.add(self.uid)
+        assert self.countCheckins() == 3
+        assert len(buffer) == 0
+
+    @freeze_time("2022-01-14")
+    def testRetryFailedFlush(self):
+        """Test checkins of a failed flush are kept for the next one"""
+        buffer = CheckinBuffer(self.db, maxSize=10)
+        buffer.add(self.uid)
+        buffer.add(self.uid)
+        self.db.createCheckins = lambda checkins: None
+        assert buffer.flush() == 0
+        assert len(buffer) == 2
+        del self.db.createCheckins
+        assert buffer.flush() == 2
+        assert self.countCheckins() == 2
+
+    @freeze_time("2022-01-14")
+    def testDropRemovedMachine(self):
+        """Test a checkin of a removed machine is dropped and doesn't block the other checkins"""
+        flushed = []
+        buffer = CheckinBuffer(self.db, maxSize=10, onFlush=flushed.append)
+        buffer.add(self.uid)
+        buffer.add(uuid.uuid4())
+        buffer.add(self.uid)
+        assert buffer.flush() == 2
+        assert len(buffer) == 0
+        assert self.countCheckins() == 2
+        assert flushed == [{self.uid}]
+
+    @freeze_time("2022-01-14")
+    def testOnFlush(self):
+        """Test onFlush gets the machines of the written checkins once"""
+        flushed = []
+        buffer = CheckinBuffer(self.db, maxSize=10, onFlush=flushed.append)
+        buffer.add(self.uid)
+        buffer.add(self.uid)
+        buffer.flush()
+        assert flushed == [{self.uid}]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import uuid
+import datetime
+from fixtures.db import DBMock
+from pony import orm
+
+
+class TestDBIndexes(unittest.TestCase):
+    def setUp(self):
+        self.db = DBMock()
+
+    def tearDown(self):
+        self.db.reset_db()
+
+    def queryPlan(self, query) -> str:
+        """Returns the sqlite query plan of the given pony query as one string"""
+        sql = query.get_sql()
+        cursor = self.db.dbClient.get_connection().cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, [None] * sql.count('?'))
+        return '\n'.join(row[-1] for row in cursor.fetchall())
+
+    @orm.db_session
+    def testLatestSuccessfulPasswordIndex(self):
+        """Test the latest successful password lookup uses the machine/set/received index"""
+        mid = uuid.uuid4()
+        query = self.db.Password.select(lambda c: c.machine_id.id == mid and c.password_set == True
+                                                  and c.machine_id.disabled == False).order_by(
+            lambda c: orm.desc(c.password_received))
+        assert "idx_password__machine_id_password_set_password_received" in self.queryPlan(query)
+
+    @orm.db_session
+    def testMachinesCheckinsIndex(self):
+        """Test the checkins of a machine are read through the machine/time index"""
+        query = self.db.getMachinesCheckins(uuid.uuid4())
+        plan = self.queryPlan(query)
+        assert "idx_checkin__mid_checkin_time" in plan
+        assert "TEMP B-TREE" not in plan
+
+    @orm.db_session
+    def testMachinesByHostnameAndSerialnumberIndex(self):
+        """Test machines are searched by hostname and serialnumber through their indexes"""
+        assert "idx_machine__hostname" in self.queryPlan(self.db.getMachinesByHostname("host"))
+        assert "idx_machine__serialnumber" in self.queryPlan(self.db.getMachinesBySerialnumber("serial"))
+
+    @orm.db_session
+    def testAccessLogTimeIndex(self):
+        """Test filtering the access log by time uses the time index"""
+        dateFrom = datetime.datetime(2022, 1, 14)
+        query = self.db.AccessLog.select(lambda a: a.getTime >= dateFrom)
+        assert "idx_accesslog__gettime" in self.queryPlan(query).lower()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -38,6 +38,69 @@ class TestDBInit(unittest.TestCase):
             }
         ]
 
+    def testMachineListPasswordStatus(self):
+        """Test DB GetMachineList latest password status"""
+        uid = uuid.UUID("61877565-5fe5-4175-9f2b-d24704df0b74")
+        other = uuid.UUID("0c5b8a3e-27d4-4bd6-9d27-3f0b7b6ce1a5")
+        disabled = uuid.UUID("a8d1f5f2-5d25-4a3a-8a8b-4f1c0f7f2c11")
+        with freeze_time("2022-01-14"):
+            assert self.db.createMachine(uid, "test", "testitest") is True
+            assert self.db.createMachine(other, "other", "otherhost") is True
+            assert self.db.createMachine(disabled, "dis", "dishost") is True
+            assert self.db.createPassword(uid, "oldpassword") is True
+            assert self.db.createPassword(disabled, "password") is True
+            assert self.db.disableMachine(disabled) is True
+        with freeze_time("2022-01-15"):
+            assert self.db.createPassword(uid, "newpassword") is True
+            statuses = {m['mid']: m['password_status'] for m in self.db.getMachineList()}
+        # the newest password has not expired yet, the machine without passwords is unknown
+        assert statuses == {uid: 'Unseen', other: 'Unknown'}
+        with freeze_time("2022-01-16"):
+            statuses = {m['mid']: m['password_status'] for m in self.db.getMachineList()}
+        assert statuses == {uid: 'Expired', other: 'Unknown'}
+
+    def testExpireOverduePasswords(self):
+        """Test DB ExpireOverduePasswords only marks the overdue passwords of the non disabled machines"""
+        uid = uuid.UUID("61877565-5fe5-4175-9f2b-d24704df0b74")
+        disabled = uuid.UUID("a8d1f5f2-5d25-4a3a-8a8b-4f1c0f7f2c11")
+        with freeze_time("2022-01-14"):
+            for mid in (uid, disabled):
+                assert self.db.createMachine(mid, "test", "testitest") is True
+                assert self.db.createPassword(mid, "password") is True
+            assert self.db.disableMachine(disabled) is True
+            assert self.db.expireOverduePasswords() == 0
+        with freeze_time("2022-01-16"):
+            assert self.db.expireOverduePasswords() == 1
+            assert self.db.expireOverduePasswords() == 0
+        with orm.db_session:
+            statuses = {p.machine_id.id: p.status for p in self.db.Password.select()}
+        assert statuses == {uid: 'Expired', disabled: 'Unseen'}
+
+    @freeze_time("2022-01-14")
+    def testMachinePage(self):
+        """Test DB GetMachinePage sorting, filtering and paging"""
+        for i in range(5):
+            assert self.db.createMachine(uuid.uuid4(), f"serial{i}", f"host{i}") is True
+        assert self.db.createMachine(uuid.uuid4(), "other", "laptop") is True
+        machines, total = self.db.getMachinePage(sort_by='hostname', sort_reverse=True, search='host',
+                                                 page=1, pageSize=2)
+        assert total == 5
+        assert [m['hostname'] for m in machines] == ['host4', 'host3']
+        machines, total = self.db.getMachinePage(sort_by='hostname', sort_reverse=True, search='host',
+                                                 page=3, pageSize=2)
+        assert [m['hostname'] for m in machines] == ['host0']
+        machines, total = self.db.getMachinePage(search='other')
+        assert total == 1 and machines[0]['hostname'] == 'laptop'
+
+    @freeze_time("2022-01-14")
+    def testMachineChunks(self):
+        """Test DB IterMachineChunks"""
+        for i in range(5):
+            assert self.db.createMachine(uuid.uuid4(), f"serial{i}", f"host{i}") is True
+        chunks = list(self.db.iterMachineChunks(sort_by='hostname', chunkSize=2))
+        assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+        assert [m['hostname'] for chunk in chunks for m in chunk] == [f"host{i}" for i in range(5)]
+
     @freeze_time("2022-01-14")
     def testInsertCheckin(self):
         """Test DB GetAccessLog"""
@@ -47,6 +110,100 @@ class TestDBInit(unittest.TestCase):
 
         assert self.db.createCheckin(uid) is True
 
+    def testCheckinMachine(self):
+        """Test DB CheckinMachine"""
+        uid = uuid.UUID("61877565-5fe5-4175-9f2b-d24704df0b74")
+        assert self.db.checkinMachine(uid, "test", "testitest") is None
+        with freeze_time("2022-01-14"):
+            assert self.db.createMachine(uid, "test", "testitest") is True
+            # no successfully set password yet
+            assert self.db.checkinMachine(uid, "test2", "testitest2") is False
+            assert self.db.createPassword(uid, "mysafepassword1234") is True
+            assert self.db.updatePasswordSecStage("Success", uid) is True
+        with freeze_time("2022-01-14 00:00:00.5"):
+            assert self.db.checkinMachine(uid, "test2", "testitest2") is True
+            assert self.db.checkPasswordValidityString(uid) is True
+        with freeze_time("2022-01-15"):
+            assert self.db.checkinMachine(uid, "test2", "testitest2") is False
+            assert self.db.checkPasswordValidityString(uid) is False
+        assert self.db.getMachineList()[0]['hostname'] == "testitest2"
+        assert self.db.getMachineList()[0]['enroll_success'] is True
+
+    @freeze_time("2022-01-14")
+    def testInsertCheckins(self):
+        """Test DB CreateCheckins"""
+        uid = uuid.UUID("61877565-5fe5-4175-9f2b-d24704df0b74")
+        assert self.db.createMachine(uid, "test", "testitest") is True
+        times = [datetime.datetime(2022, 1, 13, hour) for hour in range(3)]
+        checkins = [(uid, checkinTime) for checkinTime in times]
+        assert self.db.createCheckins(checkins) == checkins
+        # a checkin of an unknown machine is skipped, the others are still saved
+        assert self.db.createCheckins([(uid, times[0]), (uuid.uuid4(), times[0])]) == [(uid, times[0])]
+        with orm.db_session:
+            assert [c.checkin_time for c in self.db.getMachinesCheckins(uid)] == sorted(times + times[:1])[::-1]
+
+    def testRollupCheckins(self):
+        """Test DB RollupCheckins"""
+        uid = uuid.UUID("61877565-5fe5-4175-9f2b-d24704df0b74")
+        assert self.db.createMachine(uid, "test", "testitest") is True
+        times = [datetime.datetime(2022, 1, 10, hour) for hour in range(5)] + [datetime.datetime(2022, 1, 11, 12),
+                                                                               datetime.datetime(2022, 1, 13, 12)]
+        assert self.db.createCheckins([(uid, checkinTime) for checkinTime in times]) is not None
+        assert self.db.rollupCheckins(datetime.datetime(2022, 1, 12), batchSize=2) == 6
+        # rolling up the same day again adds to the existing summary
+        assert self.db.createCheckins([(uid, datetime.datetime(2022, 1, 10, 23))]) is not None
+        assert self.db.rollupCheckins(datetime.datetime(2022, 1, 12)) == 1
+        with orm.db_session:
+            assert [c.checkin_time for c in self.db.getMachinesCheckins(uid)] == [datetime.datetime(2022, 1, 13, 12)]
+            summaries = sorted((s.day, s.checkins, s.first_checkin, s.last_checkin)
+                               for s in self.db.CheckinSummary.select())
+        assert summaries == [
+            (datetime.date(2022, 1, 10), 6, datetime.datetime(2022, 1, 10, 0), datetime.datetime(2022, 1, 10, 23)),
+            (datetime.date(2022, 1, 11), 1, datetime.datetime(2022, 1, 11, 12), datetime.datetime(2022, 1, 11, 12))
+        ]
+
+    def testBulkDisable(self):
+        """Test DB DisableUnenrolledMachines and DisableMachines"""
+        uids = [uuid.uuid4() for _ in range(4)]
+        for i, uid in enumerate(uids):
+            assert self.db.createMachine(uid, f"sn{i}", f"hn{i}") is True
+        with orm.db_session:
+            self.db.readMachine(uids[0]).enroll_time = datetime.datetime.utcnow() - datetime.timedelta(days=3)
+            self.db.readMachine(uids[1]).enroll_success = True
+        assert self.db.disableUnenrolledMachines(datetime.timedelta(days=2)) == 1
+        assert self.db.disableUnenrolledMachines() == 2
+        assert self.db.disableMachines([uids[1], uids[2], uids[1]]) == 1
+        with orm.db_session:
+            assert [self.db.readMachine(uid).disabled for uid in uids] == [True, True, True, True]
+
+    def testBulkExpirePasswords(self):
+        """Test DB ExpireMachinesPasswords"""
+        uids = [uuid.uuid4() for _ in range(3)]
+        for i, uid in enumerate(uids):
+            assert self.db.createMachine(uid, f"sn{i}", f"hn{i}") is True
+            assert self.db.createPassword(uid, "pw") is True
+        assert self.db.expireMachinesPasswords(uids[:2]) == 2
+        assert self.db.expireMachinesPasswords(uids[:2]) == 0
+        timeNow = datetime.datetime.utcnow()
+        with orm.db_session:
+            assert [self.db.Password.get(machine_id=uid).password_expiry > timeNow for uid in uids] == [False, False, True]
+
+    def testLatestSuccessfulPasswords(self):
+        """Test DB GetLatestSuccessfulPasswords and MarkPasswordsSeen"""
+        uids = [uuid.uuid4() for _ in range(3)]
+        for i, uid in enumerate(uids):
+            assert self.db.createMachine(uid, f"sn{i}", f"hn{i}") is True
+        for pw in ["old", "new"]:
+            assert self.db.createPassword(uids[0], pw) is True
+            assert self.db.updatePasswordSecStage("Success", uids[0]) is True
+        # only the machine without a successfully set password is missing
+        assert self.db.createPassword(uids[1], "unset") is True
+        passwords = self.db.getLatestSuccessfulPasswords(uids)
+        assert [(mid, hostname, cipher) for _, mid, hostname, _, cipher in passwords] == [(uids[0], "hn0", "new")]
+        assert self.db.markPasswordsSeen([pwid for pwid, _, _, _, _ in passwords]) is True
+        with orm.db_session:
+            assert self.db.getLatestSuccessfulPassword(uids[0]).status == 'Seen'
+
     @freeze_time("2022-01-14")
     def testInsertPassword(self):
         """Test DB GetAccessLog"""
@@ -0,0 +1,100 @@
+import gc
+import sqlite3
+import threading
+import unittest
+from unittest import mock
+from dbPool import PoolLimits, RecyclingPool, PooledMySQLProvider
+
+
+class TestRecyclingPool(unittest.TestCase):
+    def testReuseConnection(self):
+        """Test a released connection is reused by the next session of the thread"""
+        pool = RecyclingPool(sqlite3, PoolLimits(size=2, recycle=3600), ":memory:")
+        con, new = pool.connect()
+        assert new
+        pool.release(con)
+        assert pool.connect() == (con, False)
+        assert pool.limits.open == 1
+
+    def testRecycleOldConnection(self):
+        """Test a connection older than the recycle time is replaced before it is reused"""
+        pool = RecyclingPool(sqlite3, PoolLimits(size=2, recycle=60), ":memory:")
+        con, _ = pool.connect()
+        pool.release(con)
+        with mock.patch("time.monotonic", return_value=pool.connectedAt + 61):
+            newCon, new = pool.connect()
+        assert new and newCon is not con
+        assert pool.limits.open == 1
+
+    def testCloseConnectionsOverSize(self):
+        """Test connections are closed after their session while more than size connections are open"""
+        limits = PoolLimits(size=1, recycle=3600)
+        pool = RecyclingPool(sqlite3, limits, ":memory:", check_same_thread=False)
+        con, _ = pool.connect()
+        released = threading.Event()
+
+        def otherThread():
+            otherCon, _ = pool.connect()
+            assert limits.open == 2
+            pool.release(otherCon)
+            assert pool.con is None
+            released.set()
+
+        thread = threading.Thread(target=otherThread)
+        thread.start()
+        thread.join()
+        assert released.is_set()
+        assert limits.open == 1
+        pool.release(con)
+        assert pool.con is con
+
+    def testExitedThreads(self):
+        """Test the connections of exited threads aren't counted, so they don't close the connections of others"""
+        limits = PoolLimits(size=1, recycle=3600)
+        pool = RecyclingPool(sqlite3, limits, ":memory:", check_same_thread=False)
+
+        def shortLived():
+            con, _ = pool.connect()
+            pool.release(con)
+
+        for _ in range(2):
+            thread = threading.Thread(target=shortLived)
+            thread.start()
+            thread.join()
+        gc.collect()
+        assert limits.open == 0
+        for _ in range(5):
+            con, _ = pool.connect()
+            pool.release(con)
+        assert pool.con is con
+        assert limits.open == 1
+        pool.disconnect()
+        assert limits.open == 0
+
+
+class TestReplicaRouting(unittest.TestCase):
+    def setUp(self):
+        # the provider is only routing between its pools here, so no mysql server is needed
+        self.provider = PooledMySQLProvider.__new__(PooledMySQLProvider)
+        self.provider.route = threading.local()
+        self.provider.pool = RecyclingPool(sqlite3, PoolLimits(), ":memory:")
+        self.provider.replicaPool = RecyclingPool(sqlite3, PoolLimits(), ":memory:")
+
+    def testRouteToReplica(self):
+        """Test only sessions started inside readReplica get a replica connection and are released to its pool"""
+        primary, _ = self.provider.connect()
+        self.provider.release(primary)
+        with self.provider.readReplica():
+            replica, _ = self.provider.connect()
+        assert primary is self.provider.pool.con
+        assert replica is self.provider.replicaPool.con and replica is not primary
+        self.provider.drop(replica)
+        assert self.provider.replicaPool.con is None
+        assert self.provider.pool.con is primary
+
+    def testWithoutReplica(self):
+        """Test readReplica keeps using the primary if no replica is configured"""
+        self.provider.replicaPool = None
+        with self.provider.readReplica():
+            con, _ = self.provider.connect()
+        assert con is self.provider.pool.con
@@ -0,0 +1,100 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from enrollmentPool import EnrollmentPool
+from fixtures.controller import ControllerMock
+from fixtures.db import DBMock
+import sessionStore
+
+
+class TestEnrollmentPool(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.pool = EnrollmentPool(self.sign, workers=1, maxPending=2, resultTTL=600)
+
+    def tearDown(self):
+        self.release.set()
+        self.pool.shutdown()
+
+    def sign(self, uid, csr):
+        self.release.wait(5)
+        return f"cert of {uid}"
+
+    def testBoundedPending(self):
+        """Test enrollments over maxPending are rejected until a pending one finished"""
+        uids = [uuid.uuid4() for _ in range(3)]
+        futures = [self.pool.submit(uid, "csr") for uid in uids]
+        assert futures[2] is None
+        assert not futures[0].done()
+        self.release.set()
+        assert futures[0].result(5) == f"cert of {uids[0]}"
+        assert futures[1].result(5) == f"cert of {uids[1]}"
+        assert self.pool.submit(uids[2], "csr").result(5) == f"cert of {uids[2]}"
+
+    def testPollResult(self):
+        """Test finished enrollments can be polled until their result expired"""
+        uid = uuid.uuid4()
+        self.pool.submit(uid, "csr")
+        assert not self.pool.get(uid).done()
+        self.release.set()
+        assert self.pool.get(uid).result(5) == f"cert of {uid}"
+        assert self.pool.get(uuid.uuid4()) is None
+        # the result is only kept once the done callback of the future ran
+        self.pool.resultTTL = -1
+        deadline = time.monotonic() + 5
+        while self.pool.get(uid) is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert self.pool.get(uid) is None
+
+
+class SigningStub():
+    """Stands in for the hsmclient, signs once released"""
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def hsm_sign_csr(self, csr, common_name):
+        self.release.wait(5)
+        return {'data': {'certificate': f"cert of {common_name}"}}
+
+
+class TestSharedEnrollments(unittest.TestCase):
+    def setUp(self):
+        self.db = DBMock()
+        self.folder = tempfile.TemporaryDirectory()
+        self.hsm = SigningStub()
+        # two workers which only share the session store
+        self.workers = [enrollController(self.db, self.hsm, os.path.join(self.folder.name, "sessions.db"))
+                        for _ in range(2)]
+
+    def tearDown(self):
+        self.hsm.release.set()
+        for contr in self.workers:
+            contr.pool.shutdown()
+        self.db.reset_db()
+        self.folder.cleanup()
+
+    def testPollOtherWorker(self):
+        """Test a pending enrollment can be polled on another worker than the one signing the csr"""
+        ok, enrollID = self.workers[0].handleEnrollClient("csr", "host", "serial")
+        assert ok is None
+        assert self.workers[1].handleEnrollStatus(enrollID) == [None, enrollID]
+        self.hsm.release.set()
+        deadline = time.monotonic() + 5
+        while self.workers[1].handleEnrollStatus(enrollID)[0] is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert self.workers[1].handleEnrollStatus(enrollID) == [True, f"cert of {enrollID}"]
+        assert self.workers[1].handleEnrollStatus(str(uuid.uuid4())) is None
+        assert self.workers[1].handleEnrollStatus("no uuid") is None
+
+
+def enrollController(db, hsm, sessionPath):
+    """Returns a controller with only what the enrollment needs, its enrollment pool is kept as pool"""
+    # don't wait for the signing, so the enrollment has to be polled
+    contr = ControllerMock({'ENROLL': {'wait': '0'}}, mysqlConx=db, hsmClient=hsm,
+                           sessions=sessionStore.SqliteSessionStore(sessionPath))
+    contr.pool = EnrollmentPool(contr._Controller__signEnrollment, workers=1)
+    return contr.use(enrollmentPool=contr.pool)
@@ -0,0 +1,160 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+import metrics
+from hsmTokens import HSMTokenManager
+
+
+class VaultStub(BaseHTTPRequestHandler):
+    """Answers approle logins with a new token, slowly, and counts them."""
+    logins = 0
+    numUses = 5
+    fail = False
+    # secret ids of all logins, also the failed ones
+    secrets = []
+    # secret ids which expired
+    rejected = set()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b"{}")
+        VaultStub.secrets.append(body.get('secret_id'))
+        time.sleep(0.05)
+        if VaultStub.fail or body.get('secret_id') in VaultStub.rejected:
+            self.send_response(400)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        VaultStub.logins += 1
+        body = json.dumps({'auth': {'client_token': f"token{VaultStub.logins}", 'num_uses': VaultStub.numUses,
+                                    'lease_duration': 3600}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class VaultServer(ThreadingHTTPServer):
+    # server_close waits for the running requests, so no login of a previous test is counted by the next one
+    daemon_threads = False
+
+
+class TestHSMTokenManager(unittest.TestCase):
+    def setUp(self):
+        VaultStub.logins = 0
+        VaultStub.fail = False
+        VaultStub.secrets = []
+        VaultStub.rejected = set()
+        self.server = VaultServer(('127.0.0.1', 0), VaultStub)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.manager = self.createManager(standbySize=0)
+
+    def createManager(self, standbySize):
+        return HSMTokenManager(f"http://127.0.0.1:{self.server.server_port}/", requests.Session(), timeout=5,
+                               renewMargin=1, standbySize=standbySize)
+
+    def waitFor(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def waitForLogins(self, logins):
+        self.waitFor(lambda: VaultStub.logins >= logins)
+        return VaultStub.logins
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testProactiveRenewal(self):
+        """Test a new token is requested in the background before the current one is used up"""
+        renewals = metrics.hsmLogins.get('renewal', 'ok')
+        assert self.manager.login('role', 'secret') is True
+        first = [self.manager.acquire() for _ in range(4)]
+        # the fourth use left only the renewal margin, the remaining use is still handed out during the login
+        assert len(set(map(id, first))) == 1
+        assert self.manager.acquire() is first[0]
+        assert self.waitForLogins(2) == 2
+        assert self.manager.acquire() is not first[0]
+        assert metrics.hsmLogins.get('renewal', 'ok') == renewals + 1
+
+    def testSingleFlightLogin(self):
+        """Test concurrent requests share one login and never overrun the uses of a token"""
+        assert self.manager.login('role', 'secret') is True
+        clients = []
+        lock = threading.Lock()
+
+        def request():
+            client = self.manager.acquire()
+            with lock:
+                clients.append(client)
+
+        threads = [threading.Thread(target=request) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(clients) == 20
+        assert all(clients.count(client) <= VaultStub.numUses for client in clients)
+        # 20 uses need at least 4 tokens of 5 uses, the first one came from the explicit login
+        assert VaultStub.logins <= 5
+
+    def testFailedLogin(self):
+        """Test a failed login keeps the current token and an exhausted token raises"""
+        assert self.manager.login('role', 'secret') is True
+        VaultStub.fail = True
+        assert self.manager.login('role', 'wrong') is False
+        assert self.manager.isAuthenticated
+        for _ in range(VaultStub.numUses):
+            self.manager.acquire()
+        with self.assertRaises(ValueError):
+            self.manager.acquire()
+
+    def testFailedLoginKeepsCredentials(self):
+        """Test the renewals keep using the credentials of the last successful login after a failed one"""
+        manager = self.createManager(standbySize=1)
+        assert manager.login('role', 'secret') is True
+        assert self.waitFor(lambda: manager.standby == 1)
+        VaultStub.fail = True
+        assert manager.login('role', 'wrong') is False
+        VaultStub.fail = False
+        for _ in range(VaultStub.numUses + 1):
+            manager.acquire()
+        # the standby token was used, its refill logs in with the stored credentials
+        assert self.waitFor(lambda: len(VaultStub.secrets) == 4)
+        assert VaultStub.secrets == ['secret', 'secret', 'wrong', 'secret']
+
+    def testRereadRotatedSecret(self):
+        """Test a renewal failing with an expired secret id re-reads the credentials and retries with the rotated one"""
+        manager = HSMTokenManager(f"http://127.0.0.1:{self.server.server_port}/", requests.Session(), timeout=5,
+                                  renewMargin=0, standbySize=0, readCredentials=lambda: ('role', 'rotated'))
+        assert manager.login('role', 'secret') is True
+        VaultStub.rejected.add('secret')
+        for _ in range(VaultStub.numUses + 1):
+            manager.acquire()
+        assert VaultStub.secrets == ['secret', 'secret', 'rotated']
+        # the re-read credentials are stored for the next renewals
+        for _ in range(VaultStub.numUses):
+            manager.acquire()
+        assert VaultStub.secrets[-1] == 'rotated' and VaultStub.secrets.count('secret') == 2
+
+    def testStandbyToken(self):
+        """Test a used up token is replaced by the standby token and the standby token is refilled afterwards"""
+        manager = self.createManager(standbySize=1)
+        assert manager.login('role', 'secret') is True
+        # the login hands the first refill to a background thread
+        assert self.waitFor(lambda: manager.standby == 1)
+        first = [manager.acquire() for _ in range(VaultStub.numUses)]
+        assert len(set(map(id, first))) == 1
+        # no renewal login was started while a standby token is ready
+        assert VaultStub.logins == 2 and manager.standby == 1
+        assert manager.acquire() is not first[0]
+        assert self.waitFor(lambda: manager.standby == 1)
+        assert VaultStub.logins == 3
@@ -0,0 +1,152 @@
+import datetime
+import json
+import logging
+import os
+import queue
+import re
+import tempfile
+import types
+import unittest
+import flask
+from fixtures.controller import ControllerMock
+import Controller
+import logger
+
+
+class TestLogger(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.level = logging.getLogger().level
+
+    def tearDown(self):
+        logging.getLogger().setLevel(self.level)
+        self.folder.cleanup()
+
+    def readLog(self) -> list:
+        with open(os.path.join(self.folder.name, "mlaps.log"), encoding='utf8') as f:
+            return f.read().splitlines()
+
+    def testWrittenByListener(self):
+        """Test the records are written to the file and the tail once the writer is stopped"""
+        log = logger.Logger("INFO", self.folder.name, 10)
+        data = {'machine': 'before'}
+        logging.getLogger('mlaps').info("Checkin of %s with %s", "machine", data)
+        # the message is formatted when logging, a later change of the argument doesn't show up
+        data['machine'] = 'after'
+        logging.getLogger('mlaps').debug("Not written %s", "below the level")
+        log.stop()
+        lines = self.readLog()
+        assert len(lines) == 1
+        assert lines[0].endswith("INFO - Checkin of machine with {'machine': 'before'}")
+        entries, _ = log.tail.query()
+        assert [entry.message for entry in entries] == ["Checkin of machine with {'machine': 'before'}"]
+        assert log.queue_handler not in logging.getLogger().handlers
+
+    def testJsonFormat(self):
+        """Test the json format writes one object per line including the exception"""
+        log = logger.Logger("INFO", self.folder.name, 10, jsonFormat=True)
+        try:
+            raise ValueError("broken")
+        except ValueError:
+            logging.getLogger('mlaps').exception("Failed for %s", "machine")
+        log.stop()
+        entry = json.loads(self.readLog()[0])
+        assert entry['level'] == "ERROR" and entry['logger'] == "mlaps"
+        assert entry['message'] == "Failed for machine"
+        assert "ValueError: broken" in entry['exception']
+
+    def testDropWhenFull(self):
+        """Test records are dropped instead of blocking if the queue is full and the drop is reported afterwards"""
+        handler = logger.DroppingQueueHandler(queue.Queue(2))
+        testLogger = logging.getLogger('mlaps.test.drop')
+        testLogger.propagate = False
+        testLogger.addHandler(handler)
+        try:
+            for message in ("first", "second", "dropped", "dropped too"):
+                testLogger.warning(message)
+            assert handler.dropped == 2
+            assert [handler.queue.get_nowait().getMessage() for _ in range(2)] == ["first", "second"]
+            testLogger.warning("third")
+            assert [handler.queue.get_nowait().getMessage() for _ in range(2)] == \
+                ["third", "Dropped 2 log records, the log writer couldn't keep up"]
+            assert handler.dropped == 0
+        finally:
+            testLogger.removeHandler(handler)
+
+
+class TestTailLogger(unittest.TestCase):
+    def setUp(self):
+        self.tail = logger.TailLogger(5)
+        self.start = datetime.datetime(2023, 1, 1)
+        for i in range(8):
+            self.tail.append(self.start + datetime.timedelta(minutes=i), logging.WARNING if i % 2 else logging.INFO,
+                             "WARNING" if i % 2 else "INFO", "mlaps", f"message {i}")
+
+    def testRingBuffer(self):
+        """Test only the latest maxlen records are kept, the newest first"""
+        entries, older = self.tail.query()
+        assert [entry.message for entry in entries] == [f"message {i}" for i in range(7, 2, -1)]
+        assert older is None
+        assert self.tail.latest == 8
+
+    def testPages(self):
+        """Test the cursor of a page fetches the next older records"""
+        entries, older = self.tail.query(limit=2)
+        assert [entry.seq for entry in entries] == [8, 7]
+        entries, older = self.tail.query(before=older, limit=2)
+        assert [entry.seq for entry in entries] == [6, 5]
+        entries, older = self.tail.query(before=older, limit=2)
+        assert [entry.seq for entry in entries] == [4]
+        assert older is None
+
+    def testFilters(self):
+        """Test the filters by level, text and time"""
+        assert [entry.seq for entry in self.tail.query(level=logging.WARNING)[0]] == [8, 6, 4]
+        assert [entry.seq for entry in self.tail.query(search="MESSAGE 5")[0]] == [6]
+        since = self.start + datetime.timedelta(minutes=5)
+        assert [entry.seq for entry in self.tail.query(since=since)[0]] == [8, 7, 6]
+
+    def testIncremental(self):
+        """Test only the records logged after the cursor are returned"""
+        latest = self.tail.latest
+        assert self.tail.query(after=latest)[0] == []
+        self.tail.append(self.start, logging.ERROR, "ERROR", "mlaps", "new")
+        assert [entry.message for entry in self.tail.query(after=latest)[0]] == ["new"]
+
+
+class TestLogTailView(unittest.TestCase):
+    def setUp(self):
+        self.tail = logger.TailLogger(100)
+        self.contr = ControllerMock({'TABLES': {'page-size': '2'}}, logger=types.SimpleNamespace(tail=self.tail))
+        self.app = flask.Flask(__name__, template_folder=os.path.join(os.path.dirname(Controller.__file__), "templates"))
+        self.app.add_url_rule("/api/logTail", "handleLogTail", lambda: "")
+        self.log(3)
+
+    def log(self, n):
+        for _ in range(n):
+            seq = self.tail.latest + 1
+            self.tail.append(datetime.datetime(2023, 1, 1), logging.INFO, "INFO", "mlaps", f"message {seq}")
+
+    def get(self, **kwargs) -> str:
+        with self.app.test_request_context():
+            return flask.make_response(self.contr.handleLogTail(**kwargs)).get_data(as_text=True)
+
+    def testPollMoreThanAPage(self):
+        """Test a poll finding more than a page of new rows gets the cursor for the rest, down to the polled rows"""
+        self.log(3)
+        html = self.get(after=3, pid=os.getpid())
+        assert re.findall(r"message (\d+)", html) == ["6", "5"]
+        cursor = re.search(r"before=(\d+)&amp;after=3", html)
+        assert cursor is not None
+        html = self.get(before=int(cursor.group(1)), after=3, pid=os.getpid())
+        assert re.findall(r"message (\d+)", html) == ["4"]
+        assert "before=" not in html
+
+    def testOtherWorkerCursor(self):
+        """Test a cursor of another worker restarts the whole tail of this worker"""
+        with self.app.test_request_context():
+            resp = flask.make_response(self.contr.handleLogTail(after=1, pid=os.getpid() + 1))
+        assert resp.headers['HX-Retarget'] == "#log-div"
+        html = resp.get_data(as_text=True)
+        assert "<table" in html and re.findall(r"message (\d+)", html) == ["3", "2"]
+        assert f"pid={os.getpid()}" in html
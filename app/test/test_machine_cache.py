@@ -0,0 +1,60 @@
+import unittest
+import uuid
+from machineCache import MachineCache
+from sessionStore import MemorySessionStore
+
+
+class TestMachineCache(unittest.TestCase):
+    def setUp(self):
+        self.store = MemorySessionStore()
+        self.cache = MachineCache(self.store, ttl=60)
+        self.mid = uuid.uuid4()
+        self.builds = 0
+
+    def build(self, expiresIn=None):
+        self.builds += 1
+        return {'hostName': f"build {self.builds}"}, expiresIn
+
+    def testHit(self):
+        """Test repeated views are served from the cache, also if the id is given as string"""
+        assert self.cache.get(self.mid, self.build)['hostName'] == "build 1"
+        assert self.cache.get(str(self.mid), self.build)['hostName'] == "build 1"
+        assert self.cache.stats()['hits'] == 1 and self.cache.stats()['misses'] == 1
+
+    def testInvalidate(self):
+        """Test a write to the machine rebuilds its fragments, but not the ones of other machines"""
+        other = uuid.uuid4()
+        self.cache.get(self.mid, self.build)
+        self.cache.get(other, self.build)
+        self.cache.invalidate(str(self.mid), shared=False)
+        assert self.cache.get(self.mid, self.build)['hostName'] == "build 3"
+        assert self.cache.get(other, self.build)['hostName'] == "build 2"
+
+    def testSharedStamp(self):
+        """Test a write in another worker sharing the store invalidates the entries of this one"""
+        self.cache.get(self.mid, self.build)
+        MachineCache(self.store).invalidate(self.mid)
+        assert self.cache.get(self.mid, self.build)['hostName'] == "build 2"
+        assert self.cache.get(self.mid, self.build)['hostName'] == "build 2"
+
+    def testWriteWhileBuilding(self):
+        """Test fragments built while the machine was written to aren't served afterwards"""
+        def build():
+            self.cache.invalidate(self.mid, shared=False)
+            return self.build()
+        self.cache.get(self.mid, build)
+        assert self.cache.get(self.mid, self.build)['hostName'] == "build 2"
+
+    def testExpiry(self):
+        """Test fragments aren't served after they expire on their own, like a password passing its expiry"""
+        self.cache.get(self.mid, lambda: self.build(expiresIn=0))
+        assert self.cache.get(self.mid, self.build)['hostName'] == "build 2"
+
+    def testClearAndMaxSize(self):
+        """Test clear drops all entries and the least recently used entry is dropped above maxSize"""
+        cache = MachineCache(self.store, maxSize=1)
+        cache.get(self.mid, self.build)
+        cache.get(uuid.uuid4(), self.build)
+        assert cache.stats()['entries'] == 1
+        cache.clear()
+        assert cache.stats()['entries'] == 0
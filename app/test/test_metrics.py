@@ -0,0 +1,64 @@
+import unittest
+import uuid
+from fixtures.db import DBMock
+import metrics
+from metrics import Counter, Histogram, Metric, Registry
+
+
+class TestMetrics(unittest.TestCase):
+    def testAbstract(self):
+        """Test a metric has to render its values"""
+        with self.assertRaises(TypeError):
+            Metric("abstract", "Abstract")
+
+    def testHistogramRender(self):
+        """Test the buckets are rendered cumulative with the sum and count of all observations"""
+        registry = Registry()
+        histogram = registry.register(Histogram("latency_seconds", "Latency", ("route",), buckets=(0.1, 1)))
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.observe(value, "/api/checkin")
+        assert registry.render().splitlines() == [
+            "# HELP latency_seconds Latency",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{route="/api/checkin",le="0.1"} 1',
+            'latency_seconds_bucket{route="/api/checkin",le="1"} 3',
+            'latency_seconds_bucket{route="/api/checkin",le="+Inf"} 4',
+            'latency_seconds_sum{route="/api/checkin"} 6.05',
+            'latency_seconds_count{route="/api/checkin"} 4',
+        ]
+
+    def testTimedErrors(self):
+        """Test timed records every call and counts the calls returning False as errors"""
+        histogram = Histogram("vault_seconds", "Vault")
+        errors = Counter("vault_errors_total", "Errors", ("method",))
+
+        @metrics.timed(histogram, errors)
+        def hsm_dec(result):
+            return result
+
+        hsm_dec({'data': {}})
+        hsm_dec(False)
+        assert histogram.count("hsm_dec") == 2
+        assert errors.get("hsm_dec") == 1
+        assert 'vault_errors_total{method="hsm_dec"} 1' in errors.render()
+
+
+class TestDBMetrics(unittest.TestCase):
+    def setUp(self):
+        self.db = DBMock()
+
+    def tearDown(self):
+        self.db.reset_db()
+
+    def testQueriesPerMethod(self):
+        """Test the statements of a dbClient method are counted once, also if it calls other methods"""
+        uid = uuid.uuid4()
+        self.db.createMachine(uid, "test", "testitest")
+        calls = metrics.dbLatency.count("getMachineList")
+        queries = metrics.dbQueries.get("getMachineList")
+        statuses = metrics.dbLatency.count("getLatestPasswordStatuses")
+        self.db.getMachineList()
+        assert metrics.dbLatency.count("getMachineList") == calls + 1
+        assert metrics.dbQueries.get("getMachineList") > queries
+        # called by getMachineList, so it's part of its call
+        assert metrics.dbLatency.count("getLatestPasswordStatuses") == statuses
@@ -0,0 +1,151 @@
+import base64
+import csv
+import io
+import json
+import socket
+import threading
+import unittest
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from fixtures.controller import ControllerMock
+from fixtures.db import DBMock
+from pony import orm
+import hsmclient
+import machineCache
+import sessionStore
+
+# HSMClient always talks to port 8200 of the given host
+VAULT_PORT = 8200
+
+
+def portFree(port: int) -> bool:
+    with socket.socket() as s:
+        return s.connect_ex(('127.0.0.1', port)) != 0
+
+
+class TransitStub(BaseHTTPRequestHandler):
+    """Answers approle logins and batch en- and decryptions, the ciphertext of a plaintext is vault:v1:<plaintext>
+    Plaintexts and ciphertexts containing "fail" only get an error, like vault reports failed batch items"""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b"{}")
+        if self.path.endswith("/approle/login"):
+            result = {'auth': {'client_token': "token", 'num_uses': 100, 'lease_duration': 3600}}
+        elif "/transit/encrypt/" in self.path:
+            result = {'data': {'batch_results': [
+                {'error': "encryption failed"} if "fail" in base64.b64decode(item['plaintext']).decode() else
+                {'ciphertext': "vault:v1:" + item['plaintext']} for item in body['batch_input']]}}
+        elif "/transit/decrypt/" in self.path:
+            result = {'data': {'batch_results': [
+                {'error': "decryption failed"} if "fail" in item['ciphertext'] else
+                {'plaintext': item['ciphertext'][len("vault:v1:"):]} for item in body['batch_input']]}}
+        else:
+            result = {}
+        data = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipUnless(portFree(VAULT_PORT), f"port {VAULT_PORT} of the vault stub is in use")
+class TestBatchTransit(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', VAULT_PORT), TransitStub)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.hsm = hsmclient.HSMClient("127.0.0.1", "role", "secret", timeout=5, standbyTokens=0)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testPartialFailure(self):
+        """Test the results of a batch stay in order and failed items only have an error"""
+        results = self.hsm.hsm_enc_batch(["pw1", "fail", "pw3"])['data']['batch_results']
+        assert 'ciphertext' in results[0] and 'ciphertext' not in results[1] and 'ciphertext' in results[2]
+        ciphers = [results[0]['ciphertext'], "vault:v1:fail", results[2]['ciphertext']]
+        results = self.hsm.hsm_dec_batch(ciphers)['data']['batch_results']
+        assert [base64.b64decode(r['plaintext']).decode() if 'plaintext' in r else None for r in results] == \
+            ["pw1", None, "pw3"]
+
+    def testExport(self):
+        """Test the export decrypts in batches, records only the decrypted passwords and escapes formulas"""
+        db = DBMock()
+        try:
+            contr = exportController(db, self.hsm)
+            mids = []
+            for hostname, password in (("=HYPERLINK(\"x\")", "pw1"), ("host2", "fail"), ("host3", "pw3")):
+                mid = uuid.uuid4()
+                mids.append(mid)
+                db.createMachine(mid, "@serial", hostname)
+                with orm.db_session:
+                    db.createPassword(mid, "vault:v1:" + base64.b64encode(password.encode()).decode()
+                                      if password != "fail" else "vault:v1:fail")
+                    db.updatePasswordSecStage("Success", mid)
+            rows = list(csv.reader(io.StringIO(contr.handleExportPasswords("admin", [str(mid) for mid in mids]))))
+            byMachine = {row[0]: row for row in rows[1:]}
+            assert byMachine[str(mids[0])][1:3] == ["'=HYPERLINK(\"x\")", "'@serial"]
+            assert byMachine[str(mids[0])][4] == "pw1"
+            assert byMachine[str(mids[1])][4] == "Decryption failed in HSM"
+            assert byMachine[str(mids[2])][4] == "pw3"
+            with orm.db_session:
+                accessed = {(entry.admin_kurzel, entry.machine_id.id) for entry in db.AccessLog.select()}
+            assert accessed == {("admin", mids[0]), ("admin", mids[2])}
+        finally:
+            db.reset_db()
+
+
+class SessionCheckingHSM:
+    """Decrypts ciphertexts vault:v1:<plaintext> and remembers if a db session was open during a decryption"""
+
+    def __init__(self):
+        self.inSession = False
+
+    def hsm_dec_batch(self, ciphers):
+        self.inSession |= orm.core.local.db_session is not None
+        return {'data': {'batch_results': [{'plaintext': base64.b64encode(cipher[len("vault:v1:"):].encode()).decode()}
+                                           for cipher in ciphers]}}
+
+
+class TestExportSessions(unittest.TestCase):
+    def setUp(self):
+        self.db = DBMock()
+        self.hsm = SessionCheckingHSM()
+        self.contr = exportController(self.db, self.hsm)
+        self.mids = [uuid.uuid4() for _ in range(3)]
+        for i, mid in enumerate(self.mids):
+            self.db.createMachine(mid, f"serial{i}", f"host{i}")
+            with orm.db_session:
+                self.db.createPassword(mid, f"vault:v1:pw{i}")
+                self.db.updatePasswordSecStage("Success", mid)
+
+    def tearDown(self):
+        self.db.reset_db()
+
+    def testNoSessionWhileDecrypting(self):
+        """Test the export holds no db session during the hsm requests and marks the passwords as seen"""
+        rows = list(csv.reader(io.StringIO(self.contr.handleExportPasswords("admin", [str(mid) for mid in self.mids]))))
+        assert sorted(row[4] for row in rows[1:]) == ["pw0", "pw1", "pw2"]
+        assert self.hsm.inSession is False
+        with orm.db_session:
+            assert {pw.status for pw in self.db.Password.select()} == {'Seen'}
+            assert self.db.AccessLog.select().count() == 3
+
+    def testUnrecordedWithheld(self):
+        """Test passwords are withheld and no access is recorded if they can't be marked as seen"""
+        self.db.markPasswordsSeen = lambda pwids, hours=1: False
+        rows = list(csv.reader(io.StringIO(self.contr.handleExportPasswords("admin", [str(mid) for mid in self.mids]))))
+        assert {row[4] for row in rows[1:]} == {"Failed to record the access"}
+        with orm.db_session:
+            assert self.db.AccessLog.select().count() == 0
+
+
+def exportController(db, hsm):
+    """Returns a controller with only what the export needs"""
+    # two batches for the three machines
+    return ControllerMock({'HSM': {'batch-size': '2'}}, mysqlConx=db, hsmClient=hsm,
+                          machineCache=machineCache.MachineCache(sessionStore.MemorySessionStore()))
@@ -0,0 +1,108 @@
+import configparser
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import unittest
+import requests
+import prefork
+
+# serves the pid of the worker handling the request, the port of the listener is printed by the master
+SERVER = """
+import os, sys, prefork
+
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid()).encode()]
+
+master = prefork.PreforkServer(('127.0.0.1', 0), 3)
+print(master.socket.getsockname()[1], flush=True)
+master.run()
+prefork.serve(prefork.PreboundWSGIServer(master.socket, app, numthreads=2))
+"""
+
+
+class TestPreforkServer(unittest.TestCase):
+    def setUp(self):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        self.master = subprocess.Popen([sys.executable, "-c", SERVER], stdout=subprocess.PIPE, env=env, text=True)
+        self.url = f"http://127.0.0.1:{self.master.stdout.readline().strip()}/"
+
+    def tearDown(self):
+        self.master.send_signal(signal.SIGTERM)
+        self.master.wait(10)
+        self.master.stdout.close()
+
+    def workerPids(self, requestCount=60) -> set:
+        pids = set()
+        for _ in range(requestCount):
+            # a new connection for every request, so the workers compete for it
+            pids.add(int(requests.get(self.url, headers={'Connection': 'close'}, timeout=5).text))
+        return pids
+
+    def testSharedListener(self):
+        """Test the connections are accepted by several workers on the socket bound by the master"""
+        pids = self.workerPids()
+        assert len(pids) > 1
+        assert self.master.pid not in pids
+
+    def testRestartWorker(self):
+        """Test a killed worker is replaced and the master stops all workers on SIGTERM"""
+        killed = self.workerPids().pop()
+        os.kill(killed, signal.SIGKILL)
+        time.sleep(1.5)
+        newPids = self.workerPids()
+        assert killed not in newPids and len(newPids) > 1
+        self.master.send_signal(signal.SIGTERM)
+        assert self.master.wait(10) == 0
+        for pid in newPids:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(pid, 0)
+
+
+class TestServerConfig(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        config = configparser.ConfigParser()
+        config.read_string("[SERVER]\nthreads = 2\nrequest-queue-size = 50\nmax-request-body-size = 10\n")
+        self.server = prefork.createServer(config, ('127.0.0.1', 0), self.app)
+        self.server.prepare()
+        threading.Thread(target=self.server.serve, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.bind_addr[1]}/"
+
+    def tearDown(self):
+        self.release.set()
+        self.server.stop()
+
+    def app(self, environ, start_response):
+        self.release.wait(5)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b"ok"]
+
+    def testGauges(self):
+        """Test the gauges report the busy threads and the connections waiting for one"""
+        gauges = prefork.serverGauges(self.server)
+        assert gauges['threads'] == 2 and gauges['busyThreads'] == 0 and gauges['acceptedQueue'] == 0
+        if gauges['acceptBacklog'] is not None:
+            assert gauges['acceptBacklog'] == 50
+        clients = [threading.Thread(target=requests.get, args=(self.url,), kwargs={'timeout': 10}) for _ in range(4)]
+        for client in clients:
+            client.start()
+        # both threads are blocked by the app, the other two requests wait in the accepted queue
+        deadline = time.monotonic() + 5
+        gauges = prefork.serverGauges(self.server)
+        while (gauges['busyThreads'], gauges['acceptedQueue']) != (2, 2) and time.monotonic() < deadline:
+            time.sleep(0.01)
+            gauges = prefork.serverGauges(self.server)
+        assert gauges['busyThreads'] == 2 and gauges['acceptedQueue'] == 2
+        self.release.set()
+        for client in clients:
+            client.join()
+
+    def testMaxRequestBodySize(self):
+        """Test request bodies over max-request-body-size are rejected"""
+        self.release.set()
+        assert requests.post(self.url, data="x" * 100, timeout=5).status_code == 413
+        assert requests.post(self.url, data="x" * 5, timeout=5).status_code == 200
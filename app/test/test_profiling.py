@@ -0,0 +1,101 @@
+import time
+import unittest
+import uuid
+from fixtures.db import DBMock
+import metrics
+import profiling
+from metrics import Histogram
+from profiling import Profiler
+
+
+class TestProfiler(unittest.TestCase):
+    def testHeaderTrigger(self):
+        """Test only requests sending the header are profiled if nothing is sampled"""
+        profiler = Profiler(header="X-MLAPS-Profile")
+        assert profiler.begin("GET", "/", {}) is None
+        assert profiler.end(200) is None
+        assert profiler.begin("GET", "/", {"X-MLAPS-Profile": "1"}) is profiling.current()
+        profile = profiler.end(200)
+        assert profile.status == 200 and profile.total >= 0 and profile.requested
+        assert profiling.current() is None
+
+    def testHeaderUnauthorized(self):
+        """Test the header is ignored for clients which aren't authorized, while sampling still profiles them"""
+        checked = []
+
+        def authorized():
+            checked.append(True)
+            return False
+
+        profiler = Profiler(header="X-MLAPS-Profile")
+        assert profiler.begin("GET", "/", {}, authorized=authorized) is None
+        assert checked == []
+        assert profiler.begin("GET", "/", {"X-MLAPS-Profile": "1"}, authorized=authorized) is None
+        assert checked == [True]
+        profiler.sampleRate = 1.0
+        assert not profiler.begin("GET", "/", {"X-MLAPS-Profile": "1"}, authorized=authorized).requested
+        profiler.end(200)
+        assert profiler.begin("GET", "/", {"X-MLAPS-Profile": "1"}, authorized=lambda: True).requested
+        profiler.end(200)
+
+    def testDisabled(self):
+        """Test no request is profiled without sampling and header"""
+        profiler = Profiler()
+        assert not profiler.enabled
+        assert profiler.begin("GET", "/", {"X-MLAPS-Profile": "1"}) is None
+
+    def testSampled(self):
+        """Test every request is profiled with a sample rate of 1"""
+        profiler = Profiler(sampleRate=1.0)
+        assert profiler.begin("GET", "/", {}) is not None
+        assert not profiler.end(200).requested
+
+    def testVaultAndTemplateTime(self):
+        """Test the time of the timed vault calls and the template rendering is added to the profile"""
+        profiler = Profiler(header="X-MLAPS-Profile")
+
+        @metrics.timed(Histogram("vault_seconds", "Vault"), profile='vault')
+        def hsm_dec():
+            time.sleep(0.02)
+
+        profile = profiler.begin("GET", "/", {"X-MLAPS-Profile": "1"})
+        hsm_dec()
+        profiling.templateStarted(None, None, {})
+        time.sleep(0.01)
+        profiling.templateRendered(None, None, {})
+        profiler.end(200)
+        assert profile.vault >= 0.02
+        assert profile.template >= 0.01
+        assert "vault;dur=" in profile.serverTiming() and "template;dur=" in profile.serverTiming()
+        # calls outside of a profiled request are only recorded in the histogram
+        hsm_dec()
+        assert profile.vault < 0.04
+
+    def testSlowLog(self):
+        """Test only requests above the threshold are kept, the newest first and at most slowLogSize of them"""
+        profiler = Profiler(sampleRate=1.0, slowThreshold=0.01, slowLogSize=2)
+        profiler.begin("GET", "/fast", {})
+        profiler.end(200)
+        for path in ("/slow1", "/slow2", "/slow3"):
+            profiler.begin("GET", path, {})
+            time.sleep(0.01)
+            profiler.end(200)
+        assert [profile.path for profile in profiler.slowRequests()] == ["/slow3", "/slow2"]
+
+
+class TestProfilerDB(unittest.TestCase):
+    def setUp(self):
+        self.db = DBMock()
+
+    def tearDown(self):
+        self.db.reset_db()
+
+    def testQueries(self):
+        """Test the sql statements of the request and their time are recorded"""
+        profiler = Profiler(self.db.dbClient, header="X-MLAPS-Profile")
+        profiler.begin("GET", "/", {"X-MLAPS-Profile": "1"})
+        self.db.createMachine(uuid.uuid4(), "test", "testitest")
+        self.db.getMachineList()
+        profile = profiler.end(200)
+        assert profile.queries > 0
+        assert profile.db > 0
@@ -0,0 +1,54 @@
+import ast
+import os
+import unittest
+import flask
+import starter
+
+# routes which must only be reachable by logged-in users of the webaccess_mlaps group
+PROTECTED = ['/', '/api/machineTable', '/api/logTail', '/access_log', '/api/accessLogTable', '/api/getPassword',
+             '/api/expirePassword', '/api/disableMachine', '/api/createSharelinkPassword', '/api/createSharelink',
+             '/api/disableUnenrolledMachines', '/api/bulkDisableMachines', '/api/bulkExpirePasswords',
+             '/api/exportPasswords', '/detailedMachine', '/admin']
+
+
+def routeDecorators() -> dict:
+    """Returns the decorator names of every route function of starter.createApp, the outermost first, by route"""
+    with open(os.path.join(os.path.dirname(starter.__file__), "starter.py")) as f:
+        tree = ast.parse(f.read())
+    routes = {}
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.FunctionDef):
+            continue
+        names = [ast.unparse(d.func if isinstance(d, ast.Call) else d) for d in node.decorator_list]
+        for d in node.decorator_list:
+            if isinstance(d, ast.Call) and ast.unparse(d.func) == "app.route":
+                routes[d.args[0].value] = names
+    return routes
+
+
+class TestRoutes(unittest.TestCase):
+    def testDecoratorOrder(self):
+        """Test the login and permission checks are below app.route, so flask registers the checked function"""
+        routes = routeDecorators()
+        for route in PROTECTED:
+            decorators = [name for name in routes[route] if name != "csrf.exempt"]
+            assert decorators == ["app.route", "oidc.require_login", "checkPermission"], (route, decorators)
+        # every route checking the permission is listed above
+        assert sorted(route for route, names in routes.items() if "checkPermission" in names) == sorted(PROTECTED)
+
+    def testPermission(self):
+        """Test users without the webaccess_mlaps group and anonymous users get Not Authorized"""
+        users = {'admin': {'username': 'admin', 'groups': ['webaccess_mlaps']},
+                 'user': {'username': 'user', 'groups': ['staff']}, 'anonymous': None}
+        app = flask.Flask(__name__)
+        checkPermission = starter.permissionRequired(lambda: users[flask.request.args['user']])
+
+        @app.route('/api/bulkDisableMachines', methods=['POST'])
+        @checkPermission
+        def handleBulkDisableMachines():
+            return "disabled"
+
+        client = app.test_client()
+        assert client.post('/api/bulkDisableMachines?user=admin').text == "disabled"
+        assert client.post('/api/bulkDisableMachines?user=user').text == "Not Authorized"
+        assert client.post('/api/bulkDisableMachines?user=anonymous').text == "Not Authorized"
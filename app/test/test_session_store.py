@@ -0,0 +1,175 @@
+import logging
+import os
+import tempfile
+import time
+import types
+import unittest
+import uuid
+from fixtures.controller import ControllerMock
+from fixtures.db import DBMock
+from pony import orm
+from checkinBuffer import CheckinBuffer
+from sessionStore import DBSessionStore, MemorySessionStore, SessionStore, SqliteSessionStore
+import machineCache
+
+
+class SessionStoreTests():
+    """Tests every session store has to pass, mixed into one test case per backend"""
+
+    def testSetGetPop(self):
+        """Test an entry can be read until it is popped and namespaces are kept apart"""
+        assert self.store.set('update', 'uid', 'usid', 60) is True
+        assert self.store.get('update', 'uid') == 'usid'
+        assert self.store.get('sharelink', 'uid') is None
+        assert self.store.pop('update', 'uid') == 'usid'
+        assert self.store.get('update', 'uid') is None
+        assert self.store.pop('update', 'uid') is None
+
+    def testReplace(self):
+        """Test setting an existing entry replaces its value"""
+        self.store.set('sharelink', 'rid', {'mid': 'a', 'pw': 'x'}, 60)
+        self.store.set('sharelink', 'rid', {'mid': 'b', 'pw': 'y'}, 60)
+        assert self.store.get('sharelink', 'rid') == {'mid': 'b', 'pw': 'y'}
+
+    def testExpiry(self):
+        """Test expired entries are neither returned by get nor by pop"""
+        self.store.set('update', 'uid', 'usid', 0.2)
+        time.sleep(0.3)
+        assert self.store.get('update', 'uid') is None
+        assert self.store.pop('update', 'uid') is None
+
+    def testSweep(self):
+        """Test sweep removes only the expired entries and they are counted until then"""
+        self.store.set('update', 'old', 'usid', 0.2)
+        self.store.set('update', 'new', 'usid', 60)
+        time.sleep(0.3)
+        assert self.store.count() == (1, 1)
+        assert self.store.sweep() == 1
+        assert self.store.count() == (1, 0)
+        assert self.store.get('update', 'new') == 'usid'
+        assert self.store.stats()['swept'] == 1
+
+    def testMaxSize(self):
+        """Test the entries expiring the soonest are evicted once more than maxSize are stored"""
+        self.store.maxSize = 2
+        for i, ttl in enumerate([30, 10, 20]):
+            self.store.set('sharelink', f"rid{i}", i, ttl)
+        self.store.sweep()
+        assert self.store.count() == (2, 0)
+        assert self.store.get('sharelink', 'rid1') is None
+        assert self.store.get('sharelink', 'rid0') == 0
+        assert self.store.stats()['evicted'] == 1
+
+    def testMaxSizePerNamespace(self):
+        """Test a store full of update sessions evicts only update sessions, even if a share link expires sooner"""
+        self.store.maxSize = 3
+        self.store.set('sharelink', 'rid', 'link', 10)
+        for i in range(5):
+            self.store.set('update', f"uid{i}", 'usid', 60 + i)
+        self.store.sweep()
+        assert self.store.get('sharelink', 'rid') == 'link'
+        assert self.store.count() == (4, 0)
+        assert self.store.get('update', 'uid0') is None and self.store.get('update', 'uid4') == 'usid'
+
+
+class TestMemorySessionStore(SessionStoreTests, unittest.TestCase):
+    def setUp(self):
+        self.store = MemorySessionStore()
+
+    def testReplacedEntryKeepsNewExpiry(self):
+        """Test the heap item of a replaced entry doesn't sweep the entry with its old expiry"""
+        self.store.set('update', 'uid', 'first', 0.2)
+        self.store.set('update', 'uid', 'second', 60)
+        time.sleep(0.3)
+        assert self.store.sweep() == 0
+        assert self.store.get('update', 'uid') == 'second'
+
+
+class TestSqliteSessionStore(SessionStoreTests, unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        self.store = SqliteSessionStore(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def testSharedByProcesses(self):
+        """Test a second store on the same file sees the entries, as another process would"""
+        self.store.set('update', 'uid', 'usid', 60)
+        other = SqliteSessionStore(self.path)
+        assert other.pop('update', 'uid') == 'usid'
+        assert self.store.get('update', 'uid') is None
+
+
+class TestDBSessionStore(SessionStoreTests, unittest.TestCase):
+    def setUp(self):
+        self.db = DBMock()
+        self.store = DBSessionStore(self.db)
+
+    def tearDown(self):
+        self.db.reset_db()
+
+
+class FailingSessionStore(MemorySessionStore):
+    """Stands in for a store which can't be written, like the db store while the database is down"""
+
+    def set(self, namespace, key, value, ttl) -> bool:
+        return False
+
+
+class TestCheckinHandshake(unittest.TestCase):
+    def setUp(self):
+        self.db = DBMock()
+        self.uid = uuid.uuid4()
+        self.db.createMachine(self.uid, "serial", "host")
+
+    def tearDown(self):
+        self.db.reset_db()
+
+    def testAbstract(self):
+        """Test a store has to implement the whole interface"""
+        with self.assertRaises(TypeError):
+            SessionStore()
+
+    def testUnstoredUpdateSession(self):
+        """Test the checkin doesn't hand out an update session id the store failed to save"""
+        for store, stored in ((MemorySessionStore(), True), (FailingSessionStore(), False)):
+            contr = ControllerMock(mysqlConx=self.db, secrets={'MYSQL': {'password': "password"}}, sessions=store,
+                                   updateSessionTTL=60, checkinBuffer=CheckinBuffer(self.db, maxSize=10),
+                                   machineCache=machineCache.MachineCache(store))
+            ok, res = contr.handleCheckin(str(self.uid), "host", "serial")
+            assert ok is False
+            if stored:
+                assert store.get('update', str(self.uid)) == res['updateSessionID']
+            else:
+                assert res == "Failed to start the password update, try again later"
+
+    def testUnstoredShareLink(self):
+        """Test no share link is handed out and no access is recorded if the store failed to save the link"""
+        with orm.db_session:
+            self.db.createPassword(self.uid, "cipher")
+            self.db.updatePasswordSecStage("Success", self.uid)
+        for store, stored in ((FailingSessionStore(), False), (MemorySessionStore(), True)):
+            contr = ControllerMock(mysqlConx=self.db, secrets={'MYSQL': {'password': "password"}}, sessions=store,
+                                   shareLinkTTL=60)
+            link = contr.handleCreateShareLink(str(self.uid), "share", "admin")
+            with orm.db_session:
+                accessed = self.db.AccessLog.select().count()
+            if stored:
+                assert store.get('sharelink', link)['mid'] == str(self.uid)
+                assert accessed == 1
+            else:
+                assert link is None
+                assert accessed == 0
+
+    def testPasswordNotLogged(self):
+        """Test the update of a password doesn't log the new password, not even on debug"""
+        store = MemorySessionStore()
+        store.set('update', str(self.uid), 'usid', 60)
+        hsm = types.SimpleNamespace(hsm_enc=lambda password: {'data': {'ciphertext': "vault:v1:cipher"}})
+        contr = ControllerMock(mysqlConx=self.db, sessions=store, hsmClient=hsm,
+                               machineCache=machineCache.MachineCache(store))
+        with self.assertLogs('mlaps', logging.DEBUG) as logs:
+            assert contr.handleUpdatePassword("secret-password", str(self.uid), 'usid') == [True, "ok"]
+        assert not any("secret-password" in line for line in logs.output)
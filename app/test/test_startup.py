@@ -0,0 +1,66 @@
+import threading
+import time
+import unittest
+from startup import StartupApp
+
+
+def call(app, path):
+    response = {}
+
+    def start_response(status, headers):
+        response['status'] = status
+        response['headers'] = dict(headers)
+
+    body = b"".join(app({'PATH_INFO': path}, start_response))
+    return response['status'], response['headers'], body
+
+
+def ready(environ, start_response):
+    start_response('200 OK', [])
+    return [b"app"]
+
+
+class TestStartupApp(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.startup = StartupApp(retryAfter=7)
+
+    def tearDown(self):
+        self.release.set()
+
+    def waitFor(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def build(self):
+        self.release.wait(5)
+        return ready
+
+    def testServeWhileInitializing(self):
+        """Test /ping answers at once and all other paths wait for the app built in the background"""
+        self.startup.initialize(self.build)
+        assert call(self.startup, '/ping') == ('200 OK', {'Content-Type': 'text/plain', 'Content-Length': '4'}, b"pong")
+        assert call(self.startup, '/ready')[0].startswith('503')
+        status, headers, _ = call(self.startup, '/')
+        assert status.startswith('503') and headers['Retry-After'] == '7'
+        self.release.set()
+        assert self.waitFor(lambda: self.startup.app is not None)
+        assert call(self.startup, '/ready')[0] == '200 OK'
+        assert call(self.startup, '/')[2] == b"app"
+        assert self.startup.startupTime is not None
+
+    def testFailedInitialization(self):
+        """Test a failing initialisation interrupts the server, so the process exits"""
+        class Server():
+            interrupt = None
+
+        def fail():
+            raise ValueError("no database")
+
+        server = Server()
+        self.startup.initialize(fail, server)
+        assert self.waitFor(lambda: server.interrupt is not None)
+        assert isinstance(server.interrupt, ValueError)
+        assert call(self.startup, '/ready')[0].startswith('503')
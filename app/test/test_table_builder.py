@@ -0,0 +1,60 @@
+import unittest
+import uuid
+import flask
+from fixtures.db import DBMock
+from pony import orm
+from tableBuilder import TableBuilder
+
+# endpoints the tables link to
+ENDPOINTS = ["home", "handle_access_log", "handleDetailedMachine", "handleShowPassword", "handleCreateShareLinkPassword",
+             "handleExpireNow", "handleDisableMachine"]
+
+
+class TestStreamTables(unittest.TestCase):
+    def setUp(self):
+        self.db = DBMock()
+        self.builder = TableBuilder(self.db)
+        self.app = flask.Flask(__name__)
+        for endpoint in ENDPOINTS:
+            self.app.add_url_rule(f"/{endpoint}", endpoint, lambda: "")
+        self.mids = [uuid.uuid4() for _ in range(5)]
+        # pairs of equal hostnames, so the chunks also have to continue after the id of the last row
+        for i, mid in enumerate(self.mids):
+            assert self.db.createMachine(mid, f"serial{i}", f"host{i // 2}") is True
+
+    def tearDown(self):
+        self.db.reset_db()
+
+    def testMachineRowsOnce(self):
+        """Test the streamed machine table has every row exactly once, even if machines change while streaming"""
+        with self.app.test_request_context():
+            stream = self.builder.streamMachineTable(sort_by='hostname', chunkSize=2)
+            parts = [next(stream), next(stream)]
+            # a removed streamed machine doesn't shift the later chunks
+            streamed = next(mid for mid in self.mids if str(mid) in parts[1])
+            self.db.removeMachine(str(streamed))
+            html = "".join(parts + list(stream))
+        for mid in self.mids:
+            assert html.count(f">{mid}<") == 1
+
+    def testAccessRowsOnce(self):
+        """Test the streamed access log has every entry exactly once, even if entries are added while streaming"""
+        with orm.db_session:
+            self.db.createPassword(self.mids[0], "cipher")
+            pwid = self.db.Password.select().first().id
+        for _ in range(5):
+            assert self.db.createAccessEntry("admin", self.mids[0], pwid) is True
+        with orm.db_session:
+            aids = [entry.id for entry in self.db.AccessLog.select()]
+        with self.app.test_request_context():
+            stream = self.builder.streamAccessTable(sort_by='aid', sort_reverse='desc', chunkSize=2)
+            parts = [next(stream), next(stream)]
+            # a new entry sorted before the streamed ones doesn't shift the later chunks
+            self.db.createAccessEntry("admin", self.mids[0], pwid)
+            html = "".join(parts + list(stream))
+        for aid in aids:
+            assert html.count(f"<td>{aid}</td>") == 1
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -30,6 +30,8 @@ CURL_DELAY=0                                                            # some s
 CURL_MAX_RETRY_TIME=60                                                  # how long it takes for curl to give up
 N_RETRIES=4
 T_RETRIES=3
+ENROLL_N_POLLS=30                                                       # how often a pending enrollment is polled
+ENROLL_POLL_DELAY=2                                                     # the seconds between the polls of a pending enrollment
 
 # Templates
 #JSON_ENROLLMENT_FORMAT='{"csr":"%c", "sn":"%s", "hn":"%h"}'           # Format for json enrollment payload
@@ -140,17 +142,44 @@ function enroll(){
   CSR=$(echo $CSR|tr -d '\n ')
   local PAYLOAD="{\"csr\":\"$CSR\", \"sn\":\"$SN\", \"hn\":\"$HN\"}"
 
-  ("${CURL_BASIC[@]}"                 \
+  # the http code is appended as the last line of the response
+  local ENROLL_DATA
+  ENROLL_DATA=$("${CURL_BASIC[@]}"      \
     --request POST                    \
     --url "$MLAPS_ENDPOINT/enroll"     \
     --retry $CURL_N_RETRIES             \
     --max-time $CURL_MAX_T               \
     --retry-delay $CURL_DELAY             \
     --retry-max-time $CURL_MAX_RETRY_TIME  \
+    --write-out '\n%{http_code}'            \
     -H 'Content-Type: application/json'     \
-    --data "$PAYLOAD" | jq -r '.response' | tee "$CRT_FILE";  exit ${PIPESTATUS[0]} ;)
+    --data "$PAYLOAD")
+  local CURL_STATUS=$?
+  local HTTP_CODE=$(echo "$ENROLL_DATA" | tail -n 1)
+  local RESPONSE=$(echo "$ENROLL_DATA" | sed '$d')
+
+  # the server answers with 202 and the url to poll if the signing takes longer, poll it until the cert is ready
+  local POLLS=0
+  while [ $CURL_STATUS -eq 0 ] && [ "$HTTP_CODE" == "202" ] && [ $POLLS -lt $ENROLL_N_POLLS ]; do
+    local POLL_URL=$(echo "$RESPONSE" | jq -r '.poll')
+    jamflog "Enrollment is pending, polling $POLL_URL"
+    sleep $ENROLL_POLL_DELAY
+    ENROLL_DATA=$("${CURL_BASIC[@]}"     \
+      --request GET                    \
+      --url "$MLAPS_HOSTNAME$POLL_URL"  \
+      --retry $CURL_N_RETRIES            \
+      --max-time $CURL_MAX_T              \
+      --retry-delay $CURL_DELAY            \
+      --retry-max-time $CURL_MAX_RETRY_TIME \
+      --write-out '\n%{http_code}')
+    CURL_STATUS=$?
+    HTTP_CODE=$(echo "$ENROLL_DATA" | tail -n 1)
+    RESPONSE=$(echo "$ENROLL_DATA" | sed '$d')
+    POLLS=$((POLLS + 1))
+  done
 
-  if [ $? ]; then
+  if [ $CURL_STATUS -eq 0 ] && [ "$HTTP_CODE" == "200" ]; then
+    echo "$RESPONSE" | jq -r '.response' > "$CRT_FILE"
     jamflog "Downloaded cert"
     local crt_hash=$(openssl md5 <(openssl x509 -noout -modulus -in "$CRT_FILE"))
     local key_hash=$(openssl md5 <(openssl  rsa -noout -modulus -in "$KEY_FILE"))
@@ -163,7 +192,7 @@ function enroll(){
       return 1
     fi
   else
-    jamflog "Failed to download cert, cleaning up broken files"
+    jamflog "Failed to download cert (http $HTTP_CODE): $(echo "$RESPONSE" | jq -r '.response'), cleaning up broken files"
     #cleanEnrollment
     return 1
   fi